@@ -0,0 +1,241 @@
+"""
+Channel -> subscriber routing table for the Message Director.
+
+Every MD participant (MDClient / AsyncMDClient) subscribes to channels with
+CONTROL_SET_CHANNEL and drops them with CONTROL_REMOVE_CHANNEL. Rather than
+asking every connected participant whether it cares about a datagram, the MD
+keeps this reverse index and updates it incrementally on each control message,
+so the cost of routing depends only on the destination channels of the
+datagram and their real subscribers.
+
+Participants may also subscribe to whole ranges of channels with
+CONTROL_ADD_RANGE / CONTROL_REMOVE_RANGE (e.g. the StateServer or DB claiming
+a block of doIds). Ranges are kept in a sorted interval index: the channel
+space is cut into consecutive segments, each one carrying the set of
+participants whose ranges cover it, so finding the range subscribers of a
+channel is a single binary search.
+"""
+
+import bisect
+
+CHANNEL_MAX = 0xffffffffffffffff
+
+
+def merge_ranges(ranges):
+    """Merge sorted, non-overlapping (low, high) ranges that touch each other."""
+    merged = []
+    for low, high in ranges:
+        if merged and merged[-1][1] + 1 == low:
+            merged[-1] = (merged[-1][0], high)
+        else:
+            merged.append((low, high))
+
+    return merged
+
+
+class ChannelMap:
+    """Maps channels to the set of participants subscribed to them."""
+
+    def __init__(self):
+        self._subscribers = {}  # channel -> set of participants
+
+        # Interval index: segment i covers [_bounds[i], _bounds[i + 1] - 1]
+        # (the last one runs up to CHANNEL_MAX) and is subscribed to by
+        # _segments[i]. Adjacent segments never carry equal sets.
+        self._bounds = [0]
+        self._segments = [set()]
+        self._ranges = {}  # participant -> sorted list of merged (low, high)
+
+    def subscribe(self, participant, channel):
+        """
+        Subscribe a participant to a channel.
+        Returns the set of subscribers of that channel after the change.
+        """
+        participant.channels.add(channel)
+        subscribers = self._subscribers.get(channel)
+        if subscribers is None:
+            subscribers = self._subscribers[channel] = set()
+
+        subscribers.add(participant)
+        return subscribers
+
+    def unsubscribe(self, participant, channel):
+        """
+        Remove a participant from a channel.
+        Returns the set of subscribers left on that channel.
+        """
+        participant.channels.discard(channel)
+        subscribers = self._subscribers.get(channel)
+        if subscribers is None:
+            return set()
+
+        subscribers.discard(participant)
+        if not subscribers:
+            del self._subscribers[channel]
+
+        return subscribers
+
+    def add_range(self, participant, low, high):
+        """
+        Subscribe a participant to every channel in [low, high].
+        Overlapping or adjacent ranges of the same participant are merged.
+        Returns the (low, high, subscribers) segments whose subscriber set
+        changed, with their subscribers after the change.
+        """
+        self._check_range(low, high)
+
+        ranges = self._ranges.setdefault(participant, [])
+        i = bisect.bisect_left(ranges, (low, low))
+        if i and ranges[i - 1][1] >= low - 1:
+            i -= 1
+
+        j = i
+        while j < len(ranges) and ranges[j][0] <= high + 1:
+            low = min(low, ranges[j][0])
+            high = max(high, ranges[j][1])
+            j += 1
+
+        ranges[i:j] = [(low, high)]
+
+        return self._update_segments(low, high, participant, set.add)
+
+    def remove_range(self, participant, low, high):
+        """
+        Unsubscribe a participant from every channel in [low, high].
+        A range only partially covered is split around the removed part.
+        Returns the (low, high, subscribers) segments whose subscriber set
+        changed, with their subscribers after the change.
+        """
+        self._check_range(low, high)
+
+        ranges = self._ranges.get(participant)
+        if not ranges:
+            return []
+
+        remaining = []
+        for start, end in ranges:
+            if end < low or start > high:
+                remaining.append((start, end))
+                continue
+
+            if start < low:
+                remaining.append((start, low - 1))
+
+            if end > high:
+                remaining.append((high + 1, end))
+
+        if remaining:
+            self._ranges[participant] = remaining
+        else:
+            del self._ranges[participant]
+
+        return self._update_segments(low, high, participant, set.discard)
+
+    def get_ranges(self, participant):
+        """Returns the merged (low, high) ranges held by a participant."""
+        return list(self._ranges.get(participant, ()))
+
+    def unsubscribe_all(self, participant):
+        """Remove every subscription held by a participant (used on disconnect)."""
+        for channel in list(participant.channels):
+            self.unsubscribe(participant, channel)
+
+        for low, high in self.get_ranges(participant):
+            self.remove_range(participant, low, high)
+
+    def is_subscribed(self, channel):
+        """Returns True if at least one participant listens on the channel."""
+        if channel in self._subscribers:
+            return True
+
+        return bool(self._segments[bisect.bisect_right(self._bounds, channel) - 1])
+
+    def lookup(self, channels):
+        """
+        Returns the set of participants subscribed to any of the channels,
+        either directly or through a range.
+        A participant subscribed to several of them appears only once.
+        """
+        bounds = self._bounds
+        segments = self._segments
+        ranged = len(bounds) > 1
+
+        if len(channels) == 1:
+            channel = channels[0]
+            recipients = set(self._subscribers.get(channel, ()))
+            if ranged:
+                recipients |= segments[bisect.bisect_right(bounds, channel) - 1]
+
+            return recipients
+
+        recipients = set()
+        for channel in channels:
+            subscribers = self._subscribers.get(channel)
+            if subscribers:
+                recipients |= subscribers
+
+            if ranged:
+                recipients |= segments[bisect.bisect_right(bounds, channel) - 1]
+
+        return recipients
+
+    def channel_items(self):
+        """Yields (channel, subscribers) for every exact channel subscription."""
+        return iter(self._subscribers.items())
+
+    def range_items(self):
+        """Yields (low, high, subscribers) for every segment covered by a range."""
+        bounds = self._bounds
+        for i, subscribers in enumerate(self._segments):
+            if subscribers:
+                end = bounds[i + 1] - 1 if i + 1 < len(bounds) else CHANNEL_MAX
+                yield bounds[i], end, subscribers
+
+    def _check_range(self, low, high):
+        if not 0 <= low <= high <= CHANNEL_MAX:
+            raise ValueError(f"Invalid channel range: [{low}, {high}]")
+
+    def _split(self, channel):
+        """
+        Make sure a segment starts at channel and return its index.
+        """
+        if channel > CHANNEL_MAX:
+            return len(self._bounds)
+
+        i = bisect.bisect_right(self._bounds, channel) - 1
+        if self._bounds[i] == channel:
+            return i
+
+        self._bounds.insert(i + 1, channel)
+        self._segments.insert(i + 1, set(self._segments[i]))
+        return i + 1
+
+    def _update_segments(self, low, high, participant, update):
+        """
+        Apply update(subscribers, participant) to every segment in [low, high],
+        then merge the neighbouring segments that ended up identical.
+        """
+        first = self._split(low)
+        last = self._split(high + 1)
+
+        bounds = self._bounds
+        segments = self._segments
+        changed = []
+        for i in range(first, last):
+            subscribers = segments[i]
+            before = len(subscribers)
+            update(subscribers, participant)
+            if len(subscribers) != before:
+                end = bounds[i + 1] - 1 if i + 1 < len(bounds) else CHANNEL_MAX
+                changed.append((bounds[i], end, subscribers))
+
+        # Coalesce from the right so indices below stay valid.
+        for i in range(min(last, len(bounds) - 1), max(first, 1) - 1, -1):
+            if segments[i] == segments[i - 1]:
+                del bounds[i]
+                del segments[i]
+
+        return changed
+
+    def __len__(self):
+        return len(self._subscribers)
@@ -1,38 +1,282 @@
+from core_components import msgTypes
+from core_components.datagram import UINT16, Datagram, DatagramIterator
+from core_components.dc_codecs import UPDATE_FIELD_HEADER
 from core_components.faithful_logger import notify
+from core_components.message_director import makeFrame
+from core_components.timing_wheel import TimingWheel
+from core_components.zone_interest import EMPTY, ZoneInterestIndex
+
+# Messages a client may send before logging in, msgType -> handler method.
+ANONYMOUS_HANDLERS = {
+    msgTypes.CLIENT_HEARTBEAT: "handle_heartbeat",
+    msgTypes.CLIENT_DISCONNECT: "handle_disconnect",
+    msgTypes.CLIENT_LOGIN_2: "handle_login",
+}
+
+# Messages of a logged in client.
+AUTHENTICATED_HANDLERS = {
+    msgTypes.CLIENT_HEARTBEAT: "handle_heartbeat",
+    msgTypes.CLIENT_DISCONNECT: "handle_disconnect",
+    msgTypes.CLIENT_SET_SHARD: "handle_set_shard",
+    msgTypes.CLIENT_SET_ZONE: "handle_set_zone",
+}
+
+# Messages from the cluster, msgType -> handler method.
+SERVER_HANDLERS = {
+    msgTypes.STATESERVER_OBJECT_UPDATE_FIELD: "handle_object_update_field",
+}
+
+CLIENT_OBJECT_UPDATE_FIELD_HEADER = UINT16.pack(msgTypes.CLIENT_OBJECT_UPDATE_FIELD)
+
+
+def coalescableFields(classTable):
+    """
+    The numbers of the fields of a dc_tables class table whose updates a
+    later one supersedes: broadcast ram fields (positions and other state).
+    """
+    return frozenset(field.number for dclass in classTable.values() for field in dclass.fields
+                     if "broadcast" in field.keywords and "ram" in field.keywords)
+
+# Login token types the CA accepts in CLIENT_LOGIN_2.
+PLAY_TOKEN_TYPES = (msgTypes.CLIENT_LOGIN_2_GREEN, msgTypes.CLIENT_LOGIN_2_PLAY_TOKEN,
+                    msgTypes.CLIENT_LOGIN_2_BLUE)
+
+# Session timeouts, the kind of their TimerEntry
+TIMEOUT_HEARTBEAT = 0   # no CLIENT_HEARTBEAT for a while after login
+TIMEOUT_LOGIN = 1       # no CLIENT_LOGIN_2 since the connection was made
+TIMEOUT_ANONYMOUS = 2   # still not logged in, login verification included
+
+TIMEOUT_REASONS = {
+    TIMEOUT_HEARTBEAT: (msgTypes.CLIENT_DISCONNECT_NO_HEARTBEAT, "Server timed out while waiting for heartbeat"),
+    TIMEOUT_LOGIN: (msgTypes.CLIENT_DISCONNECT_ANONYMOUS_VIOLATION, "Login timed out"),
+    TIMEOUT_ANONYMOUS: (msgTypes.CLIENT_DISCONNECT_ANONYMOUS_VIOLATION, "Anonymous session timed out"),
+}
+
 
 class ClientAgent:
     logger = notify.new_category("CA")
 
-    def __init__(self, otp):
+    def __init__(self, otp, serverVersion=None, dcHash=None, heartbeatTimeout=60.0,
+                 loginTimeout=30.0, anonymousTimeout=120.0, visibility=None, updateWindow=0.0,
+                 coalesceFields=frozenset()):
+        """
+        :param otp: The OTP core.
+        :param serverVersion: Server version clients must log in with, None to accept any.
+        :param dcHash: DC hash clients must log in with, None to accept any.
+        :param heartbeatTimeout: Seconds a logged in client may go without a heartbeat, 0 for no limit.
+        :param loginTimeout: Seconds a new connection has to send its login, 0 for no limit.
+        :param anonymousTimeout: Seconds a connection may stay logged out, 0 for no limit.
+        :param visibility: zone_interest.VisibilityGraph of the zones visible from
+            each zone, instead of the visible zones clients send.
+        :param updateWindow: Seconds updates of coalesceFields are held per session,
+            a newer update of the same object and field replacing the queued one; 0 to send at once.
+        :param coalesceFields: Field numbers to coalesce, see coalescableFields.
+        """
         self.otp = otp
-        self.clients = []
+        self.serverVersion = serverVersion
+        self.dcHash = dcHash
+        self.clients = set()  # AsyncCAClient sessions
+        self.nextAccountId = 1
+
+        self.heartbeatTimeout = heartbeatTimeout
+        self.loginTimeout = loginTimeout
+        self.anonymousTimeout = anonymousTimeout
+        self.timeouts = TimingWheel(self.handleTimeouts)
+        self.interest = ZoneInterestIndex(visibility)
+
+        self.updateWindow = updateWindow
+        self.coalesceFields = coalesceFields
+        self.coalescedUpdates = 0  # updates replaced before they were sent
+
+        # Dispatch tables, resolved to bound methods once for every session
+        self.anonymousHandlers = self.bindHandlers(ANONYMOUS_HANDLERS)
+        self.authenticatedHandlers = self.bindHandlers(AUTHENTICATED_HANDLERS)
+        self.serverHandlers = self.bindHandlers(SERVER_HANDLERS)
+
+    def bindHandlers(self, names):
+        return {msgType: getattr(self, name) for msgType, name in names.items()}
 
     def handle(self, channels, sender, code, datagram):
-        print(f"[CA] Handling message from {sender} with code {code}")
-        # You could parse code types here and route accordingly
+        """
+        Handle a message routed by the MD. datagram borrows the received
+        bytes and is only valid during the call.
+        """
+        handler = self.serverHandlers.get(code)
+        if handler is None:
+            self.logger.debug("Ignoring message from %s with code %d", sender, code)
+            return
+
+        handler(channels, sender, datagram)
+
+    # Cluster message handlers: handler(channels, sender, datagram)
+
+    def handle_object_update_field(self, channels, sender, datagram):
+        """
+        STATESERVER_OBJECT_UPDATE_FIELD to location channels: [uint32 doId][uint16 field][args]
+        The CLIENT_OBJECT_UPDATE_FIELD frame is built once and queued on every
+        session watching one of the locations, except the one that sent it.
+        Updates of coalesceFields wait in each session's coalescing window.
+        """
+        sessions = self.interest.lookup(channels)
+        if not sessions:
+            return
+
+        payload = datagram.getMessage()
+        frame = makeFrame(CLIENT_OBJECT_UPDATE_FIELD_HEADER + bytes(payload))
+
+        if self.updateWindow and len(payload) >= UPDATE_FIELD_HEADER.size:
+            key = UPDATE_FIELD_HEADER.unpack_from(payload)  # (doId, field)
+            if key[1] in self.coalesceFields:
+                for session in sessions:
+                    if session.channel != sender and session.queueUpdate(key, frame, self.updateWindow):
+                        self.coalescedUpdates += 1
+                return
+
+        for session in sessions:
+            if session.channel != sender:
+                session.sendFrame(frame)
 
-    def handle_client_message(self, data, writer):
+    # Sessions, called by AsyncCAClient
+
+    def addSession(self, session):
+        self.clients.add(session)
+        if self.loginTimeout:
+            session.loginTimer = self.timeouts.schedule(self.loginTimeout, session, TIMEOUT_LOGIN)
+        if self.anonymousTimeout:
+            session.anonymousTimer = self.timeouts.schedule(self.anonymousTimeout, session, TIMEOUT_ANONYMOUS)
+
+        self.logger.debug("Connection from %s", session.address)
+
+    def removeSession(self, session):
+        self.clients.discard(session)
+        self.interest.removeSession(session)
+        for timer in (session.heartbeatTimer, session.loginTimer, session.anonymousTimer):
+            if timer is not None:
+                self.timeouts.cancel(timer)
+
+        self.logger.debug("Client %s disconnected", session.address)
+
+    def handleTimeouts(self, expired):
+        """Disconnect every session whose timeout expired during one tick of the wheel."""
+        for timer in expired:
+            session = timer.owner
+            reason, message = TIMEOUT_REASONS[timer.kind]
+            session.disconnect(reason, message)
+
+        self.logger.info("%d client sessions timed out", len(expired))
+
+    def handleClientDatagram(self, session, frame):
+        """
+        Dispatch a datagram from a client, [uint16 msgType][payload], through
+        the dispatch table of the session's state. frame is a view into the
+        session's receive buffer, only valid during the call.
+        """
+        di = DatagramIterator(frame)
+        msgType = di.getUint16()
+        handler = session.handlers.get(msgType)
+        if handler is None:
+            self.rejectMessage(session, msgType)
+            return
+
+        handler(session, di)
+
+    def rejectMessage(self, session, msgType):
+        if session.handlers is self.anonymousHandlers and msgType in self.authenticatedHandlers:
+            self.logger.warning("Client %s sent %d before logging in", session.address, msgType)
+            session.disconnect(msgTypes.CLIENT_DISCONNECT_ANONYMOUS_VIOLATION,
+                               "Message not allowed before login")
+            return
+
+        self.logger.warning("Client %s sent unknown message type %d", session.address, msgType)
+        session.disconnect(msgTypes.CLIENT_DISCONNECT_INVALID_MSGTYPE, f"Invalid message type {msgType}")
+
+    # Client message handlers: handler(session, di), di positioned after the msgType
+
+    def handle_heartbeat(self, session, di):
+        if session.heartbeatTimer is not None:
+            self.timeouts.rearm(session.heartbeatTimer, self.heartbeatTimeout)
+
+    def handle_disconnect(self, session, di):
+        session.close()
+
+    def handle_set_shard(self, session, di):
+        """CLIENT_SET_SHARD: [uint32 shardId], leaves every zone of the old shard"""
+        oldParent = session.parent
+        entered, left = self.interest.setInterest(session, di.getUint32(), EMPTY)
+        self.zonesChanged(session, oldParent, entered, left)
+
+    def handle_set_zone(self, session, di):
         """
-        Handle a message received from a client (asynchronously handled by another component).
+        CLIENT_SET_ZONE: [uint32 zoneId][uint32 visible zone]*
+        Watches the zone and the zones visible from it: those of the
+        visibility graph, or for zones it lacks those the client sent.
         """
-        try:
-            message = data.decode()
-            addr = writer.get_extra_info('peername')
+        zoneId = di.getUint32()
+        visibleZones = []
+        while di.getRemainingSize():
+            visibleZones.append(di.getUint32())
 
-            self.logger.debug(f"Received message {message} from {addr}")
+        entered, left = self.interest.setZone(session, session.parent, zoneId, visibleZones)
+        self.zonesChanged(session, session.parent, entered, left)
 
-            # Process the message (e.g., forward it to other components)
-            self.process_message(message, writer)
+        dg = Datagram()
+        dg.addUint16(msgTypes.CLIENT_DONE_SET_ZONE_RESP)
+        dg.addUint32(zoneId)
+        session.sendDatagram(dg)
+
+    def zonesChanged(self, session, oldParent, entered, left):
+        """
+        A session started watching the entered zones under session.parent and
+        stopped watching the left ones under oldParent. With a visibility
+        graph these diffs come from its cache. Override to generate the
+        objects of the entered zones on the client and disable those of the
+        left ones, before CLIENT_DONE_SET_ZONE_RESP is sent.
+        """
+        if entered or left:
+            self.logger.debug("Client %s entered %d zones and left %d", session.address,
+                              len(entered), len(left))
 
-        except Exception as e:
-            self.logger.error(f"Error processing client message: {e}")
+    def handle_login(self, session, di):
+        """CLIENT_LOGIN_2: [string playToken][string serverVersion][uint32 dcHash][int32 tokenType]"""
+        playToken = di.getString()
+        serverVersion = di.getString()
+        dcHash = di.getUint32()
+        tokenType = di.getInt32()
 
-    def process_message(self, message, writer):
+        if session.loginTimer is not None:
+            self.timeouts.cancel(session.loginTimer)
+
+        if self.serverVersion is not None and serverVersion != self.serverVersion:
+            session.disconnect(msgTypes.CLIENT_DISCONNECT_BAD_VERSION,
+                               f"Server version {serverVersion} is not {self.serverVersion}")
+            return
+
+        if self.dcHash is not None and dcHash != self.dcHash:
+            session.disconnect(msgTypes.CLIENT_DISCONNECT_BAD_DCHASH,
+                               f"DC hash {dcHash:#x} is not {self.dcHash:#x}")
+            return
+
+        if tokenType not in PLAY_TOKEN_TYPES:
+            session.disconnect(msgTypes.CLIENT_DISCONNECT_INVALID_PLAY_TOKEN_TYPE,
+                               f"Invalid play token type {tokenType}")
+            return
+
+        self.login(session, playToken)
+
+    def login(self, session, playToken):
         """
-        Process the client message and prepare a response.
+        Log a session in. There is no account database yet, so every play
+        token is accepted with a new account id; override to verify tokens
+        and answer the client.
         """
-        response = f"Server received: {message}"
-        
-        writer.write(response.encode())  # Send the response asynchronously
-        self.logger.debug(f"Sent response: {response}")
+        session.accountId = self.nextAccountId
+        self.nextAccountId += 1
+        session.channel = session.accountId + (1003 << 32)
+        session.handlers = self.authenticatedHandlers
+
+        if session.anonymousTimer is not None:
+            self.timeouts.cancel(session.anonymousTimer)
+        if self.heartbeatTimeout:
+            session.heartbeatTimer = self.timeouts.schedule(self.heartbeatTimeout, session, TIMEOUT_HEARTBEAT)
 
+        self.logger.info("Client %s logged in as account %d", session.address, session.accountId)
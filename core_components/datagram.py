@@ -1,18 +1,111 @@
 import struct
 
+from core_components import msgTypes
+
+# Precompiled little-endian field packers, the same encoding as Panda's
+# (Net)Datagram so both can be mixed on the wire.
+INT8 = struct.Struct("<b")
+INT16 = struct.Struct("<h")
+INT32 = struct.Struct("<i")
+INT64 = struct.Struct("<q")
+UINT8 = struct.Struct("<B")
+UINT16 = struct.Struct("<H")
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
+FLOAT32 = struct.Struct("<f")
+FLOAT64 = struct.Struct("<d")
+
+_routingHeaders = {}  # channel count -> Struct of the whole routing header
+_uint64Arrays = {}  # count -> Struct of count uint64s
+
+
+def routingHeader(count):
+    """
+    Returns the Struct packing a routing header for count channels in one go:
+     [uint8 count][uint64 channel]*count[uint64 sender][uint16 msgType]
+    """
+    header = _routingHeaders.get(count)
+    if header is None:
+        header = _routingHeaders[count] = struct.Struct(f"<B{count}QQH")
+    return header
+
+
+class DatagramTruncatedError(RuntimeError):
+    """
+    A DatagramIterator read past the end of its datagram. The CA answers a
+    client with CLIENT_DISCONNECT_TRUNCATED_DATAGRAM (see code).
+    """
+    code = msgTypes.CLIENT_DISCONNECT_TRUNCATED_DATAGRAM
+
+
 class Datagram:
-    def __init__(self, data=None):
+    def __init__(self, data=None, copy=True):
+        """
+        With copy=False the Datagram borrows data (e.g. a memoryview into a
+        receive buffer) instead of copying it; it can then only be read.
+        """
+        if not copy:
+            self.buffer = data
+            return
+
         self.buffer = bytearray(data) if data else bytearray()  # Initialize with data if provided, or an empty buffer
 
+    @classmethod
+    def routed(cls, channels, sender, code, payload=b""):
+        """
+        Build a routed message: the whole routing header is packed with one
+        Struct call, then the payload is appended.
+        """
+        dg = cls.__new__(cls)
+        dg.buffer = bytearray(routingHeader(len(channels)).pack(len(channels), *channels, sender, code))
+        dg.buffer += payload
+        return dg
+
+    def addBool(self, value):
+        self.buffer += UINT8.pack(1 if value else 0)
+
+    def addInt8(self, value):
+        self.buffer += INT8.pack(value)
+
+    def addInt16(self, value):
+        self.buffer += INT16.pack(value)
+
+    def addInt32(self, value):
+        self.buffer += INT32.pack(value)
+
+    def addInt64(self, value):
+        self.buffer += INT64.pack(value)
 
     def addUint8(self, value):
-        self.buffer.extend(struct.pack("<B", value))
+        self.buffer += UINT8.pack(value)
+
+    def addUint16(self, value):
+        self.buffer += UINT16.pack(value)
+
+    def addUint32(self, value):
+        self.buffer += UINT32.pack(value)
 
     def addUint64(self, value):
-        self.buffer.extend(struct.pack("<Q", value))
+        self.buffer += UINT64.pack(value)
 
-    def addUint16(self, value):
-        self.buffer.extend(struct.pack("<H", value))
+    def addFloat32(self, value):
+        self.buffer += FLOAT32.pack(value)
+
+    def addFloat64(self, value):
+        self.buffer += FLOAT64.pack(value)
+
+    def addString(self, value):
+        """A uint16 length followed by the UTF-8 encoded string."""
+        self.addBlob(value.encode("utf-8"))
+
+    def addBlob(self, value):
+        """A uint16 length followed by the raw bytes."""
+        self.buffer += UINT16.pack(len(value))
+        self.buffer += value
+
+    def addServerHeader(self, channels, sender, code):
+        """Add the routing header of a message to channels with one pack."""
+        self.buffer += routingHeader(len(channels)).pack(len(channels), *channels, sender, code)
 
     def appendData(self, data):
         self.buffer.extend(data)
@@ -28,11 +121,17 @@ class Datagram:
 
     def getMessage(self):
         return self.buffer
+
+    def __bytes__(self):
+        return bytes(self.buffer)
+
+    def __len__(self):
+        return len(self.buffer)
     
     def __str__(self):
         # Return a string representation of the datagram (as string, assuming it's text data)
         try:
-            return self.buffer.decode('utf-8')
+            return str(self.buffer, 'utf-8')
         except UnicodeDecodeError:
             return "Non-UTF-8 data in datagram"
 
@@ -41,36 +140,165 @@ class Datagram:
         return "Datagram Content (Hex): " + " ".join(f"{byte:02x}" for byte in self.buffer)
 
 class DatagramIterator:
+    """
+    Reads a datagram in place through a memoryview: blobs and the remaining
+    payload are returned as views, never copied. Views borrow the datagram's
+    buffer, so a Datagram must not grow while an iterator or view of it is
+    alive. Reading past the end raises DatagramTruncatedError.
+    """
+
     def __init__(self, datagram):
-        self.buffer = datagram.get_bytes()  # The datagram's byte sequence
+        # Raw bytes-like frames (e.g. memoryviews from a FrameBuffer) are read in place
+        data = datagram.buffer if isinstance(datagram, Datagram) else datagram
+        self.buffer = data if isinstance(data, memoryview) else memoryview(data)
         self.offset = 0  # To keep track of the current reading position in the buffer
 
-    def getUint8(self):
-        value = struct.unpack_from("<B", self.buffer, self.offset)[0]
-        self.offset += 1
+    def _read(self, packer):
+        try:
+            value, = packer.unpack_from(self.buffer, self.offset)
+        except struct.error:
+            raise DatagramTruncatedError(
+                f"Read of {packer.size} bytes at offset {self.offset} past the end of a "
+                f"{len(self.buffer)} byte datagram") from None
+
+        self.offset += packer.size
         return value
 
-    def getUint16(self):
-        value = struct.unpack_from("<H", self.buffer, self.offset)[0]
-        self.offset += 2
+    def _readView(self, length):
+        end = self.offset + length
+        if end > len(self.buffer):
+            raise DatagramTruncatedError(
+                f"Read of {length} bytes at offset {self.offset} past the end of a "
+                f"{len(self.buffer)} byte datagram")
+
+        value = self.buffer[self.offset:end]
+        self.offset = end
         return value
 
+    def getBool(self):
+        return self._read(UINT8) != 0
+
+    def getInt8(self):
+        return self._read(INT8)
+
+    def getInt16(self):
+        return self._read(INT16)
+
+    def getInt32(self):
+        return self._read(INT32)
+
+    def getInt64(self):
+        return self._read(INT64)
+
+    def getUint8(self):
+        return self._read(UINT8)
+
+    def getUint16(self):
+        return self._read(UINT16)
+
+    def getUint32(self):
+        return self._read(UINT32)
+
     def getUint64(self):
-        value = struct.unpack_from("<Q", self.buffer, self.offset)[0]
-        self.offset += 8
-        return value
+        return self._read(UINT64)
+
+    def getUint64s(self, count):
+        """Reads count uint64s with one unpack, returned as a tuple."""
+        packer = _uint64Arrays.get(count)
+        if packer is None:
+            packer = _uint64Arrays[count] = struct.Struct(f"<{count}Q")
+
+        return packer.unpack_from(self._readView(packer.size))
+
+    def getFloat32(self):
+        return self._read(FLOAT32)
+
+    def getFloat64(self):
+        return self._read(FLOAT64)
 
     def getString(self):
         length = self.getUint16()  # Assuming strings are prefixed with their length (e.g., a 2-byte length field)
-        value = self.buffer[self.offset:self.offset + length].decode("utf-8")
-        self.offset += length
-        return value
+        return str(self._readView(length), "utf-8")
 
     def getBlob(self):
-        length = self.getUint16()  # Assuming blobs are prefixed with their length (e.g., a 2-byte length field)
-        value = self.buffer[self.offset:self.offset + length]
-        self.offset += length
-        return value
+        """Returns a memoryview of the blob; copy it with bytes() to keep it."""
+        return self._readView(self.getUint16())
 
     def getRemainingBytes(self):
-        return self.buffer[self.offset:]
\ No newline at end of file
+        """Returns a memoryview of everything not read yet."""
+        return self.buffer[self.offset:]
+
+    def getRemainingSize(self):
+        return len(self.buffer) - self.offset
+
+
+class FrameBuffer:
+    """
+    Receive buffer for a stream of <uint16 length><datagram> frames.
+
+    Bytes are received straight into a preallocated bytearray (recv_into) and
+    complete frames are handed out as memoryview slices of it, so a frame is
+    never copied on its way to the router. Consumed bytes are skipped by
+    moving a read offset; the unread tail is only moved back to the front once
+    most of the buffer has been consumed or the free space runs low.
+
+    Frames are only valid until the next call to writable().
+    """
+
+    LENGTH = struct.Struct("<H")
+
+    def __init__(self, size=16384, min_read=4096):
+        self.data = bytearray(size)
+        self.start = 0          # first unread byte
+        self.end = 0            # first free byte
+        self.min_read = min_read
+
+    def __len__(self):
+        return self.end - self.start
+
+    def writable(self):
+        """Returns a memoryview of the free space to receive into."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start and (self.start >= len(self.data) // 2 or
+                             len(self.data) - self.end < self.min_read):
+            self._compact(len(self.data))
+
+        if self.end == len(self.data):
+            # A single frame bigger than the whole buffer: make room for it.
+            needed = self.LENGTH.size + self.LENGTH.unpack_from(self.data, self.start)[0]
+            self._compact(max(needed, len(self.data) * 2))
+
+        return memoryview(self.data)[self.end:]
+
+    def commit(self, nbytes):
+        """Marks nbytes of the writable() space as received."""
+        self.end += nbytes
+
+    def frames(self):
+        """Yields every complete frame (without its length prefix) as a memoryview."""
+        data = self.data
+        unpack = self.LENGTH.unpack_from
+        header = self.LENGTH.size
+        with memoryview(data) as view:
+            while self.end - self.start >= header:
+                length = unpack(data, self.start)[0]
+                begin = self.start + header
+                if self.end - begin < length:
+                    break
+
+                self.start = begin + length
+                yield view[begin:self.start]
+
+    def _compact(self, size):
+        pending = self.end - self.start
+        if size == len(self.data):
+            self.data[:pending] = self.data[self.start:self.end]
+        else:
+            # Never resize in place: frames handed out earlier may still be exported.
+            data = bytearray(size)
+            data[:pending] = self.data[self.start:self.end]
+            self.data = data
+
+        self.start = 0
+        self.end = pending
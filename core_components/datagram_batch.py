@@ -0,0 +1,104 @@
+"""
+Batch decoding of MD routing headers with NumPy.
+
+Takes one large buffer of <uint16 length><datagram> frames (a capture of MD
+traffic, or everything an MDClient received in one go) and decodes the routing
+header of every datagram into one structured array, instead of building a
+Datagram / DatagramIterator per frame:
+
+    headers = decodeHeaders(capture)
+    types, counts = numpy.unique(headers["msg_type"], return_counts=True)
+    busiest = numpy.unique(headers["first_channel"], return_counts=True)
+
+Only the walk from one frame to the next is sequential (each frame start
+depends on the previous length); every header field is then gathered for all
+frames at once.
+
+Requires NumPy, which the rest of the OTP does not need.
+"""
+
+import numpy
+
+from core_components import msgTypes
+
+HEADER_DTYPE = numpy.dtype([
+    ("offset", "<u8"),         # start of the datagram (after its length prefix) in the buffer
+    ("length", "<u2"),         # datagram length
+    ("channel_count", "u1"),
+    ("first_channel", "<u8"),
+    ("sender", "<u8"),         # 0 for control messages, which carry none
+    ("msg_type", "<u2"),       # the control code for control messages
+])
+
+
+def frameOffsets(buffer):
+    """
+    Walk the length prefixes of buffer.
+    Returns (offsets, lengths, end): the start and length of every complete
+    datagram, and the offset where the trailing incomplete frame (if any) starts.
+    """
+    size = len(buffer)
+    offsets = []
+    append = offsets.append
+    position = 0
+    while position + 2 <= size:
+        end = position + 2 + (buffer[position] | buffer[position + 1] << 8)
+        if end > size:
+            break
+
+        append(position + 2)
+        position = end
+
+    offsets = numpy.array(offsets, dtype="<u8")
+    if not len(offsets):
+        return offsets, numpy.zeros(0, dtype="<u2"), position
+
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    return offsets, _gather(data, offsets.astype(numpy.int64) - 2, 2, "<u2"), position
+
+
+def _gather(data, positions, width, dtype):
+    """Read a little-endian integer of width bytes at every position of data."""
+    index = positions[:, None] + numpy.arange(width, dtype=positions.dtype)
+    numpy.minimum(index, len(data) - 1, out=index)  # rows out of range are masked by the caller
+    return numpy.ascontiguousarray(data[index]).view(dtype).ravel()
+
+
+def decodeHeaders(buffer):
+    """
+    Decode the routing header of every complete frame in buffer:
+     [uint8 count][uint64 channel]*count[uint64 sender][uint16 msgType]
+    or, for control messages, [uint8 1][uint64 CONTROL_MESSAGE][uint16 code].
+    Returns a HEADER_DTYPE array with one row per frame. Fields a frame is
+    too short to hold are left at 0.
+    """
+    offsets, lengths, _ = frameOffsets(buffer)
+    headers = numpy.zeros(len(offsets), dtype=HEADER_DTYPE)
+    headers["offset"] = offsets
+    headers["length"] = lengths
+    if not len(offsets):
+        return headers
+
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    positions = offsets.astype(numpy.int64)
+    ends = positions + lengths
+
+    hasCount = lengths >= 1
+    counts = numpy.where(hasCount, data[numpy.minimum(positions, len(data) - 1)], 0)
+    headers["channel_count"] = counts
+
+    hasChannel = hasCount & (counts >= 1) & (positions + 9 <= ends)
+    firstChannel = numpy.where(hasChannel, _gather(data, positions + 1, 8, "<u8"), 0)
+    headers["first_channel"] = firstChannel
+
+    control = hasChannel & (counts == 1) & (firstChannel == msgTypes.CONTROL_MESSAGE)
+    senderAt = positions + 1 + 8 * counts.astype(numpy.int64)
+    typeAt = numpy.where(control, positions + 9, senderAt + 8)
+
+    hasSender = hasCount & ~control & (senderAt + 8 <= ends)
+    headers["sender"] = numpy.where(hasSender, _gather(data, senderAt, 8, "<u8"), 0)
+
+    hasType = hasCount & (typeAt + 2 <= ends)
+    headers["msg_type"] = numpy.where(hasType, _gather(data, typeAt, 2, "<u2"), 0)
+
+    return headers
@@ -0,0 +1,171 @@
+"""
+Plain Python tables of the classes and fields of a DC file, and their on-disk cache.
+
+Parsing the .dc files (DCFile.read) is a noticeable part of every daemon's
+startup. NetworkDCLoader flattens what the OTP needs from the parse into
+DCClassInfo / DCFieldInfo tuples, which pickle, and keeps them in a cache file
+keyed by the mtime and size of every .dc file together with the DC hash. A
+later start with unchanged files loads the tables from the cache and only
+parses the .dc files if something asks for Panda's DCClass objects.
+
+Nothing here imports Panda3D: the tables are built from the DC objects passed in.
+"""
+
+import collections
+import os
+import pickle
+import time
+
+DC_CACHE_VERSION = 2
+
+# What unpickling a corrupt, truncated or foreign file may raise
+CACHE_LOAD_ERRORS = (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError,
+                     IndexError, ValueError)
+
+# DCSubatomicType values of DCSimpleParameter.get_type()
+ST_INT8 = 0
+ST_INT16 = 1
+ST_INT32 = 2
+ST_INT64 = 3
+ST_UINT8 = 4
+ST_UINT16 = 5
+ST_UINT32 = 6
+ST_UINT64 = 7
+ST_FLOAT64 = 8
+ST_STRING = 9
+ST_BLOB = 10
+
+DC_KEYWORDS = ('required', 'broadcast', 'ram', 'db', 'airecv', 'ownrecv',
+               'clrecv', 'clsend', 'ownsend')
+
+DCClassInfo = collections.namedtuple('DCClassInfo', 'number name fields')
+
+# elements: one (subatomic type, divisor, fixed size) per parameter, or None
+# when a parameter is not a plain simple parameter (arrays, structs, moduli...).
+# fixed size is N for string(N) / blob(N), which have no length prefix, else 0.
+DCFieldInfo = collections.namedtuple('DCFieldInfo', 'number name keywords elements')
+
+
+def parameter_element(parameter):
+    simple = parameter.as_simple_parameter()
+    if simple is None or simple.has_modulus():
+        return None
+
+    element_type = simple.get_type()
+    fixed_size = 0
+    if element_type in (ST_STRING, ST_BLOB) and simple.has_fixed_byte_size():
+        fixed_size = simple.get_fixed_byte_size()
+
+    return (element_type, simple.get_divisor(), fixed_size)
+
+
+def field_elements(field):
+    """Returns the (type, divisor, fixed size) of every parameter of a field, or None."""
+    parameters = []
+    molecular = field.as_molecular_field()
+    if molecular is not None:
+        atomics = [molecular.get_atomic(i) for i in range(molecular.get_num_atomics())]
+    else:
+        atomics = [field.as_atomic_field()]
+
+    for atomic in atomics:
+        if atomic is None:
+            parameter = field.as_parameter()
+            if parameter is None:
+                return None
+
+            parameters.append(parameter)
+            continue
+
+        parameters.extend(atomic.get_element(i) for i in range(atomic.get_num_elements()))
+
+    elements = tuple(parameter_element(parameter) for parameter in parameters)
+    if None in elements:
+        return None
+
+    return elements
+
+
+def build_class_table(dc_file):
+    """Returns {class number: DCClassInfo} for every class of a parsed DCFile."""
+    classes = {}
+    for i in range(dc_file.get_num_classes()):
+        dclass = dc_file.get_class(i)
+        fields = []
+        for j in range(dclass.get_num_inherited_fields()):
+            field = dclass.get_inherited_field(j)
+            keywords = tuple(keyword for keyword in DC_KEYWORDS if field.has_keyword(keyword))
+            fields.append(DCFieldInfo(field.get_number(), field.get_name(), keywords,
+                                      field_elements(field)))
+
+        classes[dclass.get_number()] = DCClassInfo(dclass.get_number(), dclass.get_name(),
+                                                   tuple(fields))
+
+    return classes
+
+
+def file_stamps(dc_file_names):
+    """(path, mtime_ns, size) of every .dc file, the cache key besides the DC hash."""
+    stamps = []
+    for name in dc_file_names:
+        path = os.path.abspath(str(name))
+        stat = os.stat(path)
+        stamps.append((path, stat.st_mtime_ns, stat.st_size))
+
+    return stamps
+
+
+def read_dc_cache(cache_file):
+    """The entry dict pickled in cache_file, or None if it is missing, unreadable or not ours."""
+    try:
+        with open(cache_file, 'rb') as f:
+            entry = pickle.load(f)
+    except CACHE_LOAD_ERRORS:
+        return None
+
+    if not isinstance(entry, dict) or entry.get('version') != DC_CACHE_VERSION:
+        return None
+
+    return entry
+
+
+def load_dc_cache(cache_file, dc_file_names):
+    """
+    Returns the cached entry for dc_file_names, a dict with 'hash',
+    'parse_time' and 'classes', or None if there is none or a .dc file
+    changed since it was written.
+    """
+    entry = read_dc_cache(cache_file)
+    if entry is None:
+        return None
+
+    try:
+        if entry.get('files') != file_stamps(dc_file_names):
+            return None
+    except OSError:
+        return None
+
+    return entry
+
+
+def peek_dc_cache_hash(cache_file):
+    """The DC hash recorded in a cache file, whatever its files, or None."""
+    entry = read_dc_cache(cache_file)
+    return entry.get('hash') if entry is not None else None
+
+
+def store_dc_cache(cache_file, dc_file_names, hash_value, parse_time, classes):
+    """Write (atomically) the cache entry of a full parse."""
+    entry = {
+        'version': DC_CACHE_VERSION,
+        'files': file_stamps(dc_file_names),
+        'hash': hash_value,
+        'parse_time': parse_time,
+        'created': time.time(),
+        'classes': classes,
+    }
+
+    temp = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(temp, 'wb') as f:
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, cache_file)
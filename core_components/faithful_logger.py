@@ -1,43 +1,160 @@
+import atexit
 import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
 import coloredlogs
 
+LOG_FORMAT = '%(asctime)s [%(levelname)s] [%(name)s]: %(message)s'  # No hostname here
+
+
+class faithfulQueueHandler(QueueHandler):
+    """
+    Hands records over to the LoggerNotify listener thread.
+    Only the message itself is resolved on the calling thread (its arguments
+    may be views into buffers that are reused right after); timestamps,
+    colouring and the write to the terminal all happen on the listener.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class faithfulRateLimit(logging.Filter):
+    """
+    Token bucket for the chatty per-datagram lines of a category: lets
+    through at most rate records per second (bursts up to burst), counts the
+    rest and reports how many were suppressed on the next record let through.
+    Records above maxLevel (warnings and errors by default) are never limited.
+    """
+
+    def __init__(self, rate, burst=None, maxLevel=logging.INFO):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.maxLevel = maxLevel
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno > self.maxLevel:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+
+        self.tokens -= 1
+        if self.suppressed:
+            if not record.args:
+                record.msg = str(record.msg).replace('%', '%%')
+                record.args = ()
+            if isinstance(record.args, tuple):
+                record.msg = str(record.msg) + ' (%d similar messages suppressed)'
+                record.args += (self.suppressed,)
+                self.suppressed = 0
+
+        return True
+
+
 class faithfulLogger(object):
-    def __init__(self, category):
+    def __init__(self, category, handler, level=logging.DEBUG):
         self.logger = logging.getLogger(category)
-        self.logger.setLevel(logging.DEBUG)
-        self.handler = logging.StreamHandler()
-        self.handler.setLevel(logging.DEBUG)
-        #self.formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.formatter = logging.Formatter('%(asctime)s [%(levelname)s] [%(name)s]: %(message)s')  # No hostname here
-        self.handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.handler)
-        #coloredlogs.install(level='DEBUG', logger=self.logger)
-        coloredlogs.install(level='DEBUG', logger=self.logger, fmt='%(asctime)s [%(levelname)s] [%(name)s]: %(message)s')
+        self.logger.setLevel(level)
+        self.logger.addHandler(handler)
         self.logger.propagate = False
+        self.rateLimit = None
+
+    # Messages may carry %-style arguments, only formatted if the record is
+    # actually emitted: logger.faithfulDebug('Code: %s, Datagram: %s', code, dg)
 
+    def faithfulInfo(self, message, *args):
+        self.logger.info(message, *args)
 
-    def faithfulInfo(self, message):
-        self.logger.info(message)
+    def faithfulWarning(self, message, *args):
+        self.logger.warning(message, *args)
 
-    def faithfulWarning(self, message):
-        self.logger.warning(message)
+    def faithfulError(self, message, *args):
+        self.logger.error(message, *args)
 
-    def faithfulError(self, message):
-        self.logger.error(message)
+    def faithfulDebug(self, message, *args):
+        self.logger.debug(message, *args)
+
+    # Panda3D notify style names, used by the network and CA code
+    info = faithfulInfo
+    warning = faithfulWarning
+    error = faithfulError
+    debug = faithfulDebug
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def faithfulDebugEnabled(self):
+        """
+        Guard for debug lines whose arguments are expensive to compute
+        (hex dumps and the like), so they cost nothing when DEBUG is off.
+        """
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def setLevel(self, level):
+        self.logger.setLevel(level)
+
+    def setRateLimit(self, rate, burst=None, maxLevel=logging.INFO):
+        """
+        Let at most rate records per second at or below maxLevel through
+        this category. A rate of None removes the limit.
+        """
+        if self.rateLimit:
+            self.logger.removeFilter(self.rateLimit)
+            self.rateLimit = None
+
+        if rate is not None:
+            self.rateLimit = faithfulRateLimit(rate, burst, maxLevel)
+            self.logger.addFilter(self.rateLimit)
 
-    def faithfulDebug(self, message):
-        self.logger.debug(message)
 
 class LoggerNotify(object):
+    """
+    Hands out one faithfulLogger per category. Every category feeds the
+    same queue, drained by a single listener thread that formats and writes
+    the records, so logging never blocks the event loop on terminal I/O.
+    The level of new categories comes from FAITHFUL_LOG_LEVEL (DEBUG by default).
+    """
+
     def __init__(self):
         self.categories = {}
+        self.level = os.environ.get('FAITHFUL_LOG_LEVEL', 'DEBUG').upper()
+
+        stream = logging.StreamHandler()
+        stream.setFormatter(coloredlogs.ColoredFormatter(fmt=LOG_FORMAT))
+
+        self.queue = queue.SimpleQueue()
+        self.handler = faithfulQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, stream, respect_handler_level=True)
+        self.listener.start()
+        self.running = True
+        atexit.register(self.stop)
 
     def new_category(self, category):
         if category not in self.categories:
-            notifier = faithfulLogger(category)
+            notifier = faithfulLogger(category, self.handler, self.level)
             self.categories[category] = notifier
         return self.categories[category]
 
+    def stop(self):
+        """Flush every queued record and stop the listener thread."""
+        if self.running:
+            self.running = False
+            self.listener.stop()
+
 
 notify = LoggerNotify()
 
@@ -45,7 +162,3 @@ DC_logger = notify.new_category("NetworkDCLoader")
 DC_logger.faithfulInfo("This is an info message for testing.")
 
 MDClient = notify.new_category("MDClient")
-
-
-
-    
\ No newline at end of file
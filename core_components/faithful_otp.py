@@ -1,10 +1,29 @@
 import asyncio
+import os
 import struct
 import time
 from core_components.message_director import MessageDirector
 from core_components.faithful_logger import notify
 from core_components.client_agent import ClientAgent
 from core_components.network_server_async import AsyncServer
+from core_components.zone_interest import loadVisibilityGraph
+
+logger = notify.new_category("MDClient")
+logger.setRateLimit(100)  # per-datagram lines
+
+# JSON file of the zones visible from each zone (see zone_interest), loaded
+# once at startup; unset to trust the visible zones clients send.
+VISIBILITY_GRAPH = os.environ.get('FAITHFUL_VISIBILITY_GRAPH', '')
+
+
+def loadVisibility():
+    """The VisibilityGraph named by FAITHFUL_VISIBILITY_GRAPH, or None."""
+    if not VISIBILITY_GRAPH:
+        return None
+
+    graph = loadVisibilityGraph(VISIBILITY_GRAPH)
+    ClientAgent.logger.info("Loaded the visibility of %d zones from %s", len(graph), VISIBILITY_GRAPH)
+    return graph
 
 class faithfulOTP:
     def __init__(self, host='127.0.0.1', port=7100):
@@ -17,15 +36,16 @@ class faithfulOTP:
 
         # Handlers
         self.messageDirector = MessageDirector(self)
-        self.clientAgent = ClientAgent(self)
+        self.clientAgent = ClientAgent(self, visibility=loadVisibility())
 
         # Initialize AsyncServer with MD and CA handlers
         self.async_server = AsyncServer(self.md, self.clientAgent, notify)
 
     async def handle_message(self, channels, sender, code, datagram):
-        logger = notify.new_category("MDClient")
         #logger.faithfulDebug(f"Channels: {channels}, Code: {code}, Datagram: {datagram}")
-        logger.faithfulDebug(f"Channels: {channels}, Code: {code}, Datagram (Hex): {datagram.to_hex()}, Datagram (Str): {str(datagram)}")
+        if logger.faithfulDebugEnabled():
+            logger.faithfulDebug("Channels: %s, Code: %s, Datagram (Hex): %s, Datagram (Str): %s",
+                                 channels, code, datagram.to_hex(), datagram)
 
         # Transmit received message from MD to other components
         self.clientAgent.handle(channels, sender, code, datagram)
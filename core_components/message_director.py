@@ -71,22 +71,61 @@ The message director is the simplest component.
 """
 
 import socket
-import select
 import struct
 import asyncio
 
 #from panda3d.core import Datagram, DatagramIterator
 from . import msgTypes
-from core_components import network_manager
 from core_components.faithful_logger import notify
 
-from core_components.datagram import Datagram, DatagramIterator
+from core_components.datagram import Datagram, DatagramIterator, DatagramTruncatedError, FrameBuffer
+from core_components.channel_map import ChannelMap
 
+FRAME_LENGTH = struct.Struct("<H")
 
+# What to do with a participant whose outbound queue stays above its high water mark
+SLOW_CONSUMER_BLOCK = "block"            # senders wait until it drains to the low water mark
+SLOW_CONSUMER_DROP = "drop"              # low priority datagrams to it are dropped
+SLOW_CONSUMER_DISCONNECT = "disconnect"  # it is kicked and its postRemove datagrams replayed
 
+# Datagrams that may be dropped under SLOW_CONSUMER_DROP
+LOW_PRIORITY_CODES = frozenset((
+    msgTypes.STATESERVER_OBJECT_UPDATE_FIELD,
+    msgTypes.STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE,
+    msgTypes.CLIENT_OBJECT_UPDATE_FIELD,
+))
 
 
 
+
+
+
+def makeFrame(dg):
+    """
+    Frame a Datagram (or raw bytes-like datagram) for the wire:
+    returns the (uint16 length prefix, datagram) pair, ready for sendmsg().
+    The datagram itself is not copied.
+    """
+    if isinstance(dg, Datagram):
+        dg = dg.getMessage()
+    return (FRAME_LENGTH.pack(len(dg)), dg)
+
+
+def makeControlDatagram(code, *channels):
+    """
+    Build a CONTROL_MESSAGE carrying channels, as sent by a participant:
+     [uint8 1][uint64 CONTROL_MESSAGE][uint16 code][uint64 channel...]
+    """
+    dg = Datagram()
+    dg.addUint8(1)
+    dg.addUint64(msgTypes.CONTROL_MESSAGE)
+    dg.addUint16(code)
+    for channel in channels:
+        dg.addUint64(channel)
+
+    return dg
+
+
 class MDClient:
     """Represents one daemon connection to the Message Director."""
 
@@ -94,57 +133,164 @@ class MDClient:
         self.md = md                # back‑reference to MessageDirector
         self.sock = sock            # TCP socket
         self.addr = addr            # (ip, port)
-        self.buffer = bytearray()   # raw recv buffer
+        self.buffer = FrameBuffer()  # raw recv buffer
         self.connectionName = ""    # optional human name
         self.connectionURL = ""     # optional URL
         self.channels = set()       # subscribed channels
         self.postRemove = []        # datagrams to replay on disconnect
         self.otp = md.otp
+        self.fd = sock.fileno()     # key in md.clients, stable after close
+        self.task = None            # reader task driving handle()
+        self.outbound = bytearray() # bytes the kernel has not accepted yet
+        self.congested = False      # above high water, not yet back under low water
+        self.drained = asyncio.Event()  # set while not congested
+        self.drained.set()
+        self.drops = 0              # datagrams dropped by SLOW_CONSUMER_DROP
+        self.closing = False
 
     def fileno(self):
-        """Expose underlying socket for select()."""
+        """Expose underlying socket for the selector."""
         return self.sock.fileno()
 
-    def onLost(self):
+    async def handle(self):
+        """Read from the socket until the daemon goes away."""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                nbytes = await loop.sock_recv_into(self.sock, self.buffer.writable())
+                if not nbytes:
+                    raise ConnectionResetError
+                await self.onData(nbytes)
+        except ConnectionError:
+            pass
+        except DatagramTruncatedError as e:
+            print(f"[MD] Truncated datagram from {self.getName()}, disconnecting: {e}")
+        finally:
+            await self.onClosed()
+
+    async def onClosed(self):
+        """Called once the reader stops, lets the MD forget this connection."""
+        await self.md.remove_client(self)
+
+    async def onLost(self):
         """Called if connection is lost — replay any postRemove datagrams."""
         for raw in self.postRemove:
-            self.onDatagram(Datagram(bytes(raw)))
+            await self.handle_datagram(raw)
 
-    async def onData(self, data):
+    async def onData(self, nbytes):
         """
-        Buffer incoming bytes, process complete packets.
+        Account for nbytes received into our buffer, process complete packets.
         Packet format: <uint16 length><raw datagram bytes>
+        Each packet is handed over as a memoryview into the receive buffer.
         """
-        self.buffer.extend(data)
-        while len(self.buffer) >= 2:
-            length = struct.unpack("<H", self.buffer[:2])[0]
-            if len(self.buffer) < length + 2:
-                break
-            packet = bytes(self.buffer[2:2 + length])
-            del self.buffer[:2 + length]
-            await self.handle_datagram(Datagram(packet))
-
-async def route_datagram(self, dg, channels, sender, di):
-    code = di.getUint16()
-
-    for client in self.clients:
-        if client == sender:
-            continue
-        if client.channels.intersection(channels):
-            client.sendDatagram(dg)
+        self.buffer.commit(nbytes)
+        for frame in self.buffer.frames():
+            await self.handle_datagram(frame)
 
-    await self.otp.handle_message(channels, sender, code, Datagram(di.getRemainingBytes()))
+    async def handle_datagram(self, dg):
+        """Hand a complete datagram to the Message Director for routing."""
+        await self.md.handle_datagram(dg, self)
 
     def sendDatagram(self, dg):
         """
-        Send a Panda3D Datagram over the socket:
+        Send a Datagram (or raw bytes-like datagram) over the socket:
         Prepend a little-endian uint16 length.
         """
-        self.sock.send(struct.pack("<H", dg.getLength()))
-        self.sock.send(bytes(dg))
+        self.sendFrame(makeFrame(dg))
+
+    def sendFrame(self, frame, lowPriority=False):
+        """
+        Send a (length prefix, datagram) frame built once per route with a
+        single sendmsg(). Whatever the kernel does not accept right away is
+        kept in self.outbound and flushed once the socket is writable again,
+        so a frame is never truncated and frames never overtake each other.
+
+        Returns True while the outbound queue is congested, so the router
+        can apply the MD's slow consumer policy.
+        """
+        if self.closing:
+            return False
+
+        if self.congested and lowPriority and self.md.slowPolicy == SLOW_CONSUMER_DROP:
+            self.drops += 1
+            return True
+
+        if self.outbound:
+            for part in frame:
+                self.outbound += part
+            return self.checkCongestion()
+
+        try:
+            sent = self.sock.sendmsg(frame)
+        except BlockingIOError:
+            sent = 0
+        except ConnectionError:
+            return  # the reader task notices the disconnect and cleans up
+
+        for part in frame:
+            if sent >= len(part):
+                sent -= len(part)
+                continue
+
+            self.outbound += part[sent:]
+            sent = 0
+
+        if self.outbound:
+            asyncio.get_running_loop().add_writer(self.fd, self.onWritable)
+
+        return self.checkCongestion()
+
+    def checkCongestion(self):
+        """Enter the congested state once the queue reaches the high water mark."""
+        if not self.congested and len(self.outbound) >= self.md.highWater:
+            self.congested = True
+            self.drained.clear()
+            if self.md.slowPolicy == SLOW_CONSUMER_DISCONNECT:
+                self.disconnect()
+                return False
+
+        return self.congested
+
+    def disconnect(self):
+        """Kick this participant; its reader task replays postRemove on the way out."""
+        print(f"[MD] Disconnecting slow consumer: {self.getName()}")
+        self.closing = True
+        self.drained.set()
+        if self.task:
+            self.task.cancel()
+
+    def getName(self):
+        """Name used to report this connection (CONTROL_SET_CON_NAME)."""
+        return self.connectionName or f"{self.addr[0]}:{self.addr[1]}"
+
+    def queueDepth(self):
+        """Bytes queued for this participant that the kernel has not accepted yet."""
+        return len(self.outbound)
+
+    def onWritable(self):
+        """Flush what is left in self.outbound now that the socket drained."""
+        try:
+            sent = self.sock.send(self.outbound)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            sent = len(self.outbound)
+
+        del self.outbound[:sent]
+        if not self.outbound:
+            asyncio.get_running_loop().remove_writer(self.fd)
+
+        if self.congested and len(self.outbound) <= self.md.lowWater:
+            self.congested = False
+            self.drained.set()
 
     def close(self):
         """Clean up the connection."""
+        self.closing = True
+        self.drained.set()
+        if self.outbound:
+            self.outbound.clear()
+            asyncio.get_running_loop().remove_writer(self.fd)
         try:
             self.sock.close()
         except:
@@ -154,56 +300,92 @@ async def route_datagram(self, dg, channels, sender, di):
 class MessageDirector:
     """Main MD server: accepts MDClients, multiplexes I/O, routes Datagrams."""
 
-    def __init__(self, otp):
+    logger = notify.new_category("MDServer")
+
+    def __init__(self, otp, highWater=4 * 1024 * 1024, lowWater=1024 * 1024,
+                 slowPolicy=SLOW_CONSUMER_BLOCK, lowPriorityCodes=LOW_PRIORITY_CODES):
         """
         otp: your OTP core instance with .handleMessage(channels, sender, code, dg)
         host/port: where to listen for MDClients
+        highWater/lowWater: outbound queue limits (bytes) of every MDClient and AsyncMDClient
+        slowPolicy: SLOW_CONSUMER_BLOCK, SLOW_CONSUMER_DROP or SLOW_CONSUMER_DISCONNECT
+        lowPriorityCodes: msgTypes that SLOW_CONSUMER_DROP may drop
         """
+        if slowPolicy not in (SLOW_CONSUMER_BLOCK, SLOW_CONSUMER_DROP, SLOW_CONSUMER_DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy: {slowPolicy}")
+
         self.otp = otp  # Store the otp instance passed to MessageDirector
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.slowPolicy = slowPolicy
+        self.lowPriorityCodes = lowPriorityCodes
         #self.sock = socket.socket()
         #self.sock.bind(("127.0.0.1", 7100))  # Use localhost instead of 0.0.0.0
         #self.sock.listen(5)
         self.ready = False
-        self.clients = []  # list of MDClient
+        self.clients = {}  # fd -> MDClient / AsyncMDClient
+        self.channelMap = ChannelMap()  # channel -> subscribed MDClients
+        self.interestListeners = []  # notified of every subscription change
+        self.bus = None  # WorkerBus when running as one of several MD workers
+        self.federation = None  # Federation once linked to other MD nodes
+
+    async def start(self, host, port, reusePort=False):
+        """
+        Bind, listen and serve every MDClient from the asyncio event loop.
+
+        Sockets are non-blocking and readiness comes from the loop's selector
+        (epoll on Linux), so handling one readable connection never touches
+        the others and there is no FD_SETSIZE cap on the number of daemons.
+        reusePort lets several MD worker processes share the listen port.
+        """
+        loop = asyncio.get_running_loop()
 
-    async def start(self, host, port):
-        """Bind, listen, and enter main select loop."""
         self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.bind((host, port))
-        self.sock.listen(5)
+        self.sock.listen(socket.SOMAXCONN)
+        self.sock.setblocking(False)
         print(f"[MD] Listening on {host}:{port}")
 
         try:
             while True:
-                # Prepare select list: server socket and all client sockets
-                rlist = [self.sock] + [c.sock for c in self.clients]
-                readable, _, _ = select.select(rlist, [], [])
-                for s in readable:
-                    if s is self.sock:
-                        client_sock, addr = self.sock.accept()
-                        client = MDClient(self.otp, client_sock, addr)  # Pass self.otp
-                        self.clients.append(client)
-                        print(f"[MD] New connection from {addr}")
-                    else:
-                        # Find corresponding MDClient
-                        client = next((c for c in self.clients if c.sock is s), None)
-                        if not client:
-                            continue
-                        try:
-                            data = s.recv(4096)
-                            if not data:
-                                raise ConnectionResetError
-                            await client.onData(data)
-                        except ConnectionResetError:
-                            print(f"[MD] Connection lost: {client.addr}")
-                            client.onLost()
-                            client.close()
-                            self.clients.remove(client)
+                client_sock, addr = await loop.sock_accept(self.sock)
+                client_sock.setblocking(False)
+                client = MDClient(self, client_sock, addr)
+                self.clients[client.fileno()] = client
+                client.task = loop.create_task(client.handle())
+                print(f"[MD] New connection from {addr}")
         except KeyboardInterrupt:
             print("[MD] Shutting down.")
         finally:
             self.stop()
 
+    async def remove_client(self, client):
+        """Forget a disconnected MDClient, drop its subscriptions and replay its postRemove."""
+        print(f"[MD] Connection lost: {client.addr}")
+        self.clients.pop(client.fd, None)
+        if self.federation:
+            self.federation.removeLink(client)
+        self.unsubscribeAll(client)
+        client.close()
+        await client.onLost()
+
+    def getQueueStats(self):
+        """
+        Returns the outbound queue depth (bytes) and drop count of every
+        connection, keyed by connection name (CONTROL_SET_CON_NAME).
+        """
+        stats = {}
+        for client in self.clients.values():
+            entry = stats.setdefault(client.getName(), {"depth": 0, "drops": 0, "congested": 0})
+            entry["depth"] += client.queueDepth()
+            entry["drops"] += client.drops
+            entry["congested"] += client.congested
+
+        return stats
+
     async def sendMessage(self, channels, sender, code, datagram):
         """
         Send a message *from* OTP core into the MD:
@@ -212,26 +394,183 @@ class MessageDirector:
          code: uint16
          datagram: Panda3D Datagram (with body payload)
         """
-        dg = Datagram()
-        dg.addUint8(len(channels))
-        for ch in channels:
-            dg.addUint64(ch)
-        dg.addUint64(sender)
-        dg.addUint16(code)
-        dg.appendData(datagram.getMessage())
+        dg = Datagram.routed(channels, sender, code, datagram.getMessage())
 
-        # Deliver to all subscribed clients
-        for client in list(self.clients):
-            if client.channels.intersection(channels):
-                client.sendDatagram(dg)
+        # Deliver to all subscribed clients, framing the message only once
+        await self.fanOut(makeFrame(dg), channels, code)
 
         # Also give to OTP core if needed
         self.otp.handleMessage(channels, sender, code, datagram)
 
+    async def handle_datagram(self, dg, client):
+        """
+        Handle a complete datagram received from one of our participants.
+        Control messages update the routing table, everything else is routed.
+        dg may be a Datagram or a bytes-like frame (e.g. a memoryview into the
+        client's receive buffer, only valid for the duration of this call).
+        """
+        if isinstance(dg, Datagram):
+            dg = dg.getMessage()
+        di = DatagramIterator(dg)
+
+        count = di.getUint8()
+        channels = [di.getUint64() for _ in range(count)]
+
+        if count == 1 and channels[0] == msgTypes.CONTROL_MESSAGE:
+            self.handle_control_message(client, di.getUint16(), di)
+            return
+
+        sender = di.getUint64()
+        await self.route_datagram(dg, channels, sender, di, client)
+
+    def handle_control_message(self, client, code, di):
+        """
+        Apply a CONTROL_MESSAGE sent by a participant:
+         [uint16 code][control specific data...]
+        """
+        if code == msgTypes.CONTROL_SET_CHANNEL:
+            self.subscribe(client, di.getUint64())
+
+        elif code == msgTypes.CONTROL_REMOVE_CHANNEL:
+            self.unsubscribe(client, di.getUint64())
+
+        elif code == msgTypes.CONTROL_UPDATE_CHANNELS:
+            self.updateChannels(client, di)
+
+        elif code == msgTypes.CONTROL_ADD_RANGE:
+            low = di.getUint64()
+            self.addRange(client, low, di.getUint64())
+
+        elif code == msgTypes.CONTROL_REMOVE_RANGE:
+            low = di.getUint64()
+            self.removeRange(client, low, di.getUint64())
+
+        elif code == msgTypes.CONTROL_ADD_POST_REMOVE:
+            client.postRemove.append(bytes(di.getBlob()))
+
+        elif code == msgTypes.CONTROL_CLEAR_POST_REMOVE:
+            client.postRemove.clear()
+
+        elif code == msgTypes.CONTROL_SET_CON_NAME:
+            client.connectionName = di.getString()
+
+        elif code == msgTypes.CONTROL_SET_CON_URL:
+            client.connectionURL = di.getString()
+
+        elif code == msgTypes.CONTROL_SET_DOWNSTREAM:
+            print(f"[MD] Downstream MD linked: {client.getName()}")
+            self.linkFederation().addLink(client)
+
+        else:
+            # A newer participant or a malformed datagram: not worth its connection
+            self.logger.warning("Ignoring unknown CONTROL_MESSAGE code %d from %s", code, client.getName())
+
+    def linkFederation(self):
+        """Returns this MD's Federation, creating it when the first MD link shows up."""
+        if self.federation is None:
+            from core_components.message_director_federation import Federation
+            Federation(self)
+
+        return self.federation
+
+    # Subscription changes go through these so interestListeners (e.g. the
+    # worker bus) see every change along with the resulting subscriber sets.
+
+    def subscribe(self, client, channel):
+        subscribers = self.channelMap.subscribe(client, channel)
+        for listener in self.interestListeners:
+            listener.channelAdded(client, channel, subscribers)
+
+    def unsubscribe(self, client, channel):
+        subscribers = self.channelMap.unsubscribe(client, channel)
+        for listener in self.interestListeners:
+            listener.channelRemoved(client, channel, subscribers)
+
+    def updateChannels(self, client, di):
+        """
+        Apply a CONTROL_UPDATE_CHANNELS batch:
+         [uint16 n][uint64 channel]*n to subscribe, then the same for channels to unsubscribe
+        Both lists are read before the table is touched, so a truncated batch
+        changes nothing, and no datagram is routed while one is half applied.
+        Removals are applied first.
+        """
+        added = di.getUint64s(di.getUint16())
+        removed = di.getUint64s(di.getUint16())
+
+        for channel in removed:
+            self.unsubscribe(client, channel)
+
+        for channel in added:
+            self.subscribe(client, channel)
+
+    def addRange(self, client, low, high):
+        changed = self.channelMap.add_range(client, low, high)
+        for listener in self.interestListeners:
+            listener.rangeAdded(client, changed)
+
+    def removeRange(self, client, low, high):
+        changed = self.channelMap.remove_range(client, low, high)
+        for listener in self.interestListeners:
+            listener.rangeRemoved(client, changed)
+
+    def unsubscribeAll(self, client):
+        """Drop every channel and range subscription of a participant."""
+        if not self.interestListeners:
+            self.channelMap.unsubscribe_all(client)
+            return
+
+        for channel in list(client.channels):
+            self.unsubscribe(client, channel)
+
+        for low, high in self.channelMap.get_ranges(client):
+            self.removeRange(client, low, high)
+
+    async def route_datagram(self, dg, channels, sender, di, client=None, localOnly=False):
+        """
+        Deliver a datagram to every participant subscribed to one of its
+        destination channels, except the participant it came from.
+        localOnly is set for datagrams forwarded by another MD worker: they
+        are only delivered to our own participants.
+        The OTP core gets the payload as a Datagram borrowing the received
+        bytes, only valid until it returns; it must copy what it keeps.
+        """
+        code = di.getUint16()
+
+        await self.fanOut(makeFrame(dg), channels, code, client, localOnly)
+
+        if not localOnly:
+            await self.otp.handle_message(channels, sender, code, Datagram(di.getRemainingBytes(), copy=False))
+
+    async def fanOut(self, frame, channels, code, client=None, localOnly=False):
+        """
+        Send a frame to every subscriber of the channels but client, then
+        apply the slow consumer policy to the subscribers that are congested.
+        """
+        subscribers = self.channelMap.lookup(channels)
+        if self.bus and not localOnly:
+            subscribers |= self.bus.peerMap.lookup(channels)
+
+        lowPriority = code in self.lowPriorityCodes
+        congested = []
+        for subscriber in subscribers:
+            if subscriber is client:
+                continue
+
+            if subscriber.sendFrame(frame, lowPriority):
+                congested.append(subscriber)
+
+        if self.slowPolicy == SLOW_CONSUMER_BLOCK:
+            # Stop reading from the sender until its slow subscribers caught up
+            for subscriber in congested:
+                await subscriber.drained.wait()
+
     def stop(self):
         """Close all connections and the listening socket."""
-        for client in list(self.clients):
+        for client in list(self.clients.values()):
+            if client.task:
+                client.task.cancel()
             client.close()
+        self.clients.clear()
         if self.sock:
             self.sock.close()
         print("[MD] Shutdown complete.")
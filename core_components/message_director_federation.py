@@ -0,0 +1,162 @@
+"""
+MD-to-MD federation: upstream / downstream links between Message Directors.
+
+A cluster spanning several machines runs one MD per node; each node's CA, AI
+and other daemons talk to their local MD, and the node MDs link into a tree
+(typically every node MD connects to one upstream MD). A link is an ordinary
+MD connection: a downstream MD connects to its upstream like any daemon,
+announces itself with CONTROL_SET_DOWNSTREAM, and from then on both ends
+advertise interest to each other with the regular control messages.
+
+Over a link L an MD advertises a channel (or range) when somebody other than L
+subscribes to it: a local participant or another link. Registrations are
+aggregated, so the link only hears about a channel when the first such
+subscriber appears and when the last one leaves. Since the far end is a
+subscriber like any other, the routing table only forwards a datagram over a
+link when the other side has a subscriber for it: only cross-node traffic
+goes over the wire, and in a tree a datagram never comes back the way it came.
+"""
+
+import asyncio
+import socket
+
+from core_components import msgTypes
+from core_components.channel_map import merge_ranges
+from core_components.message_director import MDClient, makeControlDatagram, makeFrame
+
+
+class UpstreamLink(MDClient):
+    """Our connection to the upstream Message Director."""
+
+    def __init__(self, federation, sock, addr):
+        MDClient.__init__(self, federation.md, sock, addr)
+        self.connectionName = f"upstream-md-{addr[0]}:{addr[1]}"
+
+    def disconnect(self):
+        """The upstream link is never kicked as a slow consumer."""
+
+
+class Federation:
+    """Keeps the interest advertised over every MD link of one Message Director."""
+
+    def __init__(self, md):
+        self.md = md
+        self.links = set()  # UpstreamLink and downstream MDClients
+        self.upstream = None
+
+        md.federation = self
+        md.interestListeners.append(self)
+
+    def addLink(self, link):
+        """Start advertising to a new link everything the rest of us subscribe to."""
+        self.links.add(link)
+
+        for channel, subscribers in self.md.channelMap.channel_items():
+            if len(subscribers) > 1 or link not in subscribers:
+                link.sendDatagram(makeControlDatagram(msgTypes.CONTROL_SET_CHANNEL, channel))
+
+        covered = [(low, high) for low, high, subscribers in self.md.channelMap.range_items()
+                   if len(subscribers) > 1 or link not in subscribers]
+        for low, high in merge_ranges(covered):
+            link.sendDatagram(makeControlDatagram(msgTypes.CONTROL_ADD_RANGE, low, high))
+
+    def removeLink(self, link):
+        self.links.discard(link)
+
+    def affectedLinks(self, client, subscribers, joined):
+        """
+        Returns the links whose advertisement of a channel flips because client
+        joined or left it. subscribers is the channel's subscriber set after
+        the change. A link L is advertised the channel when it has a subscriber
+        other than L, so only the first other subscriber arriving (or the last
+        one leaving) matters.
+        """
+        others = len(subscribers) - 1 if joined else len(subscribers)
+        if others == 0:
+            return [link for link in self.links if link is not client]
+
+        if others == 1:
+            for other in subscribers:
+                if other is not client and other in self.links:
+                    return [other]
+
+        return []
+
+    # Subscription changes, called by the MessageDirector
+
+    def channelAdded(self, client, channel, subscribers):
+        links = self.affectedLinks(client, subscribers, True)
+        if links:
+            self.advertise(links, msgTypes.CONTROL_SET_CHANNEL, channel)
+
+    def channelRemoved(self, client, channel, subscribers):
+        links = self.affectedLinks(client, subscribers, False)
+        if links:
+            self.advertise(links, msgTypes.CONTROL_REMOVE_CHANNEL, channel)
+
+    def rangeAdded(self, client, changed):
+        self.advertiseRanges(client, changed, True, msgTypes.CONTROL_ADD_RANGE)
+
+    def rangeRemoved(self, client, changed):
+        self.advertiseRanges(client, changed, False, msgTypes.CONTROL_REMOVE_RANGE)
+
+    def advertiseRanges(self, client, changed, joined, code):
+        ranges = {}  # link -> segments to advertise
+        for low, high, subscribers in changed:
+            for link in self.affectedLinks(client, subscribers, joined):
+                ranges.setdefault(link, []).append((low, high))
+
+        for link, segments in ranges.items():
+            for low, high in merge_ranges(segments):
+                link.sendDatagram(makeControlDatagram(code, low, high))
+
+    def advertise(self, links, code, channel):
+        frame = makeFrame(makeControlDatagram(code, channel))
+        for link in links:
+            link.sendFrame(frame)
+
+    async def connectUpstream(self, host, port, retryDelay=5.0):
+        """
+        Link this MD to an upstream MD and keep the link up, reconnecting
+        after retryDelay seconds whenever it drops. Runs until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            sock = socket.socket()
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, (host, port))
+            except OSError as e:
+                print(f"[MD] Could not reach upstream MD {host}:{port}: {e}")
+                sock.close()
+                await asyncio.sleep(retryDelay)
+                continue
+
+            print(f"[MD] Linked to upstream MD {host}:{port}")
+            link = UpstreamLink(self, sock, (host, port))
+            self.upstream = link
+            link.sendDatagram(makeControlDatagram(msgTypes.CONTROL_SET_DOWNSTREAM))
+            self.addLink(link)
+
+            await link.handle()  # until the link drops
+
+            self.upstream = None
+            await asyncio.sleep(retryDelay)
+
+
+async def runNode(md, host, port, upstream=None, retryDelay=5.0):
+    """
+    Serve MD participants on host:port. When upstream is a (host, port) pair,
+    also keep this MD linked to that upstream MD.
+    """
+    linkTask = None
+    if upstream:
+        federation = md.linkFederation()
+        linkTask = asyncio.get_running_loop().create_task(
+            federation.connectUpstream(*upstream, retryDelay=retryDelay))
+
+    try:
+        await md.start(host, port)
+    finally:
+        if linkTask:
+            linkTask.cancel()
@@ -0,0 +1,208 @@
+"""
+Multi-process Message Director.
+
+A single MessageDirector routes everything on one asyncio loop, so it is
+capped at one core. In worker mode N MessageDirector processes share the
+listen port (SO_REUSEPORT): the kernel spreads daemon connections over them,
+and each worker owns the subscription table of the connections it accepted.
+
+Workers are linked by a full mesh of Unix socket pairs (the worker bus). Over
+each link a worker advertises its local interest with ordinary control
+messages (CONTROL_SET_CHANNEL / CONTROL_REMOVE_CHANNEL / CONTROL_ADD_RANGE /
+CONTROL_REMOVE_RANGE), only when a channel gains its first or loses its last
+local subscriber. Each worker keeps what its peers advertised in a peer
+ChannelMap, so a datagram is forwarded, unchanged and at most once, only to the
+workers that have a subscriber for one of its destination channels. Forwarded
+datagrams are delivered to local participants only, never forwarded again.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import socket
+
+from core_components import msgTypes
+from core_components.channel_map import ChannelMap, merge_ranges
+from core_components.datagram import DatagramIterator
+from core_components.message_director import MDClient, MessageDirector, makeControlDatagram, makeFrame
+
+
+class WorkerPeer(MDClient):
+    """The bus link to another MD worker process."""
+
+    def __init__(self, bus, sock, index):
+        MDClient.__init__(self, bus.md, sock, ("worker", index))
+        self.bus = bus
+        self.index = index
+        self.connectionName = f"md-worker-{index}"
+
+    async def handle_datagram(self, dg):
+        """Apply a peer's interest change, or deliver a datagram it forwarded."""
+        di = DatagramIterator(dg)
+
+        count = di.getUint8()
+        channels = [di.getUint64() for _ in range(count)]
+
+        if count == 1 and channels[0] == msgTypes.CONTROL_MESSAGE:
+            self.bus.handle_peer_control(self, di.getUint16(), di)
+            return
+
+        sender = di.getUint64()
+        await self.md.route_datagram(dg, channels, sender, di, self, localOnly=True)
+
+    async def onClosed(self):
+        """A worker went away: forget everything it advertised."""
+        print(f"[MD] Lost {self.connectionName}")
+        self.bus.peerMap.unsubscribe_all(self)
+        self.bus.peers.remove(self)
+        self.close()
+
+    def disconnect(self):
+        """Bus links are never kicked as slow consumers."""
+
+
+class WorkerBus:
+    """Links one MD worker with every other worker of the same cluster."""
+
+    def __init__(self, md, index, peerSockets):
+        """
+        md: the MessageDirector of this worker
+        index: this worker's number
+        peerSockets: {worker index: connected socket to that worker}
+        """
+        self.md = md
+        self.index = index
+        self.peerMap = ChannelMap()  # channel -> peers with local subscribers
+        self.peers = []
+
+        for peerIndex, sock in sorted(peerSockets.items()):
+            sock.setblocking(False)
+            self.peers.append(WorkerPeer(self, sock, peerIndex))
+
+        md.bus = self
+        md.interestListeners.append(self)
+
+    def start(self):
+        """Start reading from every peer."""
+        loop = asyncio.get_running_loop()
+        for peer in self.peers:
+            peer.task = loop.create_task(peer.handle())
+
+    def handle_peer_control(self, peer, code, di):
+        if code == msgTypes.CONTROL_SET_CHANNEL:
+            self.peerMap.subscribe(peer, di.getUint64())
+
+        elif code == msgTypes.CONTROL_REMOVE_CHANNEL:
+            self.peerMap.unsubscribe(peer, di.getUint64())
+
+        elif code == msgTypes.CONTROL_ADD_RANGE:
+            low = di.getUint64()
+            self.peerMap.add_range(peer, low, di.getUint64())
+
+        elif code == msgTypes.CONTROL_REMOVE_RANGE:
+            low = di.getUint64()
+            self.peerMap.remove_range(peer, low, di.getUint64())
+
+        else:
+            self.md.logger.warning("Ignoring unknown worker bus control code %d from %s", code, peer.getName())
+
+    # Local interest changes, called by the MessageDirector
+
+    def channelAdded(self, client, channel, subscribers):
+        if len(subscribers) == 1:
+            self.advertise(msgTypes.CONTROL_SET_CHANNEL, channel)
+
+    def channelRemoved(self, client, channel, subscribers):
+        if not subscribers:
+            self.advertise(msgTypes.CONTROL_REMOVE_CHANNEL, channel)
+
+    def rangeAdded(self, client, changed):
+        covered = [(low, high) for low, high, subscribers in changed if len(subscribers) == 1]
+        for low, high in merge_ranges(covered):
+            self.advertise(msgTypes.CONTROL_ADD_RANGE, low, high)
+
+    def rangeRemoved(self, client, changed):
+        uncovered = [(low, high) for low, high, subscribers in changed if not subscribers]
+        for low, high in merge_ranges(uncovered):
+            self.advertise(msgTypes.CONTROL_REMOVE_RANGE, low, high)
+
+    def advertise(self, code, *channels):
+        """Send a control message about our local interest to every peer."""
+        frame = makeFrame(makeControlDatagram(code, *channels))
+        for peer in self.peers:
+            peer.sendFrame(frame)
+
+
+async def runWorker(otpFactory, index, peerSockets, host, port, **mdArgs):
+    """Run one MD worker: its MessageDirector plus its end of the worker bus."""
+    md = MessageDirector(otpFactory(), **mdArgs)
+    bus = WorkerBus(md, index, peerSockets)
+    bus.start()
+    print(f"[MD] Worker {index} (pid {os.getpid()}) starting")
+    await md.start(host, port, reusePort=True)
+
+
+def workerMain(otpFactory, index, peerSockets, host, port, mdArgs):
+    try:
+        asyncio.run(runWorker(otpFactory, index, peerSockets, host, port, **mdArgs))
+    except KeyboardInterrupt:
+        pass
+
+
+def workerLinks(count):
+    """
+    Build the worker bus: one socket pair per couple of workers, a full mesh.
+    Returns the {peer index: socket} of every worker, in worker order.
+    """
+    links = [{} for _ in range(count)]
+    for i in range(count):
+        for j in range(i + 1, count):
+            links[i][j], links[j][i] = socket.socketpair()
+
+    return links
+
+
+def closeLinks(links):
+    """Close the parent's copies of the bus sockets once every worker forked."""
+    for peerSockets in links:
+        for sock in peerSockets.values():
+            sock.close()
+
+
+def runWorkers(otpFactory, host, port, count=None, **mdArgs):
+    """
+    Run count MD worker processes (one per core by default) sharing host:port.
+    otpFactory is called in each worker to build its OTP core instance.
+    Extra keyword arguments are passed to every MessageDirector.
+    Blocks until every worker exited.
+    """
+    count = count or os.cpu_count()
+    links = workerLinks(count)
+
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for index, peerSockets in enumerate(links):
+        worker = context.Process(target=workerMain, name=f"md-worker-{index}",
+                                 args=(otpFactory, index, peerSockets, host, port, mdArgs))
+        worker.start()
+        workers.append(worker)
+
+    # The workers hold their own copies now
+    closeLinks(links)
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        print("[MD] Shutting down workers.")
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    # Example usage: run one MD worker per core with a dummy OTP core
+    class DummyOTP:
+        async def handle_message(self, channels, sender, code, dg):
+            print(f"[OTP] Received code={code} from {sender} channels={channels}")
+
+    runWorkers(DummyOTP, "127.0.0.1", 7100)
@@ -11,6 +11,8 @@ CONTROL_ADD_RANGE = 2006
 CONTROL_REMOVE_RANGE = 2007
 CONTROL_ADD_POST_REMOVE = 2008
 CONTROL_CLEAR_POST_REMOVE = 2009
+CONTROL_SET_DOWNSTREAM = 2010
+CONTROL_UPDATE_CHANNELS = 2011
 
 CLIENT_GO_GET_LOST = 4
 CLIENT_OBJECT_UPDATE_FIELD = 24
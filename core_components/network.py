@@ -0,0 +1,22 @@
+"""
+Picks the network_manager backend of this process.
+
+FAITHFUL_NET_BACKEND=asyncio selects network_manager_async, built on the
+asyncio event loop, which never imports Panda3D. The default, "panda", is the
+Panda3D queued connection / task manager backend of network_manager.
+
+    from core_components.network import NetworkConnector, NetworkListener
+"""
+
+import os
+
+NET_BACKEND = os.environ.get('FAITHFUL_NET_BACKEND', 'panda').lower()
+
+if NET_BACKEND == 'asyncio':
+    from core_components.network_manager_async import (NetworkConnector, NetworkDatagram,
+        NetworkDatagramIterator, NetworkError, NetworkHandler, NetworkListener, NetworkManager)
+elif NET_BACKEND == 'panda':
+    from core_components.network_manager import (NetworkConnector, NetworkDatagram,
+        NetworkDatagramIterator, NetworkError, NetworkHandler, NetworkListener, NetworkManager)
+else:
+    raise ValueError('Unknown FAITHFUL_NET_BACKEND: %s' % NET_BACKEND)
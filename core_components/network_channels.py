@@ -0,0 +1,107 @@
+"""
+Channel registration batching shared by both network_manager backends.
+
+Nothing here depends on the backend: the datagram class to build control
+messages with, and how to send them, are passed in.
+"""
+
+from core_components import msgTypes
+
+
+def add_control_update_channels(datagram, added, removed):
+    """
+    Appends a CONTROL_UPDATE_CHANNELS control message to datagram:
+    [uint16 n][uint64 channel]*n to register, then the same for channels to unregister
+    """
+
+    datagram.add_uint8(1)
+    datagram.add_uint64(msgTypes.CONTROL_MESSAGE)
+    datagram.add_uint16(msgTypes.CONTROL_UPDATE_CHANNELS)
+    datagram.add_uint16(len(added))
+    for channel in added:
+        datagram.add_uint64(channel)
+
+    datagram.add_uint16(len(removed))
+    for channel in removed:
+        datagram.add_uint64(channel)
+
+class NetworkChannelBatch(object):
+    """
+    Coalesces the channel registrations made during one tick. The last call
+    for a channel wins, and flush() sends every pending change in
+    CONTROL_UPDATE_CHANNELS datagrams, each applied atomically by the
+    MessageDirector. A lone change is sent as a plain CONTROL_SET_CHANNEL or
+    CONTROL_REMOVE_CHANNEL.
+    """
+
+    # Channels per datagram, keeps a batch well under the 64k datagram limit
+    max_channels = 4096
+
+    def __init__(self, datagram_class, send, coalesce=True, schedule=None):
+        """
+        datagram_class builds the control datagrams, send(datagram) sends one.
+        schedule(flush), when given, arranges for flush to run at the end of
+        the tick and returns a handle with cancel(), or None to flush at once;
+        without it the owner flushes, e.g. from a task.
+        """
+
+        self._datagram_class = datagram_class
+        self._send = send
+        self._coalesce = coalesce
+        self._schedule = schedule
+        self._pending = {}  # channel -> True to register, False to unregister
+        self._handle = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set_channel(self, channel):
+        self._pending[channel] = True
+        self.__changed()
+
+    def remove_channel(self, channel):
+        self._pending[channel] = False
+        self.__changed()
+
+    def __changed(self):
+        if not self._coalesce:
+            self.flush()
+            return
+
+        if self._schedule is None or self._handle:
+            return
+
+        self._handle = self._schedule(self.flush)
+        if self._handle is None:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the pending changes to the MessageDirector
+        """
+
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        if len(pending) == 1:
+            (channel, added), = pending.items()
+            datagram = self._datagram_class()
+            datagram.add_control_header(channel, msgTypes.CONTROL_SET_CHANNEL if added else
+                msgTypes.CONTROL_REMOVE_CHANNEL)
+
+            self._send(datagram)
+            return
+
+        changes = list(pending.items())
+        for start in range(0, len(changes), self.max_channels):
+            chunk = changes[start:start + self.max_channels]
+            datagram = self._datagram_class()
+            add_control_update_channels(datagram, [channel for channel, added in chunk if added],
+                [channel for channel, added in chunk if not added])
+
+            self._send(datagram)
@@ -1,5 +1,6 @@
 import collections
 import threading
+import time
 
 from panda3d.core import *
 from panda3d.direct import *
@@ -7,7 +8,10 @@ from panda3d.direct import *
 from direct.distributed.PyDatagramIterator import PyDatagramIterator
 
 from . import msgTypes
+from core_components.dc_codecs import build_field_codecs
+from core_components.dc_tables import build_class_table, load_dc_cache, peek_dc_cache_hash, store_dc_cache
 from core_components.faithful_logger import notify
+from core_components.network_channels import NetworkChannelBatch, add_control_update_channels
 
 
 
@@ -37,6 +41,15 @@ class NetworkDatagram(NetDatagram):
         self.add_uint16(message_type)
         self.add_uint64(channel)
 
+    def add_control_range_header(self, low, high, message_type):
+        self.add_uint8(1)
+        self.add_uint64(msgTypes.CONTROL_MESSAGE)
+        self.add_uint16(message_type)
+        self.add_uint64(low)
+        self.add_uint64(high)
+
+    add_control_update_channels = add_control_update_channels
+
 class NetworkDatagramIterator(PyDatagramIterator):
     """
     A class that inherits from panda's C++ DatagramIterator buffer.
@@ -44,6 +57,44 @@ class NetworkDatagramIterator(PyDatagramIterator):
     to the OTP's internal cluster participants...
     """
 
+class NetworkDatagramPool(object):
+    """
+    A bounded free list of NetworkDatagram and NetworkDatagramIterator
+    objects, reused by the read loops so that receiving a message does
+    not allocate. Both are handed back to the pool once the message has
+    been handled: handlers must not keep them past handle_datagram.
+    """
+
+    __slots__ = ('_datagrams', '_iterators', '_size')
+
+    def __init__(self, size=64):
+        self._datagrams = []
+        self._iterators = []
+        self._size = size
+
+    def get_datagram(self):
+        if self._datagrams:
+            return self._datagrams.pop()
+
+        return NetworkDatagram()
+
+    def get_iterator(self, datagram):
+        if self._iterators:
+            di = self._iterators.pop()
+            di.assign(datagram)
+            return di
+
+        return NetworkDatagramIterator(datagram)
+
+    def release_datagram(self, datagram):
+        if len(self._datagrams) < self._size:
+            datagram.clear()
+            self._datagrams.append(datagram)
+
+    def release_iterator(self, di):
+        if len(self._iterators) < self._size:
+            self._iterators.append(di)
+
 class NetworkDCLoader(object):
     notify = notify.new_category('NetworkDCLoader')
 
@@ -53,11 +104,17 @@ class NetworkDCLoader(object):
 
         self._dclasses_by_name = {}
         self._dclasses_by_number = {}
+        self._class_table = {}
+        self._class_infos_by_name = None
+        self._field_codecs = None
 
         self._hash_value = 0
+        self._pending_dc_files = None
+        self._time_saved = 0.0
 
     @property
     def dc_file(self):
+        self.__ensure_parsed()
         return self._dc_file
 
     @property
@@ -66,17 +123,154 @@ class NetworkDCLoader(object):
 
     @property
     def dclasses_by_name(self):
+        """
+        {class name: DCClass}. Panda's DC objects need the .dc files parsed,
+        on a cache hit this parses them; class_infos_by_name does not
+        """
+
+        self.__ensure_parsed()
         return self._dclasses_by_name
 
     @property
     def dclasses_by_number(self):
+        """
+        {class number: DCClass}, parsing the .dc files like dclasses_by_name;
+        class_table has the same classes without parsing
+        """
+
+        self.__ensure_parsed()
         return self._dclasses_by_number
 
+    @property
+    def class_table(self):
+        """
+        {class number: DCClassInfo} of every DC class, see dc_tables
+        """
+
+        return self._class_table
+
+    @property
+    def class_infos_by_name(self):
+        """
+        {class name: DCClassInfo} of every DC class, served from the cache
+        """
+
+        if self._class_infos_by_name is None:
+            self._class_infos_by_name = {info.name: info for info in self._class_table.values()}
+
+        return self._class_infos_by_name
+
+    @property
+    def field_codecs(self):
+        """
+        {field number: FieldCodec} of every field simple enough for a
+        precompiled codec, see dc_codecs
+        """
+
+        if self._field_codecs is None:
+            self._field_codecs = build_field_codecs(self._class_table)
+
+        return self._field_codecs
+
     @property
     def hash_value(self):
+        """
+        The DC hash. On a cache hit this is the hash recorded in the cache,
+        only checked against DCFile.get_hash() once the .dc files are parsed
+        (see dc-cache-verify-hash)
+        """
+
         return self._hash_value
 
-    def read_dc_files(self, dc_file_names=None):
+    @property
+    def time_saved(self):
+        """
+        Seconds of DC parsing the cache saved so far. The deferred parse is
+        subtracted if something asks for the DCFile or its DCClass objects
+        """
+
+        return self._time_saved
+
+    def read_dc_files(self, dc_file_names=None, cache_file=None):
+        """
+        Reads the DC files. Given file names and a cache file (by default the
+        dc-cache-file config variable), the class tables are loaded from the
+        cache when no .dc file changed since it was written; the files are
+        then only parsed once something asks for the DCFile or its DCClass
+        objects. class_table, class_infos_by_name, field_codecs and hash_value
+        are served from the cache.
+
+        A cache hit trusts the mtime and size of the .dc files: the cached
+        hash is compared with DCFile.get_hash() by the deferred parse, which
+        rebuilds the tables if they differ. Set dc-cache-verify-hash to parse
+        and compare at once instead, giving up the saving.
+        """
+
+        if cache_file is None:
+            cache_file = config.GetString('dc-cache-file', '')
+
+        use_cache = bool(cache_file and dc_file_names)
+        if use_cache:
+            start = time.perf_counter()
+            entry = load_dc_cache(cache_file, dc_file_names)
+            if entry is not None:
+                self._hash_value = entry['hash']
+                self.__set_class_table(entry['classes'])
+                self._pending_dc_files = list(dc_file_names)
+
+                load_time = time.perf_counter() - start
+                self._time_saved = max(0.0, entry['parse_time'] - load_time)
+                self.notify.info('Loaded DC tables from %s in %.1f ms, parsing took %.1f ms',
+                    cache_file, load_time * 1000, entry['parse_time'] * 1000)
+
+                if config.GetBool('dc-cache-verify-hash', False):
+                    self.__ensure_parsed()
+                return
+
+        start = time.perf_counter()
+        self.__parse_dc_files(dc_file_names)
+        parse_time = time.perf_counter() - start
+        self.__set_class_table(build_class_table(self._dc_file))
+
+        if use_cache:
+            cached_hash = peek_dc_cache_hash(cache_file)
+            if cached_hash is not None and cached_hash != self._hash_value:
+                self.notify.info('DC hash changed from %08x to %08x, rebuilding %s',
+                    cached_hash, self._hash_value, cache_file)
+
+            try:
+                store_dc_cache(cache_file, dc_file_names, self._hash_value, parse_time,
+                    self._class_table)
+            except OSError as e:
+                self.notify.warning('Could not write DC cache %s: %s', cache_file, e)
+
+    def __ensure_parsed(self):
+        """
+        Parses the DC files the class tables were loaded from the cache for
+        """
+
+        if not self._pending_dc_files:
+            return
+
+        dc_file_names, self._pending_dc_files = self._pending_dc_files, None
+        cached_hash = self._hash_value
+        start = time.perf_counter()
+        self.__parse_dc_files(dc_file_names)
+        parse_time = time.perf_counter() - start
+        self._time_saved = max(0.0, self._time_saved - parse_time)
+        self.notify.info('Parsed the cached DC files on demand in %.1f ms, %.1f ms saved',
+            parse_time * 1000, self._time_saved * 1000)
+        if self._hash_value != cached_hash:
+            self.notify.warning('DC hash %08x does not match the cached %08x' % (
+                self._hash_value, cached_hash))
+            self.__set_class_table(build_class_table(self._dc_file))
+
+    def __set_class_table(self, class_table):
+        self._class_table = class_table
+        self._class_infos_by_name = None
+        self._field_codecs = None
+
+    def __parse_dc_files(self, dc_file_names):
         dc_imports = {}
         if dc_file_names == None:
             read_result = self._dc_file.read_all()
@@ -129,6 +323,44 @@ class NetworkDCLoader(object):
 class NetworkManager(object):
     notify = notify.new_category('NetworkManager')
 
+    def __init__(self):
+        # Per tick budget for handling queued datagrams, 0 means no limit
+        self._read_budget_count = config.GetInt('net-read-budget-count', 1000)
+        self._read_budget_time = config.GetFloat('net-read-budget-time', 0.005)
+        self._carried_over = 0
+
+    @property
+    def carried_over(self):
+        """
+        Number of datagrams left queued for the next tick by the last update
+        """
+
+        return self._carried_over
+
+    def handle_readable(self, readable, handle):
+        """
+        Handles queued datagrams in arrival order until the queue is empty
+        or this tick's count/time budget is spent, returns how many were
+        carried over to the next tick
+        """
+
+        limit = self._read_budget_count
+        budget = self._read_budget_time
+        deadline = time.perf_counter() + budget
+        handled = 0
+        while readable:
+            if (limit and handled >= limit) or (budget and time.perf_counter() >= deadline):
+                break
+
+            handle(readable.popleft())
+            handled += 1
+
+        self._carried_over = len(readable)
+        if self._carried_over:
+            self.notify.debug('%d datagrams carried over to the next tick', self._carried_over)
+
+        return self._carried_over
+
     def get_unique_name(self, name):
         return '%s-%s-%s' % (self.__class__.__name__, name, id(self))
 
@@ -166,10 +398,14 @@ class NetworkConnector(NetworkManager):
 
         self.__socket = None
         self._readable = collections.deque()
+        self._datagram_pool = NetworkDatagramPool(config.GetInt('net-datagram-pool-size', 64))
+        self._channel_batch = NetworkChannelBatch(NetworkDatagram, self.__send_channels,
+            config.GetBool('net-coalesce-channels', True))
 
         self.__read_task = None
         self.__update_task = None
         self.__disconnect_task = None
+        self.__flush_task = None
 
     @property
     def dc_loader(self):
@@ -202,62 +438,87 @@ class NetworkConnector(NetworkManager):
         self.__disconnect_task = task_mgr.add(self.__listen_disconnect,
             self.get_unique_name('listen-disconnect'))
 
+        # Runs after the update tasks (sort 0) of the same tick
+        self.__flush_task = task_mgr.add(self.__flush_channels,
+            self.get_unique_name('flush-channels'), sort=100)
+
     def register_for_channel(self, channel):
         """
-        Registers our connections channel with the MessageDirector
+        Registers our connections channel with the MessageDirector,
+        batched with the other registrations of this tick
         """
 
-        datagram = NetworkDatagram()
-        datagram.add_control_header(channel, msgTypes.CONTROL_SET_CHANNEL)
-        self.handle_send_connection_datagram(datagram)
+        self._channel_batch.set_channel(channel)
 
     def unregister_for_channel(self, channel):
         """
-        Unregisters our connections channel from the MessageDirector
+        Unregisters our connections channel from the MessageDirector,
+        batched with the other registrations of this tick
+        """
+
+        self._channel_batch.remove_channel(channel)
+
+    def register_for_range(self, low, high):
+        """
+        Registers every channel in [low, high] with the MessageDirector
         """
 
         datagram = NetworkDatagram()
-        datagram.add_control_header(channel, msgTypes.CONTROL_REMOVE_CHANNEL)
-        self.handle_send_connection_datagram(datagram)
+        datagram.add_control_range_header(low, high, msgTypes.CONTROL_ADD_RANGE)
+        self.send_connection_datagram(datagram)
+
+    def unregister_for_range(self, low, high):
+        """
+        Unregisters every channel in [low, high] from the MessageDirector
+        """
+
+        datagram = NetworkDatagram()
+        datagram.add_control_range_header(low, high, msgTypes.CONTROL_REMOVE_RANGE)
+        self.send_connection_datagram(datagram)
 
     def __read_incoming(self, task):
         """
-        Polls for incoming data
+        Polls for incoming data, queueing every datagram available
         """
 
-        if self.__reader.data_available():
-            datagram = NetworkDatagram()
+        while self.__reader.data_available():
+            datagram = self._datagram_pool.get_datagram()
+
+            if not self.__reader.get_data(datagram):
+                self._datagram_pool.release_datagram(datagram)
+                break
 
-            if self.__reader.get_data(datagram):
-                self.__handle_incoming_data(datagram)
+            self._readable.append(datagram)
 
         return task.cont
 
     def __update(self, task):
         """
-        Gets a datagram from the queue and handles it
+        Handles the queued datagrams, within this tick's budget
         """
 
-        if not len(self._readable):
-            return task.cont
-
-        datagram = self._readable.pop()
-        di = NetworkDatagramIterator(datagram)
-        if not di.get_remaining_size():
-            return task.cont
-
-        self.handle_internal_datagram(di)
+        self.handle_readable(self._readable, self.__handle_incoming_data)
         return task.cont
 
     def __listen_disconnect(self, task):
         """
-        Watches our connected socket object and determines if the stream has ended..
+        Waits for the connection manager to report our stream has ended..
+        The reader queues a reset when it hits EOF or an error on the socket,
+        so there is nothing to poll while the connection is fine.
         """
 
-        if not self.__reader.is_connection_ok(self.__socket):
-            self.handle_disconnected()
-            return task.done
+        if not self.__manager.reset_connection_available():
+            return task.cont
+
+        connection = PointerToConnection()
+        if not self.__manager.get_reset_connection(connection):
+            return task.cont
+
+        self.handle_disconnected()
+        return task.done
 
+    def __flush_channels(self, task):
+        self._channel_batch.flush()
         return task.cont
 
     def __handle_incoming_data(self, datagram):
@@ -265,8 +526,22 @@ class NetworkConnector(NetworkManager):
         Handles incoming data from the connector
         """
 
-        di = NetworkDatagramIterator(datagram)
-        self.handle_internal_datagram(di)
+        di = self._datagram_pool.get_iterator(datagram)
+        try:
+            if di.get_remaining_size():
+                self.handle_internal_datagram(di)
+        finally:
+            self._datagram_pool.release_iterator(di)
+            self._datagram_pool.release_datagram(datagram)
+
+    def send_connection_datagram(self, datagram):
+        """
+        Sends a datagram to our connection, after the channel registrations
+        still pending so the MessageDirector sees them in call order
+        """
+
+        self._channel_batch.flush()
+        self.handle_send_connection_datagram(datagram)
 
     def handle_send_connection_datagram(self, datagram):
         """
@@ -275,6 +550,9 @@ class NetworkConnector(NetworkManager):
 
         self.__writer.send(datagram, self.__socket)
 
+    def __send_channels(self, datagram):
+        self.handle_send_connection_datagram(datagram)
+
     def handle_internal_datagram(self, di):
         """
         Handles a datagram that was sent by the message director
@@ -301,6 +579,7 @@ class NetworkConnector(NetworkManager):
         """
 
         self.unregister_for_channel(self._channel)
+        self._channel_batch.flush()
         self.__reader.remove_connection(self.__socket)
 
     def shutdown(self):
@@ -313,14 +592,20 @@ class NetworkConnector(NetworkManager):
         if self.__disconnect_task:
             task_mgr.remove(self.__disconnect_task)
 
+        if self.__flush_task:
+            task_mgr.remove(self.__flush_task)
+
         self.__read_task = None
         self.__update_task = None
         self.__disconnect_task = None
+        self.__flush_task = None
 
 class NetworkHandler(NetworkManager):
     notify = notify.new_category('NetworkHandler')
 
     def __init__(self, network, rendezvous, address, connection):
+        NetworkManager.__init__(self)
+
         self._network = network
         self._rendezvous = rendezvous
         self._address = address
@@ -386,9 +671,7 @@ class NetworkHandler(NetworkManager):
         Registers our connections channel with the MessageDirector
         """
 
-        datagram = NetworkDatagram()
-        datagram.add_control_header(channel, msgTypes.CONTROL_SET_CHANNEL)
-        self._network.handle_send_connection_datagram(datagram)
+        self._network.register_channel(channel)
         self._network.add_channel_to_handler(channel, self)
 
     def unregister_for_channel(self, channel):
@@ -396,9 +679,7 @@ class NetworkHandler(NetworkManager):
         Unregisters our connections channel from the MessageDirector
         """
 
-        datagram = NetworkDatagram()
-        datagram.add_control_header(channel, msgTypes.CONTROL_REMOVE_CHANNEL)
-        self._network.handle_send_connection_datagram(datagram)
+        self._network.unregister_channel(channel)
         self._network.remove_channel_to_handler(channel)
 
     def handle_set_channel_id(self, channel):
@@ -413,18 +694,10 @@ class NetworkHandler(NetworkManager):
 
     def __update(self, task):
         """
-        Gets a datagram from the queue and handles it
+        Handles the queued datagrams, within this tick's budget
         """
 
-        if not len(self._readable):
-            return task.cont
-
-        datagram = self._readable.pop()
-        di = NetworkDatagramIterator(datagram)
-        if not di.get_remaining_size():
-            return task.cont
-
-        self.handle_datagram(di)
+        self.handle_readable(self._readable, self.handle_incoming_data)
         return task.cont
 
     def handle_send_datagram(self, datagram):
@@ -439,8 +712,13 @@ class NetworkHandler(NetworkManager):
         Puts an incoming datagram in the data queue
         """
 
-        di = NetworkDatagramIterator(datagram)
-        self.handle_datagram(di)
+        pool = self._network.datagram_pool
+        di = pool.get_iterator(datagram)
+        try:
+            if di.get_remaining_size():
+                self.handle_datagram(di)
+        finally:
+            pool.release_iterator(di)
 
     def handle_datagram(self, di):
         """
@@ -502,10 +780,20 @@ class NetworkListener(NetworkManager):
         self.__socket = None
         self._handlers = {}
         self._channel2handlers = {}
+        self._datagram_pool = NetworkDatagramPool(config.GetInt('net-datagram-pool-size', 64))
+        self._readable = collections.deque()
+        self._channel_batch = NetworkChannelBatch(NetworkDatagram, self.__send_channels,
+            config.GetBool('net-coalesce-channels', True))
 
         self.__listen_task = None
         self.__read_task = None
+        self.__update_task = None
         self.__disconnect_task = None
+        self.__flush_task = None
+
+    @property
+    def datagram_pool(self):
+        return self._datagram_pool
 
     def setup(self):
         self.__socket = self.__manager.open_TCP_server_rendezvous(self.__address,
@@ -523,9 +811,16 @@ class NetworkListener(NetworkManager):
         self.__read_task = task_mgr.add(self.__read_incoming,
             self.get_unique_name('read-incoming'))
 
+        self.__update_task = task_mgr.add(self.__update,
+            self.get_unique_name('update-handlers'))
+
         self.__disconnect_task = task_mgr.add(self.__listen_disconnect,
             self.get_unique_name('listen-disconnect'))
 
+        # Runs after the update tasks (sort 0) of the same tick
+        self.__flush_task = task_mgr.add(self.__flush_channels,
+            self.get_unique_name('flush-channels'), sort=100)
+
     def __listen_incoming(self, task):
         """
         Polls for incoming connections
@@ -543,25 +838,60 @@ class NetworkListener(NetworkManager):
 
     def __read_incoming(self, task):
         """
-        Polls for incoming data
+        Polls for incoming data, queueing every datagram available
         """
 
-        if self.__reader.data_available():
-            datagram = NetworkDatagram()
+        while self.__reader.data_available():
+            datagram = self._datagram_pool.get_datagram()
+
+            if not self.__reader.get_data(datagram):
+                self._datagram_pool.release_datagram(datagram)
+                break
 
-            if self.__reader.get_data(datagram):
-                self.__handle_incoming_data(datagram, datagram.get_connection())
+            self._readable.append(datagram)
 
         return task.cont
 
+    def __update(self, task):
+        """
+        Hands the queued datagrams to their handlers, within this tick's budget
+        """
+
+        self.handle_readable(self._readable, self.__handle_queued_data)
+        return task.cont
+
+    def __flush_channels(self, task):
+        self.flush_channels()
+        return task.cont
+
+    def __handle_queued_data(self, datagram):
+        try:
+            self.__handle_incoming_data(datagram, datagram.get_connection())
+        finally:
+            self._datagram_pool.release_datagram(datagram)
+
     def __listen_disconnect(self, task):
         """
-        Watches all connected socket objects and determines if the stream has ended...
+        Collects the connections the connection manager reported as reset
+        (EOF or error seen by the reader) and cleans their handlers up in one
+        batch. Idle connections cost nothing here.
         """
 
-        for handler in self._handlers.values():
-            if not self.__reader.is_connection_ok(handler.connection):
-                handler.handle_disconnected()
+        if not self.__manager.reset_connection_available():
+            return task.cont
+
+        handlers = []
+        while self.__manager.reset_connection_available():
+            connection = PointerToConnection()
+            if not self.__manager.get_reset_connection(connection):
+                break
+
+            handler = self._handlers.get(connection.p())
+            if handler is not None:
+                handlers.append(handler)
+
+        if handlers:
+            self.handle_disconnected_handlers(handlers)
 
         return task.cont
 
@@ -658,8 +988,45 @@ class NetworkListener(NetworkManager):
 
         self.__writer.send(datagram, connection)
 
+    def register_channel(self, channel):
+        """
+        Registers a handler's channel with the MessageDirector,
+        batched with the other registrations of this tick
+        """
+
+        self._channel_batch.set_channel(channel)
+
+    def unregister_channel(self, channel):
+        """
+        Unregisters a handler's channel from the MessageDirector,
+        batched with the other registrations of this tick
+        """
+
+        self._channel_batch.remove_channel(channel)
+
+    def flush_channels(self):
+        """
+        Sends the pending channel registrations through handle_send_connection_datagram
+        """
+
+        self._channel_batch.flush()
+
+    def send_connection_datagram(self, datagram):
+        """
+        Sends a datagram to the MessageDirector, after the channel registrations
+        still pending so it sees them in call order
+        """
+
+        self._channel_batch.flush()
+        self.handle_send_connection_datagram(datagram)
+
     def handle_send_connection_datagram(self, datagram):
-        pass
+        """
+        Sends a datagram to the MessageDirector; implemented by subclasses
+        """
+
+    def __send_channels(self, datagram):
+        self.handle_send_connection_datagram(datagram)
 
     def handle_disconnect_handler(self, handler):
         """
@@ -675,18 +1042,38 @@ class NetworkListener(NetworkManager):
 
         self.remove_handler(handler)
 
+    def handle_disconnected_handlers(self, handlers):
+        """
+        Handles the disconnection of every handler whose connection was
+        reset during the same tick
+        """
+
+        self.notify.debug('%d connections reset', len(handlers))
+        for handler in handlers:
+            handler.handle_disconnected()
+
     def shutdown(self):
+        self.flush_channels()
+
         if self.__listen_task:
             task_mgr.remove(self.__listen_task)
 
         if self.__read_task:
             task_mgr.remove(self.__read_task)
 
+        if self.__update_task:
+            task_mgr.remove(self.__update_task)
+
         if self.__disconnect_task:
             task_mgr.remove(self.__disconnect_task)
 
+        if self.__flush_task:
+            task_mgr.remove(self.__flush_task)
+
         self.__listen_task = None
         self.__read_task = None
+        self.__update_task = None
         self.__disconnect_task = None
+        self.__flush_task = None
 
         self.__listener.remove_connection(self.__socket)
@@ -0,0 +1,663 @@
+"""
+asyncio backend of network_manager.
+
+Same NetworkConnector / NetworkHandler / NetworkListener API as the Panda3D
+backend, but built on asyncio protocols instead of Panda's queued connection
+manager and task manager polling: datagrams are handled as soon as the event
+loop reads them, disconnects arrive through connection_lost, and nothing here
+imports Panda3D. AI and UberDOG processes using it can share one event loop
+with the MD stack (see network_server_async).
+
+Differences from the Panda3D backend:
+ - setup() is a coroutine: await connector.setup() / await listener.setup()
+ - datagrams are core_components.datagram Datagrams, same wire format
+ - a datagram handed to handle_datagram is a view into the receive buffer,
+   only valid until the handler returns
+
+Pick the backend with core_components.network (FAITHFUL_NET_BACKEND).
+"""
+
+import asyncio
+
+from core_components import msgTypes
+from core_components.datagram import Datagram, DatagramIterator, DatagramTruncatedError, FrameBuffer
+from core_components.faithful_logger import notify
+from core_components.message_director import makeFrame
+from core_components.network_channels import NetworkChannelBatch, add_control_update_channels
+from core_components.network_server_async import CorkedWriter
+
+
+class NetworkError(RuntimeError):
+    """
+    A custom exception class for network runtime errors.
+    """
+    pass
+
+
+class NetworkDatagram(Datagram):
+    """
+    Datagram with the Panda3D style names and headers used by the OTP's
+    internal cluster participants...
+    """
+
+    add_uint8 = Datagram.addUint8
+    add_uint16 = Datagram.addUint16
+    add_uint32 = Datagram.addUint32
+    add_uint64 = Datagram.addUint64
+    add_int8 = Datagram.addInt8
+    add_int16 = Datagram.addInt16
+    add_int32 = Datagram.addInt32
+    add_int64 = Datagram.addInt64
+    add_float64 = Datagram.addFloat64
+    add_string = Datagram.addString
+    add_blob = Datagram.addBlob
+    append_data = Datagram.appendData
+    get_length = Datagram.getLength
+    get_message = Datagram.getMessage
+
+    def add_header(self, channel, sender, message_type):
+        self.addServerHeader((channel,), sender, message_type)
+
+    def add_control_header(self, channel, message_type):
+        self.add_uint8(1)
+        self.add_uint64(msgTypes.CONTROL_MESSAGE)
+        self.add_uint16(message_type)
+        self.add_uint64(channel)
+
+    def add_control_range_header(self, low, high, message_type):
+        self.add_uint8(1)
+        self.add_uint64(msgTypes.CONTROL_MESSAGE)
+        self.add_uint16(message_type)
+        self.add_uint64(low)
+        self.add_uint64(high)
+
+    add_control_update_channels = add_control_update_channels
+
+class NetworkDatagramIterator(DatagramIterator):
+    """
+    DatagramIterator with the Panda3D style names used by the OTP's
+    internal cluster participants...
+    """
+
+    get_uint8 = DatagramIterator.getUint8
+    get_uint16 = DatagramIterator.getUint16
+    get_uint32 = DatagramIterator.getUint32
+    get_uint64 = DatagramIterator.getUint64
+    get_int8 = DatagramIterator.getInt8
+    get_int16 = DatagramIterator.getInt16
+    get_int32 = DatagramIterator.getInt32
+    get_int64 = DatagramIterator.getInt64
+    get_float64 = DatagramIterator.getFloat64
+    get_string = DatagramIterator.getString
+    get_blob = DatagramIterator.getBlob
+    get_remaining_bytes = DatagramIterator.getRemainingBytes
+    get_remaining_size = DatagramIterator.getRemainingSize
+
+class NetworkProtocol(asyncio.BufferedProtocol):
+    """
+    One TCP connection carrying <uint16 length><datagram> frames. Frames are
+    received straight into a FrameBuffer and handed to on_datagram in place;
+    outgoing datagrams are corked until the end of the event loop tick.
+    """
+
+    def __init__(self, on_datagram, on_lost, on_made=None):
+        self._on_datagram = on_datagram
+        self._on_lost = on_lost
+        self._on_made = on_made
+        self._buffer = FrameBuffer()
+        self.transport = None
+        self.output = None
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.output = CorkedWriter(transport)
+        if self._on_made:
+            self._on_made(self)
+
+    def get_buffer(self, size_hint):
+        return self._buffer.writable()
+
+    def buffer_updated(self, nbytes):
+        self._buffer.commit(nbytes)
+        try:
+            for frame in self._buffer.frames():
+                self._on_datagram(frame, self)
+        except DatagramTruncatedError as e:
+            NetworkManager.notify.warning('Truncated datagram, closing connection: %s', e)
+            self.close()
+
+    def connection_lost(self, exc):
+        self.closing = True
+        self._on_lost(self)
+
+    def write(self, datagram):
+        if not self.closing:
+            self.output.write(makeFrame(datagram))
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.output.flush()
+            self.transport.close()
+
+def call_soon(callback):
+    """
+    Schedules callback for the end of this event loop tick, or returns None
+    outside of a running loop
+    """
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+    return loop.call_soon(callback)
+
+class NetworkManager(object):
+    notify = notify.new_category('NetworkManager')
+
+    # Batch channel registrations per tick into CONTROL_UPDATE_CHANNELS,
+    # the net-coalesce-channels config variable of the Panda3D backend
+    coalesce_channels = True
+
+    def get_unique_name(self, name):
+        return '%s-%s-%s' % (self.__class__.__name__, name, id(self))
+
+    def get_puppet_connection_channel(self, doId):
+        return doId + (1001 << 32)
+
+    def get_account_connection_channel(self, doId):
+        return doId + (1003 << 32)
+
+    def get_account_id_from_channel_code(self, channel):
+        return channel >> 32
+
+    def get_avatar_id_from_connection_channel(self, channel):
+        return channel & 0xffffffff
+
+class NetworkConnector(NetworkManager):
+    notify = notify.new_category('NetworkConnector')
+
+    def __init__(self, dc_loader, address, port, channel, timeout=5000):
+        NetworkManager.__init__(self)
+
+        self._dc_loader = dc_loader
+        self.__address = address
+        self.__port = port
+        self._channel = channel
+        self.__timeout = timeout
+
+        self.__protocol = None
+        self._channel_batch = NetworkChannelBatch(NetworkDatagram, self.__send_channels,
+            self.coalesce_channels, call_soon)
+
+    @property
+    def dc_loader(self):
+        return self._dc_loader
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @channel.setter
+    def channel(self, channel):
+        self._channel = channel
+
+    async def setup(self):
+        loop = asyncio.get_running_loop()
+        try:
+            _, self.__protocol = await asyncio.wait_for(loop.create_connection(
+                lambda: NetworkProtocol(self.__handle_incoming_data, self.__handle_lost),
+                self.__address, self.__port), self.__timeout / 1000.0)
+        except (OSError, asyncio.TimeoutError):
+            raise NetworkError('Failed to connect TCP socket on address: %s:%d' % (self.__address, self.__port))
+
+        self.register_for_channel(self._channel)
+
+    def register_for_channel(self, channel):
+        """
+        Registers our connections channel with the MessageDirector,
+        batched with the other registrations of this tick
+        """
+
+        self._channel_batch.set_channel(channel)
+
+    def unregister_for_channel(self, channel):
+        """
+        Unregisters our connections channel from the MessageDirector,
+        batched with the other registrations of this tick
+        """
+
+        self._channel_batch.remove_channel(channel)
+
+    def register_for_range(self, low, high):
+        """
+        Registers every channel in [low, high] with the MessageDirector
+        """
+
+        datagram = NetworkDatagram()
+        datagram.add_control_range_header(low, high, msgTypes.CONTROL_ADD_RANGE)
+        self.send_connection_datagram(datagram)
+
+    def unregister_for_range(self, low, high):
+        """
+        Unregisters every channel in [low, high] from the MessageDirector
+        """
+
+        datagram = NetworkDatagram()
+        datagram.add_control_range_header(low, high, msgTypes.CONTROL_REMOVE_RANGE)
+        self.send_connection_datagram(datagram)
+
+    def __handle_incoming_data(self, datagram, protocol):
+        """
+        Handles incoming data from the connector
+        """
+
+        di = NetworkDatagramIterator(datagram)
+        if di.get_remaining_size():
+            self.handle_internal_datagram(di)
+
+    def __handle_lost(self, protocol):
+        self.handle_disconnected()
+
+    def send_connection_datagram(self, datagram):
+        """
+        Sends a datagram to our connection, after the channel registrations
+        still pending so the MessageDirector sees them in call order
+        """
+
+        self._channel_batch.flush()
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_send_connection_datagram(self, datagram):
+        """
+        Sends a datagram to our connection
+        """
+
+        if self.__protocol:
+            self.__protocol.write(datagram)
+
+    def __send_channels(self, datagram):
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_internal_datagram(self, di):
+        """
+        Handles a datagram that was sent by the message director
+        """
+
+        code = di.get_uint8()
+        self.handle_datagram(di.get_uint64(), di.get_uint64(), di.get_uint16(), di)
+
+    def handle_datagram(self, channel, sender, message_type, di):
+        """
+        Handles a datagram that was pulled from the queue
+        """
+
+    def handle_disconnect(self):
+        """
+        Disconnects our client socket instance
+        """
+
+        self.__protocol.close()
+
+    def handle_disconnected(self):
+        """
+        Handles disconnection when the socket connection closes
+        """
+
+        self.unregister_for_channel(self._channel)
+        self._channel_batch.flush()
+
+    def shutdown(self):
+        if self.__protocol:
+            self.__protocol.close()
+
+        self.__protocol = None
+
+class NetworkHandler(NetworkManager):
+    notify = notify.new_category('NetworkHandler')
+
+    def __init__(self, network, rendezvous, address, connection):
+        self._network = network
+        self._rendezvous = rendezvous
+        self._address = address
+        self._connection = connection
+
+        self._old_channel = 0
+        self._channel = 0
+        self._allocated_channel = 0
+
+    @property
+    def network(self):
+        return self._network
+
+    @property
+    def rendezvous(self):
+        return self._rendezvous
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def connection(self):
+        return self._connection
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @property
+    def old_channel(self):
+        return self._old_channel
+
+    @channel.setter
+    def channel(self, channel):
+        if not self._channel:
+            self._allocated_channel = channel
+
+        self._old_channel = self._channel
+        self._channel = channel
+
+    @property
+    def allocated_channel(self):
+        return self._allocated_channel
+
+    @allocated_channel.setter
+    def allocated_channel(self, allocated_channel):
+        self._allocated_channel = allocated_channel
+
+    def setup(self):
+        if self._channel:
+            self.register_for_channel(self._channel)
+
+    def register_for_channel(self, channel):
+        """
+        Registers our connections channel with the MessageDirector
+        """
+
+        self._network.register_channel(channel)
+        self._network.add_channel_to_handler(channel, self)
+
+    def unregister_for_channel(self, channel):
+        """
+        Unregisters our connections channel from the MessageDirector
+        """
+
+        self._network.unregister_channel(channel)
+        self._network.remove_channel_to_handler(channel)
+
+    def handle_set_channel_id(self, channel):
+        if channel == self._channel:
+            return
+
+        self.register_for_channel(channel)
+        if self._old_channel and self._old_channel != self._allocated_channel:
+            self.unregister_for_channel(self._old_channel)
+
+        self.channel = channel
+
+    def handle_send_datagram(self, datagram):
+        """
+        Sends a datagram to our connection
+        """
+
+        self._network.handle_send_datagram(datagram, self._connection)
+
+    def handle_incoming_data(self, datagram):
+        """
+        Handles a datagram read from our connection
+        """
+
+        di = NetworkDatagramIterator(datagram)
+        if di.get_remaining_size():
+            self.handle_datagram(di)
+
+    def handle_datagram(self, di):
+        """
+        Handles a datagram that was pulled from the queue
+        """
+
+    def handle_disconnect(self):
+        """
+        Disconnects our client socket instance
+        """
+
+        self._network.handle_disconnect_handler(self)
+
+    def handle_disconnected(self):
+        """
+        Handles disconnection when the socket connection closes
+        """
+
+        self._network.handle_disconnected_handler(self)
+
+    def shutdown(self):
+        if self._old_channel:
+            self.unregister_for_channel(self._old_channel)
+            self._old_channel = 0
+
+        if self._channel:
+            self.unregister_for_channel(self._channel)
+            self._channel = 0
+
+        if self._allocated_channel:
+            self.unregister_for_channel(self._allocated_channel)
+            self._allocated_channel = 0
+
+class NetworkListener(NetworkManager):
+    notify = notify.new_category('NetworkListener')
+
+    def __init__(self, address, port, handler, backlog=10000):
+        NetworkManager.__init__(self)
+
+        self.__address = address
+        self.__port = port
+        self.__handler = handler
+        self.__backlog = backlog
+
+        self.__server = None
+        self._handlers = {}
+        self._channel2handlers = {}
+
+        self._lost = []
+        self._channel_batch = NetworkChannelBatch(NetworkDatagram, self.__send_channels,
+            self.coalesce_channels, call_soon)
+
+    async def setup(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self.__server = await loop.create_server(
+                lambda: NetworkProtocol(self.__handle_incoming_data, self.__handle_lost,
+                                        self.__handle_made),
+                self.__address, self.__port, backlog=self.__backlog)
+        except OSError:
+            raise NetworkError('Failed to bind TCP socket on address: <%s:%d>!' % (
+                self.__address, self.__port))
+
+    def __handle_made(self, connection):
+        address = connection.transport.get_extra_info('peername')
+        self.handle_incoming_connection(self.__server, address, connection)
+
+    def handle_incoming_connection(self, rendezvous, address, connection):
+        """
+        Handles an incoming connection from the connection listener
+        """
+
+        handler = self.__handler(self, rendezvous, address, connection)
+        self.add_handler(handler)
+
+    def __handle_incoming_data(self, datagram, connection):
+        """
+        Handles new data incoming from a connection
+        """
+
+        handler = self._handlers.get(connection)
+        if handler is None:
+            return
+
+        handler.handle_incoming_data(datagram)
+
+    def __handle_lost(self, connection):
+        """
+        A connection went away; its handler is cleaned up at the end of the
+        tick together with every other connection lost meanwhile
+        """
+
+        if connection not in self._handlers:
+            return
+
+        if not self._lost:
+            asyncio.get_running_loop().call_soon(self.__flush_lost)
+
+        self._lost.append(self._handlers[connection])
+
+    def __flush_lost(self):
+        handlers, self._lost = self._lost, []
+        self.handle_disconnected_handlers(handlers)
+
+    def has_handler(self, connection):
+        """
+        Returns True if the handler is queued else False
+        """
+
+        return connection in self._handlers
+
+    def add_handler(self, handler):
+        """
+        Adds a handler to the handlers dictionary
+        """
+
+        if self.has_handler(handler.connection):
+            return
+
+        self._handlers[handler.connection] = handler
+        handler.setup()
+
+    def remove_handler(self, handler):
+        """
+        Removes a handler from the handlers dictionary
+        """
+
+        if not self.has_handler(handler.connection):
+            return
+
+        handler.shutdown()
+        del self._handlers[handler.connection]
+
+    def has_channel_to_handler(self, channel):
+        """
+        Returns True if a handler instance if one is associated with that channel else False
+        """
+
+        return channel in self._channel2handlers
+
+    def add_channel_to_handler(self, channel, handler):
+        """
+        Associates a handler with a channel
+        """
+
+        if self.has_channel_to_handler(channel):
+            return
+
+        self._channel2handlers[channel] = handler
+
+    def remove_channel_to_handler(self, channel):
+        """
+        Removes association of a channel to a handler
+        """
+
+        if not self.has_channel_to_handler(channel):
+            return
+
+        del self._channel2handlers[channel]
+
+    def get_handler_from_channel(self, channel):
+        """
+        Returns a handler instance if one is associated with that channel
+        """
+
+        return self._channel2handlers.get(channel)
+
+    def handle_send_datagram(self, datagram, connection):
+        """
+        Sends a datagram to a specific connection
+        """
+
+        if not self.has_handler(connection):
+            return
+
+        connection.write(datagram)
+
+    def register_channel(self, channel):
+        """
+        Registers a handler's channel with the MessageDirector,
+        batched with the other registrations of this tick
+        """
+
+        self._channel_batch.set_channel(channel)
+
+    def unregister_channel(self, channel):
+        """
+        Unregisters a handler's channel from the MessageDirector,
+        batched with the other registrations of this tick
+        """
+
+        self._channel_batch.remove_channel(channel)
+
+    def flush_channels(self):
+        """
+        Sends the pending channel registrations through handle_send_connection_datagram
+        """
+
+        self._channel_batch.flush()
+
+    def send_connection_datagram(self, datagram):
+        """
+        Sends a datagram to the MessageDirector, after the channel registrations
+        still pending so it sees them in call order
+        """
+
+        self._channel_batch.flush()
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_send_connection_datagram(self, datagram):
+        """
+        Sends a datagram to the MessageDirector; implemented by subclasses
+        """
+
+    def __send_channels(self, datagram):
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_disconnect_handler(self, handler):
+        """
+        Disconnects the handlers client socket instance
+        """
+
+        handler.connection.close()
+
+    def handle_disconnected_handler(self, handler):
+        """
+        Handles disconnection of a client socket instance
+        """
+
+        self.remove_handler(handler)
+
+    def handle_disconnected_handlers(self, handlers):
+        """
+        Handles the disconnection of every handler whose connection was
+        lost during the same tick
+        """
+
+        self.notify.debug('%d connections lost', len(handlers))
+        for handler in handlers:
+            handler.handle_disconnected()
+
+    def shutdown(self):
+        if self.__server:
+            self.__server.close()
+
+        self.__server = None
+        for handler in list(self._handlers.values()):
+            handler.connection.close()
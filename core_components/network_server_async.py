@@ -1,14 +1,112 @@
 import asyncio
+import collections
 from asyncio import StreamReader, StreamWriter
 #from panda3d.core import Datagram
 from core_components.faithful_logger import notify
 import struct
-from core_components.datagram import Datagram, DatagramIterator
+from core_components.datagram import Datagram, DatagramIterator, DatagramTruncatedError, FrameBuffer
 from core_components import msgTypes
+from core_components.message_director import (SLOW_CONSUMER_DISCONNECT, SLOW_CONSUMER_DROP,
+                                               makeFrame)
+from core_components.zone_interest import EMPTY
+
+# Initial receive buffer of a client connection. Client datagrams are small;
+# the FrameBuffer grows for the odd bigger one.
+CLIENT_BUFFER_SIZE = 2048
+
+
+class CorkedWriter:
+    """
+    Per-connection output buffer that coalesces writes.
+
+    Frames queued while the event loop runs one iteration are corked and
+    written to the transport in a single write() from a callback scheduled at
+    the end of the tick (or after max_latency seconds, when set). A batch is
+    flushed early once it holds max_batch frames or max_bytes bytes.
+    """
+
+    def __init__(self, transport, max_latency=0.0, max_batch=256, max_bytes=65536):
+        """
+        :param transport: Anything with a write() method (StreamWriter or Transport).
+        :param max_latency: Seconds a frame may wait in the cork, 0 for end of tick.
+        :param max_batch: Maximum number of frames per write.
+        :param max_bytes: Maximum number of bytes per write.
+        """
+        self.transport = transport
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.max_bytes = max_bytes
+
+        self.buffer = bytearray()
+        self.count = 0          # frames in the current batch
+        self.handle = None      # scheduled flush
+
+        # Counters
+        self.flushes = 0
+        self.frames = 0
+        self.bytes = 0
+        self.batchSizes = collections.Counter()  # frames per write -> writes
+
+    def write(self, frame):
+        """
+        Cork a (length prefix, datagram) frame.
+
+        :param frame: The frame returned by message_director.makeFrame.
+        """
+        for part in frame:
+            self.buffer += part
+        self.count += 1
+
+        if self.count >= self.max_batch or len(self.buffer) >= self.max_bytes:
+            self.flush()
+        elif self.handle is None:
+            loop = asyncio.get_running_loop()
+            if self.max_latency:
+                self.handle = loop.call_later(self.max_latency, self.flush)
+            else:
+                self.handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        """Write every corked frame to the transport at once."""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if not self.count:
+            return
+
+        # Hand the buffer over instead of copying it; we never touch it again.
+        data, self.buffer = self.buffer, bytearray()
+        self.transport.write(data)
+
+        self.flushes += 1
+        self.frames += self.count
+        self.bytes += len(data)
+        self.batchSizes[self.count] += 1
+        self.count = 0
+
+    def stats(self):
+        """Returns the batching counters of this connection."""
+        return {
+            "flushes": self.flushes,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "average_batch": self.frames / self.flushes if self.flushes else 0.0,
+            "batch_sizes": dict(self.batchSizes),
+        }
 
 
 class AsyncMDClient:
-    def __init__(self, reader, writer, md, logger):
+    """
+    One daemon connection to the Message Director, served through asyncio streams.
+
+    Outbound datagrams are corked by a CorkedWriter and then buffered by the
+    transport, whose write buffer limits are the MD's high / low water marks:
+    once the transport pauses, the connection is congested and the MD's slow
+    consumer policy applies to it, as it does to MDClient.
+    """
+
+    def __init__(self, reader, writer, md, logger, max_latency=0.0, max_batch=256):
         """
         Initializes the AsyncMDClient.
 
@@ -16,86 +114,134 @@ class AsyncMDClient:
         :param writer: Asynchronous writer for sending data through the connection.
         :param md: The message director instance to handle incoming datagrams.
         :param logger: Logger instance for logging warnings and other messages.
+        :param max_latency: Seconds an outgoing datagram may stay corked, 0 for end of tick.
+        :param max_batch: Maximum number of datagrams coalesced into one write.
         """
         self.reader = reader
         self.writer = writer
+        self.output = CorkedWriter(writer, max_latency, max_batch)
         self.md = md
         self.logger = logger
+        self.addr = writer.get_extra_info("peername")
+        self.fd = writer.get_extra_info("socket").fileno()  # key in md.clients
+        self.connectionName = ""    # optional human name
+        self.connectionURL = ""     # optional URL
+        self.channels = set()       # subscribed channels
+        self.postRemove = []        # datagrams to replay on disconnect
+        self.task = None            # task running handle()
+        self.congested = False      # transport paused, not yet back under low water
+        self.drained = asyncio.Event()  # set while not congested
+        self.drained.set()
+        self.drainTask = None
+        self.drops = 0              # datagrams dropped by SLOW_CONSUMER_DROP
+        self.closing = False
+
+        writer.transport.set_write_buffer_limits(high=md.highWater, low=md.lowWater)
 
     async def handle(self):
-        """Handles the incoming datagrams."""
-        while True:
-            try:
+        """Handles the incoming datagrams until the connection goes away."""
+        self.task = asyncio.current_task()
+        try:
+            while True:
                 length_bytes = await self.reader.readexactly(2)
                 length = struct.unpack("<H", length_bytes)[0]
                 data = await self.reader.readexactly(length)
-                dg = Datagram(data)
                 #await self.md.handle_datagram(dg, self)
-                await self.handle_datagram(dg)
-            except (asyncio.IncompleteReadError, ConnectionResetError) as e:
-                #logger_mdclient.warning("MDClient disconnected.")
-                logger_mdclient = notify.new_category("MDClient")
-                logger_mdclient.faithfulWarning(f"MDClient disconnected. Error: {e}")
-                #self.logger.MDClient(f"MDClient disconnected. Error: {e}")
-                break
+                await self.handle_datagram(data)
+        except (asyncio.IncompleteReadError, ConnectionResetError, DatagramTruncatedError) as e:
+            #logger_mdclient.warning("MDClient disconnected.")
+            logger_mdclient = notify.new_category("MDClient")
+            logger_mdclient.faithfulWarning(f"MDClient disconnected. Error: {e}")
+            #self.logger.MDClient(f"MDClient disconnected. Error: {e}")
+        except asyncio.CancelledError:
+            if not self.closing:
+                raise
+        finally:
+            await self.md.remove_client(self)
+
+    async def onLost(self):
+        """Called by the MD once the connection is gone: replay the postRemove datagrams."""
+        for raw in self.postRemove:
+            await self.handle_datagram(raw)
 
 
     async def handle_datagram(self, dg):
-        di = DatagramIterator(dg)
-
-        count = di.getUint8()
-        channels = [di.getUint64() for _ in range(count)]
-        sender = di.getUint64()
-
-        for _ in range(count):
-            channel = di.getUint8()
-            channels.append(channel)
-
-        if count == 1 and channels[0] == msgTypes.CONTROL_MESSAGE:
-            code = di.getuint16()
-
-            if code == msgTypes.CONTROL_SET_CHANNEL:
-                new_channel = di.getUint64()
-                print(f"[CONTROL] code={code}, set channel to {new_channel}")
-                self.channels.add(new_channel)
-            
-            elif code == msgTypes.CONTROL_REMOVE_CHANNEL:
-                remove_channel = di.getUint64()
-                print(f"[CONTROL] code={code}, remove channel {remove_channel}")
-                self.channels.discard(remove_channel)  # Use discard to avoid KeyError if missing
-            
-            elif code == msgTypes.CONTROL_ADD_POST_REMOVE:
-                blob = di.getBlob()
-                self.postRemove.append(blob)
-                print(f"[CONTROL] code={code}, added post-remove blob of size {len(blob)}, contents (string): {blob.decode('utf-8')}")
-            
-            elif code == msgTypes.CONTROL_SET_CON_NAME:
-                self.connectionName = di.getString()
-                print(f"[CONTROL] code={code}, set connection name to {self.connectionName}")
-
-            elif code == msgTypes.CONTROL_SET_CON_URL:
-                self.connectionURL = di.getString()
-                print(f"[CONTROL] code={code}, set connection URL to {self.connectionURL}")
-            else:
-                raise NotImplementedError(f"Unknown CONTROL_MESSAGE code: {code}")
-            
-            print(self.connectionName, self.connectionURL, self.channels)
+        """Hands a complete datagram to the message director for routing."""
+        await self.md.handle_datagram(dg, self)
+
+    def sendDatagram(self, dg):
+        """
+        Queues a datagram routed to this participant by the message director.
+
+        :param dg: The Datagram object (or raw bytes-like datagram) to send.
+        """
+        self.sendFrame(makeFrame(dg))
+
+    def sendFrame(self, frame, lowPriority=False):
+        """
+        Queues a (length prefix, datagram) frame built once by the router.
+        Returns True while the connection is congested, so the router can
+        apply the MD's slow consumer policy.
+
+        :param frame: The frame returned by message_director.makeFrame.
+        :param lowPriority: Whether the datagram may be dropped under SLOW_CONSUMER_DROP.
+        """
+        if self.closing:
+            return False
+
+        if self.congested and lowPriority and self.md.slowPolicy == SLOW_CONSUMER_DROP:
+            self.drops += 1
+            return True
 
-        else:
-            sender = di.getUint64()
-            code = di.getUint16()
+        self.output.write(frame)
+        return self.checkCongestion()
 
-            for client in self.md.clients:
-                if client == self:
-                    continue
-                
-                if client.channels.intersection(channels):
-                    client.sendDatagram(dg)
+    def queueDepth(self):
+        """Bytes queued for this participant: corked plus buffered by the transport."""
+        return len(self.output.buffer) + self.writer.transport.get_write_buffer_size()
 
-            await self.md.otp.handle_message(channels, sender, code, Datagram(di.getRemainingBytes()))
+    def checkCongestion(self):
+        """Enter the congested state once the queue goes over the high water mark."""
+        if self.congested or self.queueDepth() < self.md.highWater:
+            return self.congested
 
+        # Hand the cork to the transport: it pauses above the high water mark
+        self.output.flush()
+        if self.writer.transport.get_write_buffer_size() <= self.md.highWater:
+            return False
 
+        self.congested = True
+        self.drained.clear()
+        if self.md.slowPolicy == SLOW_CONSUMER_DISCONNECT:
+            self.disconnect()
+            return False
 
+        self.drainTask = asyncio.get_running_loop().create_task(self.waitDrained())
+        return True
+
+    async def waitDrained(self):
+        """Leave the congested state once the transport resumes, under the low water mark."""
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+        self.congested = False
+        self.drained.set()
+        self.drainTask = None
+
+    def disconnect(self):
+        """Kick this participant, dropping what it has not read; handle() cleans up."""
+        print(f"[MD] Disconnecting slow consumer: {self.getName()}")
+        self.closing = True
+        self.drained.set()
+        self.writer.transport.abort()
+        if self.task:
+            self.task.cancel()
+
+    def getName(self):
+        """Name used to report this connection (CONTROL_SET_CON_NAME), as MDClient.getName."""
+        return self.connectionName or f"{self.addr[0]}:{self.addr[1]}"
 
     async def _read_exactly(self, length):
         data = b""
@@ -108,104 +254,207 @@ class AsyncMDClient:
 
     async def send_datagram(self, dg):
         """
-        Serializes and sends a datagram to the server asynchronously.
+        Queues a datagram to the server; it goes out with the rest of this
+        tick's output in one write.
 
         :param dg: The Datagram object to send.
         """
         try:
-            # Serialize the datagram to bytes
-            datagram_bytes = bytes(dg)
-            # Send the length of the datagram followed by the datagram bytes
-            self.writer.write(struct.pack("<H", len(datagram_bytes)) + datagram_bytes)
-            await self.writer.drain()  # Ensure the data is sent before continuing
-            self.logger.info(f"[AsyncMDClient] Sent datagram: {datagram_bytes}")
+            self.output.write(makeFrame(dg))
         except Exception as e:
             self.logger.error(f"[AsyncMDClient] Error sending datagram: {e}")
-            await self.close()
-
-    async def close(self):
-        """Closes the connection."""
-        if self.writer:
-            self.writer.close()
-            await self.writer.wait_closed()
-            self.logger.info("[AsyncMDClient] Connection closed.")
-
-class AsyncCAClient:
-    def __init__(self, ca, logger):
+            self.close()
+
+    def close(self):
+        """Flush what is corked and close the connection."""
+        if not self.closing:
+            self.closing = True
+            self.output.flush()
+        self.drained.set()
+        if self.drainTask is not None:
+            self.drainTask.cancel()
+            self.drainTask = None
+        self.writer.close()
+
+class AsyncCAClient(asyncio.BufferedProtocol):
+    """
+    One game client connection to the Client Agent, and its session.
+
+    Client datagrams arrive as <uint16 length><uint16 msgType><payload>
+    frames. They are received straight into a FrameBuffer and handed in
+    place to the CA, which dispatches them through the msgType table of the
+    session's state. Sessions use __slots__ and need no task of their own,
+    so one CA process can hold tens of thousands of them.
+    """
+
+    __slots__ = ("ca", "transport", "output", "frames", "address", "handlers",
+                 "channel", "accountId", "avatarId", "closing", "max_latency", "max_batch",
+                 "heartbeatTimer", "loginTimer", "anonymousTimer", "parent", "zone", "zones",
+                 "pendingUpdates", "updateHandle")
+
+    def __init__(self, ca, max_latency=0.0, max_batch=256):
         """
-        Initializes the AsyncCAClient.
-
-        :param ca: The client agent instance to handle incoming data from the CA server.
-        :param logger: Logger instance for logging messages.
+        :param ca: The client agent handling this session's datagrams.
+        :param max_latency: Seconds an outgoing datagram may stay corked, 0 for end of tick.
+        :param max_batch: Maximum number of datagrams coalesced into one write.
         """
         self.ca = ca
         self.transport = None
-        self.logger = logger
+        self.output = None
+        self.frames = FrameBuffer(CLIENT_BUFFER_SIZE, CLIENT_BUFFER_SIZE // 4)
+        self.address = None
+        self.handlers = ca.anonymousHandlers  # msgType -> handler, swapped on login
+        self.channel = 0
+        self.accountId = 0
+        self.avatarId = 0
+        self.closing = False
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.heartbeatTimer = None  # TimerEntry of the CA's timing wheel
+        self.loginTimer = None
+        self.anonymousTimer = None
+        self.parent = 0             # shard, zone in it and the zones watched from there
+        self.zone = 0
+        self.zones = EMPTY
+        self.pendingUpdates = None  # coalesced field updates: key -> latest frame
+        self.updateHandle = None
 
     def connection_made(self, transport):
         """Handles a new connection from a client."""
         self.transport = transport
-        self.ca.clients.append(self)
-        peername = transport.get_extra_info("peername")
-        self.logger.info(f"[CA] Connection from {peername}")
+        self.output = CorkedWriter(transport, self.max_latency, self.max_batch)
+        self.address = transport.get_extra_info("peername")
+        self.ca.addSession(self)
+
+    def get_buffer(self, sizehint):
+        return self.frames.writable()
 
-    def data_received(self, data):
-        """Handles incoming data from the CA server."""
-        # Handle data from the server if needed (currently a placeholder)
-        self.logger.debug(f"[CA] Data received: {data}")
-        # Further CA protocol handling logic goes here
+    def buffer_updated(self, nbytes):
+        """Dispatch every complete datagram received."""
+        self.frames.commit(nbytes)
+        try:
+            for frame in self.frames.frames():
+                if self.closing:
+                    break
+
+                self.ca.handleClientDatagram(self, frame)
+        except DatagramTruncatedError as e:
+            self.ca.logger.warning("Truncated datagram from %s: %s", self.address, e)
+            self.disconnect(e.code, "Truncated datagram")
 
     def connection_lost(self, exc):
         """Handles when a connection is lost."""
-        self.ca.clients.remove(self)
-        self.logger.info("[CA] Client disconnected")
+        self.closing = True
+        if self.output.handle is not None:
+            self.output.handle.cancel()
+            self.output.handle = None
 
-    async def send_datagram(self, dg):
+        if self.updateHandle is not None:
+            self.updateHandle.cancel()
+            self.updateHandle = None
+        self.pendingUpdates = None
+
+        self.ca.removeSession(self)
+
+    def sendDatagram(self, dg):
         """
-        Sends a datagram asynchronously to the client agent server.
+        Queues a datagram for the client; it goes out with the rest of this
+        tick's output in one write.
 
-        :param dg: The Datagram object to send.
+        :param dg: The Datagram object (or raw bytes-like datagram) to send.
         """
-        try:
-            # Serialize the datagram into bytes
-            datagram_bytes = bytes(dg)
-            # Send the length of the datagram followed by the datagram itself
-            self.transport.write(struct.pack("<H", len(datagram_bytes)) + datagram_bytes)
-            await self.transport.drain()  # Ensure data is sent before continuing
-            self.logger.info(f"[AsyncCAClient] Sent datagram: {datagram_bytes}")
-        except Exception as e:
-            self.logger.error(f"[AsyncCAClient] Error sending datagram: {e}")
+        self.sendFrame(makeFrame(dg))
+
+    def sendFrame(self, frame):
+        """Queues a (length prefix, datagram) frame, possibly shared with other sessions."""
+        if self.closing:
+            return
+
+        if self.pendingUpdates:
+            # Coalesced updates were queued first, keep them ahead of this
+            self.writeUpdates()
+
+        self.output.write(frame)
+
+    def queueUpdate(self, key, frame, window):
+        """
+        Queue a field update frame for up to window seconds, during which a
+        later update with the same key (doId, field) replaces it in place.
+        Returns True if it replaced one.
+        """
+        if self.closing:
+            return False
+
+        pending = self.pendingUpdates
+        if pending is None:
+            pending = self.pendingUpdates = {}
+            self.updateHandle = asyncio.get_running_loop().call_later(window, self.flushUpdates)
+
+        replaced = key in pending
+        pending[key] = frame
+        return replaced
+
+    def writeUpdates(self):
+        """Cork the coalesced updates behind what was queued before them."""
+        if self.updateHandle is not None:
+            self.updateHandle.cancel()
+            self.updateHandle = None
+
+        pending, self.pendingUpdates = self.pendingUpdates, None
+        for frame in pending.values():
+            self.output.write(frame)
+
+    def flushUpdates(self):
+        """End of the coalescing window: send the surviving updates in one write."""
+        self.updateHandle = None
+        if self.closing or not self.pendingUpdates:
+            return
+
+        self.writeUpdates()
+        self.output.flush()
+
+    def disconnect(self, reason, message=""):
+        """
+        Tell the client why with CLIENT_GO_GET_LOST, then close the connection
+        once it is written.
+        """
+        if self.closing:
+            return
+
+        dg = Datagram()
+        dg.addUint16(msgTypes.CLIENT_GO_GET_LOST)
+        dg.addUint16(reason)
+        dg.addString(message)
+        self.output.write(makeFrame(dg))
+        self.close()
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self.output.flush()
             self.transport.close()
 
 
 class AsyncServer:
-    def __init__(self, message_director, client_agent, logger):
+    def __init__(self, message_director, client_agent, logger, max_latency=0.0, max_batch=256):
         self.md = message_director
         self.ca = client_agent
         self.logger = logger
 
+        # Output coalescing for every MD / CA connection
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+
 
     async def handle_md_connection(self, reader: StreamReader, writer: StreamWriter):
         #self.logger.info("[MD] New MD client connected.")
         logger_mdclient = notify.new_category("MDClient")
         logger_mdclient.faithfulDebug("[MD] New MD client connected.")
-        md_client = AsyncMDClient(reader, writer, self.md, self.logger)
+        md_client = AsyncMDClient(reader, writer, self.md, self.logger,
+                                  self.max_latency, self.max_batch)
+        self.md.clients[md_client.fd] = md_client
         await md_client.handle()
     
-    async def handle_ca_connection(self, reader: StreamReader, writer: StreamWriter):
-        """Handle new connections to the CA server."""
-        logger_caclient = notify.new_category("CAClient")
-        logger_caclient.faithfulDebug("[CA] New CA client connected.")
-        ca_client = AsyncCAClient(self.ca, self.logger)
-        ca_client.connection_made(writer)  # Simulate connection being made
-
-        await ca_client.send_datagram(Datagram("Hello CA"))  # Example of sending a datagram
-        await asyncio.sleep(1)  # Wait a bit to ensure communication
-    
-    
-
-        
-        
     async def run(self):
         """Starts both MD and CA servers."""
         # Start MD socket
@@ -220,8 +469,9 @@ class AsyncServer:
         logger_ca = notify.new_category("CAServer")
         logger_ca.faithfulDebug("Starting CA listener...")
         #self.logger.info("Starting CA listener...")
-        self.ca_server = await asyncio.start_server(
-            self.handle_ca_connection, "127.0.0.1", 7101
+        loop = asyncio.get_running_loop()
+        self.ca_server = await loop.create_server(
+            lambda: AsyncCAClient(self.ca, self.max_latency, self.max_batch), "127.0.0.1", 7101
         )
 
         # Start both servers
@@ -0,0 +1,111 @@
+"""
+Microbenchmark of the precompiled dc_codecs against Panda's DCPacker.
+
+Reads a DC file, checks that every field with a codec packs its sample
+arguments to the same bytes as DCPacker, then times packing and unpacking
+each of those fields both ways.
+
+Run from the repository root:
+    python -m core_components.test_scripts.dc_codec_benchmark path/to/otp.dc [iterations]
+"""
+
+import sys
+import time
+
+from panda3d.direct import DCPacker
+
+from core_components.dc_tables import ST_BLOB, ST_FLOAT64, ST_STRING
+from core_components.network_manager import NetworkDCLoader
+
+
+def sampleValue(elementType, divisor, fixedSize):
+    if elementType == ST_STRING:
+        return "Toontown"[:fixedSize].ljust(fixedSize, "!") if fixedSize else "Toontown"
+    if elementType == ST_BLOB:
+        return bytes(range(1, (fixedSize or 4) + 1))
+    if divisor > 1 or elementType == ST_FLOAT64:
+        return 1.5
+    return 7
+
+
+def dcPack(packer, field, values):
+    packer.begin_pack(field)
+    field.pack_args(packer, values)
+    packer.end_pack()
+    data = packer.get_bytes()
+    packer.clear_data()
+    return data
+
+
+def dcUnpack(packer, field, data):
+    packer.set_unpack_data(data)
+    packer.begin_unpack(field)
+    values = field.unpack_args(packer)
+    packer.end_unpack()
+    return values
+
+
+def timeIt(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return time.perf_counter() - start
+
+
+def main(path, iterations):
+    loader = NetworkDCLoader()
+    loader.read_dc_files([path], cache_file="")
+    dcFile = loader.dc_file
+    codecs = loader.field_codecs
+
+    elementsByField = {}
+    for classInfo in loader.class_table.values():
+        for fieldInfo in classInfo.fields:
+            if fieldInfo.number in codecs:
+                elementsByField[fieldInfo.number] = fieldInfo.elements
+
+    packer = DCPacker()
+    cases = []
+    mismatched = 0
+    for number, codec in sorted(codecs.items()):
+        field = dcFile.get_field_by_index(number)
+        values = tuple(sampleValue(*element) for element in elementsByField[number])
+        try:
+            expected = dcPack(packer, field, values)
+        except Exception as e:
+            print(f"skipping {codec.name}: DCPacker could not pack {values}: {e}")
+            continue
+
+        if codec.pack(values) != expected:
+            print(f"MISMATCH {codec.name}: {codec.pack(values).hex()} != {expected.hex()}")
+            mismatched += 1
+            continue
+
+        cases.append((field, codec, values, expected))
+
+    print(f"{len(codecs)} of {sum(len(c.fields) for c in loader.class_table.values())} "
+          f"inherited fields have a codec, {len(cases)} benchmarked, {mismatched} mismatched")
+    if not cases:
+        return 1 if mismatched else 0
+
+    totals = {"DCPacker pack": 0.0, "codec pack": 0.0, "DCPacker unpack": 0.0, "codec unpack": 0.0}
+    for field, codec, values, data in cases:
+        totals["DCPacker pack"] += timeIt(lambda: dcPack(packer, field, values), iterations)
+        totals["codec pack"] += timeIt(lambda: codec.pack(values), iterations)
+        totals["DCPacker unpack"] += timeIt(lambda: dcUnpack(packer, field, data), iterations)
+        totals["codec unpack"] += timeIt(lambda: codec.unpack_from(data), iterations)
+
+    calls = len(cases) * iterations
+    for name, total in totals.items():
+        print(f"{name:16} {total / calls * 1e9:8.0f} ns/call")
+
+    print(f"pack speedup   {totals['DCPacker pack'] / totals['codec pack']:.1f}x")
+    print(f"unpack speedup {totals['DCPacker unpack'] / totals['codec unpack']:.1f}x")
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+
+    sys.exit(main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10000))
@@ -0,0 +1,144 @@
+"""
+Localhost multi-process check of MD federation.
+
+Starts an upstream MD and two downstream node MDs (one process each), then
+connects plain participants to the nodes and checks that:
+ - a datagram sent on node A reaches a subscriber on node B through the hub,
+ - a datagram whose only subscribers are on node A never reaches the hub,
+ - a subscriber leaving on node B stops the traffic crossing from node A.
+
+Run from the repository root:
+    python -m core_components.test_scripts.md_federation_harness [base port]
+The MDs listen on base port (the hub, 7190 by default) and the next two ports.
+"""
+
+import asyncio
+import multiprocessing
+import struct
+import sys
+import time
+
+from core_components import msgTypes
+from core_components.datagram import Datagram
+from core_components.message_director import MessageDirector
+from core_components.message_director_federation import runNode
+
+HOST = "127.0.0.1"
+
+
+class CountingOTP:
+    """OTP core stand-in counting the datagrams its MD routed."""
+
+    def __init__(self, routed):
+        self.routed = routed
+
+    async def handle_message(self, channels, sender, code, dg):
+        with self.routed.get_lock():
+            self.routed.value += 1
+
+
+def mdMain(port, upstream, routed):
+    md = MessageDirector(CountingOTP(routed))
+    try:
+        asyncio.run(runNode(md, HOST, port, upstream, retryDelay=0.2))
+    except KeyboardInterrupt:
+        pass
+
+
+class Participant:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port):
+        reader, writer = await asyncio.open_connection(HOST, port)
+        return cls(reader, writer)
+
+    def send(self, dg):
+        payload = dg.getMessage()
+        self.writer.write(struct.pack("<H", len(payload)) + payload)
+
+    def control(self, code, channel):
+        dg = Datagram()
+        dg.addUint8(1)
+        dg.addUint64(msgTypes.CONTROL_MESSAGE)
+        dg.addUint16(code)
+        dg.addUint64(channel)
+        self.send(dg)
+
+    def message(self, channel, text):
+        dg = Datagram()
+        dg.addUint8(1)
+        dg.addUint64(channel)
+        dg.addUint64(1234)
+        dg.addUint16(1)
+        dg.appendData(text.encode())
+        self.send(dg)
+
+    async def receive(self, timeout=1.0):
+        """Returns the next datagram payload, or None if nothing came."""
+        try:
+            size, = struct.unpack("<H", await asyncio.wait_for(self.reader.readexactly(2), timeout))
+            return await self.reader.readexactly(size)
+        except asyncio.TimeoutError:
+            return None
+
+
+async def check(hubRouted, nodeA, nodeB):
+    a = await Participant.connect(nodeA)
+    a2 = await Participant.connect(nodeA)
+    b = await Participant.connect(nodeB)
+
+    b.control(msgTypes.CONTROL_SET_CHANNEL, 5000)  # only on node B
+    a2.control(msgTypes.CONTROL_SET_CHANNEL, 6000)  # only on node A
+    await asyncio.sleep(0.5)
+
+    a.message(5000, "cross node")
+    assert await b.receive() is not None, "cross-node datagram was not delivered"
+    print("OK: cross-node datagram delivered through the hub")
+
+    before = hubRouted.value
+    a.message(6000, "node local")
+    assert await a2.receive() is not None, "node-local datagram was not delivered"
+    await asyncio.sleep(0.3)
+    assert hubRouted.value == before, "node-local datagram was forwarded to the hub"
+    print("OK: node-local datagram stayed on its node")
+
+    b.control(msgTypes.CONTROL_REMOVE_CHANNEL, 5000)
+    await asyncio.sleep(0.5)
+    before = hubRouted.value
+    a.message(5000, "nobody left")
+    await asyncio.sleep(0.3)
+    assert hubRouted.value == before, "datagram crossed after its last remote subscriber left"
+    print("OK: interest withdrawn once the last remote subscriber left")
+
+    for participant in (a, a2, b):
+        participant.writer.close()
+
+
+def main(hubPort=7190):
+    nodeA, nodeB = hubPort + 1, hubPort + 2
+    context = multiprocessing.get_context("fork")
+    hubRouted = context.Value("i", 0)
+    processes = [
+        context.Process(target=mdMain, args=(hubPort, None, hubRouted)),
+        context.Process(target=mdMain, args=(nodeA, (HOST, hubPort), context.Value("i", 0))),
+        context.Process(target=mdMain, args=(nodeB, (HOST, hubPort), context.Value("i", 0))),
+    ]
+    processes[0].start()
+    time.sleep(0.3)
+    for process in processes[1:]:
+        process.start()
+    time.sleep(0.5)
+
+    try:
+        asyncio.run(check(hubRouted, nodeA, nodeB))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,189 @@
+"""
+Localhost multi-process check of the MD worker mode.
+
+Starts two MD workers (one process each) linked by the worker bus, each on
+a port of its own so the check knows which worker every participant is on,
+then checks that:
+ - a datagram sent on worker A reaches a subscriber on worker B, for exact
+   channels and ranges,
+ - a datagram whose only subscribers are on worker A is never forwarded,
+ - unsubscribing, removing a range or disconnecting on worker B stops the
+   forwarding from worker A,
+ - with the block slow consumer policy, floods in both directions to slow
+   subscribers (each worker waiting on its bus link to the other) all
+   arrive in order once the subscribers read.
+
+Run from the repository root:
+    python -m core_components.test_scripts.md_workers_harness [base port]
+The workers listen on base port (7290 by default) and the next one.
+"""
+
+import asyncio
+import multiprocessing
+import sys
+import time
+
+from core_components import msgTypes
+from core_components.datagram import Datagram
+from core_components.message_director import SLOW_CONSUMER_BLOCK, MessageDirector
+from core_components.message_director_workers import WorkerBus, closeLinks, workerLinks
+from core_components.test_scripts.md_federation_harness import HOST, Participant
+
+# Small queues, so the floods congest the bus links quickly
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+FLOOD_COUNT = 20000
+FLOOD_FILL = "x" * 2000
+HEADER_SIZE = 1 + 8 + 8 + 2  # one channel, sender, msgType
+
+
+class NullOTP:
+    async def handle_message(self, channels, sender, code, dg):
+        pass
+
+
+class CountingMD(MessageDirector):
+    """MD worker counting the datagrams the other worker forwarded to it."""
+
+    def __init__(self, forwarded):
+        MessageDirector.__init__(self, NullOTP(), highWater=HIGH_WATER, lowWater=LOW_WATER,
+                                 slowPolicy=SLOW_CONSUMER_BLOCK)
+        self.forwarded = forwarded
+
+    async def route_datagram(self, dg, channels, sender, di, client=None, localOnly=False):
+        if localOnly:
+            with self.forwarded.get_lock():
+                self.forwarded.value += 1
+
+        await MessageDirector.route_datagram(self, dg, channels, sender, di, client, localOnly)
+
+
+def workerMain(index, peerSockets, port, forwarded):
+    async def run():
+        md = CountingMD(forwarded)
+        WorkerBus(md, index, peerSockets).start()
+        await md.start(HOST, port, reusePort=True)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+class BusParticipant(Participant):
+    def controlRange(self, code, low, high):
+        dg = Datagram()
+        dg.addUint8(1)
+        dg.addUint64(msgTypes.CONTROL_MESSAGE)
+        dg.addUint16(code)
+        dg.addUint64(low)
+        dg.addUint64(high)
+        self.send(dg)
+
+
+async def assertNotForwarded(forwarded, send, message):
+    before = forwarded.value
+    send()
+    await asyncio.sleep(0.3)
+    assert forwarded.value == before, message
+
+
+async def checkRouting(forwarded, portA, portB):
+    a = await BusParticipant.connect(portA)
+    a2 = await BusParticipant.connect(portA)
+    b = await BusParticipant.connect(portB)
+    b2 = await BusParticipant.connect(portB)
+
+    b.control(msgTypes.CONTROL_SET_CHANNEL, 5000)  # only on worker B
+    b.controlRange(msgTypes.CONTROL_ADD_RANGE, 9000, 9010)
+    b2.control(msgTypes.CONTROL_SET_CHANNEL, 5001)
+    a2.control(msgTypes.CONTROL_SET_CHANNEL, 6000)  # only on worker A
+    await asyncio.sleep(0.5)
+
+    a.message(5000, "cross worker")
+    assert await b.receive() is not None, "cross-worker datagram was not delivered"
+    a.message(9005, "cross worker range")
+    assert await b.receive() is not None, "cross-worker datagram to a range was not delivered"
+    print("OK: cross-worker datagrams delivered over the bus")
+
+    await assertNotForwarded(forwarded[1], lambda: a.message(6000, "worker local"),
+                             "worker-local datagram was forwarded")
+    assert await a2.receive() is not None, "worker-local datagram was not delivered"
+    print("OK: worker-local datagram stayed on its worker")
+
+    b.control(msgTypes.CONTROL_REMOVE_CHANNEL, 5000)
+    b.controlRange(msgTypes.CONTROL_REMOVE_RANGE, 9000, 9010)
+    b2.writer.close()
+    await asyncio.sleep(0.5)
+    for channel in (5000, 9005, 5001):
+        await assertNotForwarded(forwarded[1], lambda: a.message(channel, "nobody left"),
+                                 f"datagram to {channel} forwarded after its subscriber left")
+    print("OK: interest withdrawn on unsubscribe, range removal and disconnect")
+
+    for participant in (a, a2, b):
+        participant.writer.close()
+
+
+async def flood(sender, channel):
+    for sequence in range(FLOOD_COUNT):
+        sender.message(channel, f"{sequence:06d}{FLOOD_FILL}")
+        await sender.writer.drain()
+
+
+async def receiveFlood(receiver):
+    for sequence in range(FLOOD_COUNT):
+        payload = await receiver.receive(timeout=10.0)
+        assert payload is not None, f"flood stalled after {sequence} datagrams"
+        received = int(payload[HEADER_SIZE:HEADER_SIZE + 6])
+        assert received == sequence, f"datagram {received} arrived in place of {sequence}"
+
+
+async def checkBlock(portA, portB):
+    slowA = await BusParticipant.connect(portA)
+    slowB = await BusParticipant.connect(portB)
+    a = await BusParticipant.connect(portA)
+    b = await BusParticipant.connect(portB)
+
+    slowA.control(msgTypes.CONTROL_SET_CHANNEL, 7001)
+    slowB.control(msgTypes.CONTROL_SET_CHANNEL, 7002)
+    await asyncio.sleep(0.5)
+
+    # Each worker forwards a flood to a slow subscriber on the other one, so
+    # both bus links congest and each worker waits on the other's drain
+    floods = [asyncio.create_task(flood(a, 7002)), asyncio.create_task(flood(b, 7001))]
+    await asyncio.sleep(1.0)
+    assert not any(task.done() for task in floods), "the floods were not held back"
+
+    await asyncio.wait_for(asyncio.gather(receiveFlood(slowA), receiveFlood(slowB)), 120)
+    await asyncio.wait_for(asyncio.gather(*floods), 10)
+    print(f"OK: block policy held back both floods, {FLOOD_COUNT} datagrams each way arrived in order")
+
+    for participant in (slowA, slowB, a, b):
+        participant.writer.close()
+
+
+def main(basePort=7290):
+    ports = (basePort, basePort + 1)
+    context = multiprocessing.get_context("fork")
+    forwarded = [context.Value("i", 0) for _ in ports]
+
+    links = workerLinks(len(ports))
+    processes = [context.Process(target=workerMain, args=(index, links[index], port, forwarded[index]))
+                 for index, port in enumerate(ports)]
+    for process in processes:
+        process.start()
+    closeLinks(links)
+    time.sleep(0.5)
+
+    try:
+        asyncio.run(checkRouting(forwarded, *ports))
+        asyncio.run(checkBlock(*ports))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
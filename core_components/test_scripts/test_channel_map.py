@@ -0,0 +1,154 @@
+"""
+Checks of the ChannelMap range index: overlapping and adjacent ranges,
+removals splitting a range, the segments reported as changed, and a
+randomized comparison against a brute-force model.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_channel_map.py
+"""
+
+import random
+import unittest
+
+from core_components.channel_map import CHANNEL_MAX, ChannelMap
+
+
+class Participant:
+    def __init__(self, name):
+        self.name = name
+        self.channels = set()
+
+    def __repr__(self):
+        return self.name
+
+
+class TestChannelMap(unittest.TestCase):
+    def setUp(self):
+        self.map = ChannelMap()
+        self.p = Participant("p")
+        self.q = Participant("q")
+
+    def assertSegmentsMerged(self):
+        segments = self.map._segments
+        for i in range(1, len(segments)):
+            self.assertNotEqual(segments[i], segments[i - 1], "adjacent segments left unmerged")
+
+    def test_exact_channels(self):
+        self.assertEqual(self.map.subscribe(self.p, 5), {self.p})
+        self.assertEqual(self.map.subscribe(self.q, 5), {self.p, self.q})
+        self.assertEqual(self.map.lookup([5, 6]), {self.p, self.q})
+
+        self.assertEqual(self.map.unsubscribe(self.p, 5), {self.q})
+        self.assertEqual(self.map.unsubscribe(self.q, 5), set())
+        self.assertFalse(self.map.is_subscribed(5))
+        self.assertEqual(len(self.map), 0)
+
+    def test_overlapping_and_adjacent_ranges_merge(self):
+        self.map.add_range(self.p, 10, 20)
+        self.map.add_range(self.p, 15, 30)
+        self.map.add_range(self.p, 31, 40)
+        self.map.add_range(self.p, 50, 60)
+
+        self.assertEqual(self.map.get_ranges(self.p), [(10, 40), (50, 60)])
+        self.assertEqual(list(self.map.range_items()), [(10, 40, {self.p}), (50, 60, {self.p})])
+        self.assertSegmentsMerged()
+
+    def test_remove_overlapping_range(self):
+        self.map.add_range(self.p, 10, 20)
+        self.map.add_range(self.q, 15, 30)
+
+        changed = self.map.remove_range(self.p, 12, 25)
+
+        self.assertEqual(changed, [(12, 14, set()), (15, 20, {self.q})])
+        self.assertEqual(self.map.get_ranges(self.p), [(10, 11)])
+        self.assertEqual(self.map.get_ranges(self.q), [(15, 30)])
+        self.assertEqual(self.map.lookup([11]), {self.p})
+        self.assertEqual(self.map.lookup([12]), set())
+        self.assertEqual(self.map.lookup([15]), {self.q})
+        self.assertEqual(list(self.map.range_items()), [(10, 11, {self.p}), (15, 30, {self.q})])
+        self.assertSegmentsMerged()
+
+    def test_remove_splits_a_range(self):
+        self.map.add_range(self.p, 0, 100)
+        self.map.remove_range(self.p, 40, 60)
+
+        self.assertEqual(self.map.get_ranges(self.p), [(0, 39), (61, 100)])
+        self.assertFalse(self.map.is_subscribed(50))
+        self.assertTrue(self.map.is_subscribed(61))
+
+    def test_remove_spanning_several_ranges(self):
+        for low in (10, 30, 50):
+            self.map.add_range(self.p, low, low + 5)
+
+        self.map.remove_range(self.p, 12, 52)
+        self.assertEqual(self.map.get_ranges(self.p), [(10, 11), (53, 55)])
+
+        self.map.remove_range(self.p, 0, CHANNEL_MAX)
+        self.assertEqual(self.map.get_ranges(self.p), [])
+        self.assertEqual(list(self.map.range_items()), [])
+        self.assertEqual(self.map._bounds, [0])
+
+    def test_range_up_to_channel_max(self):
+        self.map.add_range(self.p, CHANNEL_MAX - 1, CHANNEL_MAX)
+        self.assertEqual(self.map.lookup([CHANNEL_MAX]), {self.p})
+        self.assertEqual(list(self.map.range_items()), [(CHANNEL_MAX - 1, CHANNEL_MAX, {self.p})])
+
+    def test_invalid_range(self):
+        with self.assertRaises(ValueError):
+            self.map.add_range(self.p, 5, 4)
+        with self.assertRaises(ValueError):
+            self.map.remove_range(self.p, 0, CHANNEL_MAX + 1)
+
+    def test_unsubscribe_all(self):
+        self.map.subscribe(self.p, 1)
+        self.map.add_range(self.p, 10, 20)
+        self.map.add_range(self.q, 15, 25)
+
+        self.map.unsubscribe_all(self.p)
+        self.assertEqual(self.map.lookup([1, 10, 15]), {self.q})
+        self.assertEqual(self.p.channels, set())
+
+    def test_random_against_brute_force(self):
+        rng = random.Random(2)
+        participants = [Participant(f"p{i}") for i in range(4)]
+        exact = {participant: set() for participant in participants}
+        covered = {participant: set() for participant in participants}
+
+        for _ in range(2000):
+            participant = rng.choice(participants)
+            low = rng.randrange(100)
+            high = min(99, low + rng.randrange(20))
+            op = rng.randrange(4)
+            if op == 0:
+                self.map.add_range(participant, low, high)
+                covered[participant].update(range(low, high + 1))
+            elif op == 1:
+                self.map.remove_range(participant, low, high)
+                covered[participant].difference_update(range(low, high + 1))
+            elif op == 2:
+                self.map.subscribe(participant, low)
+                exact[participant].add(low)
+            else:
+                self.map.unsubscribe(participant, low)
+                exact[participant].discard(low)
+
+            channel = rng.randrange(101)
+            expected = {p for p in participants if channel in exact[p] or channel in covered[p]}
+            self.assertEqual(self.map.lookup([channel]), expected)
+
+        for channel in range(101):
+            expected = {p for p in participants if channel in exact[p] or channel in covered[p]}
+            self.assertEqual(self.map.lookup([channel]), expected)
+            self.assertEqual(self.map.is_subscribed(channel), bool(expected))
+
+        for participant in participants:
+            ranges = self.map.get_ranges(participant)
+            self.assertEqual({c for low, high in ranges for c in range(low, high + 1)}, covered[participant])
+            for (_, high), (low, _) in zip(ranges, ranges[1:]):
+                self.assertGreater(low, high + 1, "touching ranges left unmerged")
+
+        self.assertSegmentsMerged()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+"""
+Checks of the NumPy header decoding of datagram_batch against
+DatagramIterator: a buffer of mixed frames (zero, one and several channels,
+control messages, headers cut short) and a truncated trailing frame. Needs
+NumPy.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_datagram_batch.py
+"""
+
+import random
+import struct
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from core_components import msgTypes
+from core_components.datagram import Datagram, DatagramIterator, DatagramTruncatedError
+
+if numpy is not None:
+    from core_components.datagram_batch import decodeHeaders, frameOffsets
+
+
+def routed(channels, sender, msgType, payload=b""):
+    dg = Datagram()
+    dg.addUint8(len(channels))
+    for channel in channels:
+        dg.addUint64(channel)
+    dg.addUint64(sender)
+    dg.addUint16(msgType)
+    dg.appendData(payload)
+    return bytes(dg.getMessage())
+
+
+def control(code, channel):
+    dg = Datagram()
+    dg.addUint8(1)
+    dg.addUint64(msgTypes.CONTROL_MESSAGE)
+    dg.addUint16(code)
+    dg.addUint64(channel)
+    return bytes(dg.getMessage())
+
+
+def frame(datagram):
+    return struct.pack("<H", len(datagram)) + datagram
+
+
+def referenceHeader(datagram):
+    """(channel_count, first_channel, sender, msg_type) read with a DatagramIterator, 0 where cut short."""
+    count = firstChannel = sender = msgType = 0
+    di = DatagramIterator(datagram)
+    try:
+        count = di.getUint8()
+        if count:
+            firstChannel = di.getUint64()
+            for _ in range(count - 1):
+                di.getUint64()
+
+        if count == 1 and firstChannel == msgTypes.CONTROL_MESSAGE:
+            msgType = di.getUint16()
+        else:
+            sender = di.getUint64()
+            msgType = di.getUint16()
+    except DatagramTruncatedError:
+        pass
+
+    return count, firstChannel, sender, msgType
+
+
+DATAGRAMS = [
+    routed([4000], 1, msgTypes.STATESERVER_OBJECT_UPDATE_FIELD, b"\x01\x02\x03"),
+    routed([], 7, msgTypes.STATESERVER_OBJECT_UPDATE_FIELD),
+    routed([1 << 63, 2, 0xFFFFFFFFFFFFFFFF], 9, 0xFFFF, b"payload"),
+    control(msgTypes.CONTROL_SET_CHANNEL, 4000),
+    b"",
+    b"\x02" + struct.pack("<Q", 55),          # two channels announced, one present
+    routed([12], 34, 56)[:-1],                # msgType cut short
+    b"\x01" + struct.pack("<Q", msgTypes.CONTROL_MESSAGE),  # control code missing
+    routed([5] * 200, 3, 4, b"x" * 300),
+]
+
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class TestDatagramBatch(unittest.TestCase):
+    def assertMatchesIterator(self, buffer, datagrams):
+        headers = decodeHeaders(buffer)
+        self.assertEqual(len(headers), len(datagrams))
+
+        offset = 0
+        for row, datagram in zip(headers, datagrams):
+            offset += 2
+            self.assertEqual(int(row["offset"]), offset)
+            self.assertEqual(int(row["length"]), len(datagram))
+            self.assertEqual(bytes(buffer[offset:offset + len(datagram)]), datagram)
+
+            count, firstChannel, sender, msgType = referenceHeader(datagram)
+            with self.subTest(datagram=datagram[:24]):
+                self.assertEqual(int(row["channel_count"]), count)
+                self.assertEqual(int(row["first_channel"]), firstChannel)
+                self.assertEqual(int(row["sender"]), sender)
+                self.assertEqual(int(row["msg_type"]), msgType)
+            offset += len(datagram)
+
+    def test_mixed_frames(self):
+        buffer = b"".join(frame(dg) for dg in DATAGRAMS)
+        self.assertMatchesIterator(buffer, DATAGRAMS)
+
+        headers = decodeHeaders(buffer)
+        self.assertEqual(int(headers[3]["msg_type"]), msgTypes.CONTROL_SET_CHANNEL)
+        self.assertEqual(int(headers[3]["sender"]), 0)
+
+    def test_truncated_trailing_frame(self):
+        complete = b"".join(frame(dg) for dg in DATAGRAMS[:3])
+        partial = frame(routed([1, 2], 3, 4))[:10]
+        buffer = complete + partial
+
+        offsets, lengths, end = frameOffsets(buffer)
+        self.assertEqual(len(offsets), 3)
+        self.assertEqual(list(lengths), [len(dg) for dg in DATAGRAMS[:3]])
+        self.assertEqual(end, len(complete))
+        self.assertMatchesIterator(buffer, DATAGRAMS[:3])
+
+    def test_lone_length_byte(self):
+        offsets, lengths, end = frameOffsets(b"\x05")
+        self.assertEqual((len(offsets), len(lengths), end), (0, 0, 0))
+        self.assertEqual(len(decodeHeaders(b"")), 0)
+
+    def test_random_against_iterator(self):
+        rng = random.Random(6)
+        datagrams = []
+        for _ in range(500):
+            kind = rng.randrange(4)
+            if kind == 0:
+                datagram = control(msgTypes.CONTROL_REMOVE_CHANNEL, rng.getrandbits(64))
+            else:
+                channels = [rng.getrandbits(64) for _ in range(rng.randrange(5))]
+                datagram = routed(channels, rng.getrandbits(64), rng.getrandbits(16),
+                                  bytes(rng.randrange(256) for _ in range(rng.randrange(20))))
+            if kind == 3:
+                datagram = datagram[:rng.randrange(len(datagram))]
+            datagrams.append(datagram)
+
+        buffer = bytearray(b"".join(frame(dg) for dg in datagrams))
+        self.assertMatchesIterator(buffer, datagrams)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Round trips of the precompiled dc_codecs against Panda's DCPacker.
+
+Parses a small DC file with fixed-size string(8) / blob(8) parameters, which
+DCPacker packs without a length prefix, next to variable-size and scaled
+ones, and checks that each codec packs to DCPacker's bytes and that each side
+unpacks what the other packed. Needs Panda3D.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_dc_codecs.py
+"""
+
+import os
+import struct
+import tempfile
+import unittest
+
+try:
+    from panda3d.core import Filename
+    from panda3d.direct import DCFile, DCPacker
+except ImportError:
+    DCFile = None
+
+from core_components.dc_codecs import build_field_codec, build_field_codecs
+from core_components.dc_tables import (ST_BLOB, ST_INT16, ST_STRING, ST_UINT32, DCFieldInfo,
+                                       build_class_table)
+
+DC_SOURCE = """
+dclass FixedSizes {
+  setName(string(8)) broadcast ram;
+  setKey(blob(8)) broadcast;
+  setText(string) broadcast;
+  setMixed(uint32, string(8), blob(8), int16/10, string) broadcast ram;
+};
+"""
+
+SAMPLES = {
+    "setName": ("Toontown",),
+    "setKey": (b"\x00\x01\x02\x03\xfc\xfd\xfe\xff",),
+    "setText": ("variable length",),
+    "setMixed": (7, "Goofy!!!", b"12345678", 12.3, "tail"),
+}
+
+
+class TestFixedSizeElements(unittest.TestCase):
+    """The layout DCPacker uses, checked without Panda3D."""
+
+    def test_fixed_size_string_and_blob(self):
+        elements = ((ST_UINT32, 1, 0), (ST_STRING, 1, 8), (ST_BLOB, 1, 8), (ST_INT16, 10, 0),
+                    (ST_STRING, 1, 0))
+        codec = build_field_codec(DCFieldInfo(1, "setMixed", (), elements))
+        data = codec.pack(SAMPLES["setMixed"])
+
+        self.assertEqual(data, b"\x07\x00\x00\x00" b"Goofy!!!" b"12345678" b"\x7b\x00"
+                               b"\x04\x00" b"tail")
+        self.assertEqual(codec.unpack_from(data), (SAMPLES["setMixed"], len(data)))
+
+    def test_truncated_fixed_size(self):
+        codec = build_field_codec(DCFieldInfo(1, "setKey", (), ((ST_BLOB, 1, 8),)))
+        with self.assertRaises(struct.error):
+            codec.unpack_from(b"1234")
+
+
+@unittest.skipIf(DCFile is None, "needs Panda3D")
+class TestFieldCodecs(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.NamedTemporaryFile("w", suffix=".dc", delete=False) as f:
+            f.write(DC_SOURCE)
+        cls.addClassCleanup(os.unlink, f.name)
+
+        cls.dcFile = DCFile()
+        if not cls.dcFile.read(Filename.from_os_specific(f.name)):
+            raise RuntimeError("could not parse the test DC file")
+
+        cls.dclass = cls.dcFile.get_class_by_name("FixedSizes")
+        cls.codecs = build_field_codecs(build_class_table(cls.dcFile))
+        cls.packer = DCPacker()
+
+    def dcPack(self, field, values):
+        self.packer.begin_pack(field)
+        field.pack_args(self.packer, values)
+        self.assertTrue(self.packer.end_pack(), f"DCPacker could not pack {values}")
+        data = self.packer.get_bytes()
+        self.packer.clear_data()
+        return data
+
+    def dcUnpack(self, field, data):
+        self.packer.set_unpack_data(data)
+        self.packer.begin_unpack(field)
+        values = field.unpack_args(self.packer)
+        self.assertTrue(self.packer.end_unpack())
+        return tuple(values)
+
+    def test_round_trips(self):
+        for name, values in SAMPLES.items():
+            with self.subTest(field=name):
+                field = self.dclass.get_field_by_name(name)
+                codec = self.codecs[field.get_number()]
+
+                expected = self.dcPack(field, values)
+                self.assertEqual(codec.pack(values), expected)
+                self.assertEqual(codec.unpack_from(expected), (values, len(expected)))
+                self.assertEqual(self.dcUnpack(field, codec.pack(values)), values)
+
+    def test_fixed_size_has_no_length_prefix(self):
+        codec = self.codecs[self.dclass.get_field_by_name("setKey").get_number()]
+        self.assertEqual(codec.pack((b"abcdefgh",)), b"abcdefgh")
+
+    def test_fixed_size_rejects_other_lengths(self):
+        codec = self.codecs[self.dclass.get_field_by_name("setName").get_number()]
+        with self.assertRaises(ValueError):
+            codec.pack(("Toon",))
+
+
+if __name__ == "__main__":
+    unittest.main()
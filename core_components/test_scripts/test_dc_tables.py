@@ -0,0 +1,74 @@
+"""
+Checks of the dc_tables cache file: round trip, stale .dc files, and corrupt
+or foreign cache files, which must all read as a cache miss.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_dc_tables.py
+"""
+
+import os
+import pickle
+import tempfile
+import unittest
+
+from core_components.dc_tables import (DCClassInfo, DCFieldInfo, ST_UINT32, load_dc_cache,
+                                       peek_dc_cache_hash, store_dc_cache)
+
+CLASSES = {
+    1: DCClassInfo(1, "DistributedObject", (DCFieldInfo(3, "setX", ("broadcast",), ((ST_UINT32, 1, 0),)),)),
+}
+
+
+class TestDCCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        self.dcFile = os.path.join(self.directory.name, "otp.dc")
+        with open(self.dcFile, "w") as f:
+            f.write("dclass DistributedObject {};\n")
+
+        self.cacheFile = os.path.join(self.directory.name, "otp.dc.cache")
+
+    def writeCache(self, data):
+        with open(self.cacheFile, "wb") as f:
+            f.write(data)
+
+    def test_round_trip(self):
+        store_dc_cache(self.cacheFile, [self.dcFile], 0x1234, 0.5, CLASSES)
+        entry = load_dc_cache(self.cacheFile, [self.dcFile])
+
+        self.assertEqual(entry["classes"], CLASSES)
+        self.assertEqual(entry["hash"], 0x1234)
+        self.assertEqual(peek_dc_cache_hash(self.cacheFile), 0x1234)
+
+    def test_changed_dc_file_misses(self):
+        store_dc_cache(self.cacheFile, [self.dcFile], 0x1234, 0.5, CLASSES)
+        with open(self.dcFile, "a") as f:
+            f.write("dclass Other {};\n")
+
+        self.assertIsNone(load_dc_cache(self.cacheFile, [self.dcFile]))
+        self.assertEqual(peek_dc_cache_hash(self.cacheFile), 0x1234)
+
+    def test_missing_cache_misses(self):
+        self.assertIsNone(load_dc_cache(self.cacheFile, [self.dcFile]))
+        self.assertIsNone(peek_dc_cache_hash(self.cacheFile))
+
+    def test_unusable_cache_misses(self):
+        cases = {
+            "not a dict": pickle.dumps([1, 2, 3]),
+            "truncated": pickle.dumps({"version": 2, "hash": 1})[:-3],
+            "garbage": b"\x80\x05garbage",
+            "unknown class": b"cnot_a_module\nNotAClass\n.",
+            "empty": b"",
+            "other version": pickle.dumps({"version": -1, "hash": 1}),
+        }
+        for name, data in cases.items():
+            with self.subTest(name):
+                self.writeCache(data)
+                self.assertIsNone(load_dc_cache(self.cacheFile, [self.dcFile]))
+                self.assertIsNone(peek_dc_cache_hash(self.cacheFile))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Checks of FrameBuffer: frames split across reads, frames bigger than the
+buffer, and compaction keeping the unread tail intact.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_frame_buffer.py
+"""
+
+import random
+import struct
+import unittest
+
+from core_components.datagram import FrameBuffer
+
+
+def frame(payload):
+    return struct.pack("<H", len(payload)) + payload
+
+
+class TestFrameBuffer(unittest.TestCase):
+    def feed(self, buffer, data):
+        """Receive data into buffer like recv_into would, as much as fits per call."""
+        received = []
+        while data:
+            space = buffer.writable()
+            count = min(len(space), len(data))
+            space[:count] = data[:count]
+            buffer.commit(count)
+            data = data[count:]
+            received.extend(bytes(f) for f in buffer.frames())
+
+        return received
+
+    def test_incomplete_frame_waits(self):
+        buffer = FrameBuffer(64, 16)
+        self.assertEqual(self.feed(buffer, b"\x05"), [])
+        self.assertEqual(self.feed(buffer, b"\x00abc"), [])
+        self.assertEqual(self.feed(buffer, b"de"), [b"abcde"])
+        self.assertEqual(len(buffer), 0)
+
+    def test_empty_frame(self):
+        buffer = FrameBuffer(64, 16)
+        self.assertEqual(self.feed(buffer, frame(b"") + frame(b"x")), [b"", b"x"])
+
+    def test_frame_bigger_than_the_buffer(self):
+        buffer = FrameBuffer(64, 16)
+        payload = bytes(range(256)) * 3
+        self.assertEqual(self.feed(buffer, frame(b"a") + frame(payload) + frame(b"b")),
+                         [b"a", payload, b"b"])
+        self.assertGreaterEqual(len(buffer.data), len(payload) + 2)
+
+    def test_compaction_keeps_the_tail(self):
+        buffer = FrameBuffer(32, 8)
+        data = b"".join(frame(bytes([i]) * 9) for i in range(10))
+        self.assertEqual(self.feed(buffer, data), [bytes([i]) * 9 for i in range(10)])
+        self.assertEqual(len(buffer.data), 32, "frames fitting the buffer must not grow it")
+
+    def test_random_chunks(self):
+        rng = random.Random(4)
+        payloads = [bytes(rng.randrange(256) for _ in range(rng.choice((0, 1, 7, 40, 100, 300))))
+                    for _ in range(300)]
+        data = b"".join(frame(payload) for payload in payloads)
+
+        buffer = FrameBuffer(128, 32)
+        received = []
+        offset = 0
+        while offset < len(data):
+            space = buffer.writable()
+            count = min(len(space), rng.randrange(1, 90), len(data) - offset)
+            space[:count] = data[offset:offset + count]
+            buffer.commit(count)
+            offset += count
+            received.extend(bytes(f) for f in buffer.frames())
+
+        self.assertEqual(received, payloads)
+        self.assertEqual(len(buffer), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
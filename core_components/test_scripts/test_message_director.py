@@ -0,0 +1,54 @@
+"""
+Checks of the MessageDirector control message dispatch: unknown control
+codes, from participants and from worker bus peers, are logged and ignored
+instead of costing the connection.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_message_director.py
+"""
+
+import socket
+import unittest
+
+from core_components import msgTypes
+from core_components.message_director import MDClient, MessageDirector, makeControlDatagram
+from core_components.message_director_workers import WorkerBus
+
+UNKNOWN_CODE = 9999
+
+
+class NullOTP:
+    async def handle_message(self, channels, sender, code, dg):
+        pass
+
+
+class TestControlMessages(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.md = MessageDirector(NullOTP())
+        self.sockets = socket.socketpair()
+        self.client = MDClient(self.md, self.sockets[0], ("127.0.0.1", 1))
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    async def test_unknown_code_is_ignored(self):
+        with self.assertLogs("MDServer", level="WARNING"):
+            await self.md.handle_datagram(makeControlDatagram(UNKNOWN_CODE, 5), self.client)
+
+        await self.md.handle_datagram(makeControlDatagram(msgTypes.CONTROL_SET_CHANNEL, 5), self.client)
+        self.assertEqual(self.md.channelMap.lookup([5]), {self.client})
+
+    async def test_unknown_worker_bus_code_is_ignored(self):
+        bus = WorkerBus(self.md, 0, {1: self.sockets[1]})
+        peer = bus.peers[0]
+
+        with self.assertLogs("MDServer", level="WARNING"):
+            await peer.handle_datagram(makeControlDatagram(UNKNOWN_CODE, 5).getMessage())
+
+        await peer.handle_datagram(makeControlDatagram(msgTypes.CONTROL_SET_CHANNEL, 5).getMessage())
+        self.assertEqual(bus.peerMap.lookup([5]), {peer})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Checks of the channel registration batching of network_channels, and of the
+order NetworkListener and NetworkConnector send registrations and datagrams in.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_network_channels.py
+"""
+
+import asyncio
+import unittest
+
+from core_components import msgTypes
+from core_components.datagram import DatagramIterator
+from core_components.network_channels import NetworkChannelBatch
+from core_components.network_manager_async import (NetworkConnector, NetworkDatagram, NetworkListener,
+                                                   call_soon)
+
+
+def decode(datagram):
+    """Returns (code, registered, unregistered) of a control datagram."""
+    di = DatagramIterator(datagram.getMessage())
+    di.getUint8()
+    di.getUint64()
+    code = di.getUint16()
+    if code == msgTypes.CONTROL_SET_CHANNEL:
+        return code, [di.getUint64()], []
+    if code == msgTypes.CONTROL_REMOVE_CHANNEL:
+        return code, [], [di.getUint64()]
+
+    added = di.getUint64s(di.getUint16())
+    removed = di.getUint64s(di.getUint16())
+    return code, list(added), list(removed)
+
+
+class TestNetworkChannelBatch(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.batch = NetworkChannelBatch(NetworkDatagram, self.sent.append)
+
+    def test_lone_change_is_a_plain_control_message(self):
+        self.batch.set_channel(5)
+        self.batch.flush()
+        self.assertEqual([decode(dg) for dg in self.sent], [(msgTypes.CONTROL_SET_CHANNEL, [5], [])])
+
+    def test_last_call_wins(self):
+        self.batch.set_channel(1)
+        self.batch.remove_channel(1)
+        self.batch.set_channel(2)
+        self.batch.remove_channel(3)
+        self.batch.flush()
+
+        self.assertEqual([decode(dg) for dg in self.sent],
+                         [(msgTypes.CONTROL_UPDATE_CHANNELS, [2], [1, 3])])
+
+    def test_chunks(self):
+        count = NetworkChannelBatch.max_channels * 2 + 1
+        for channel in range(count):
+            self.batch.set_channel(channel)
+        self.batch.flush()
+
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(sorted(c for dg in self.sent for c in decode(dg)[1]), list(range(count)))
+        self.assertEqual(len(self.batch), 0)
+
+    def test_no_coalescing_sends_at_once(self):
+        batch = NetworkChannelBatch(NetworkDatagram, self.sent.append, coalesce=False)
+        batch.set_channel(1)
+        batch.remove_channel(2)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_scheduled_flush(self):
+        async def run():
+            batch = NetworkChannelBatch(NetworkDatagram, self.sent.append, schedule=call_soon)
+            batch.set_channel(1)
+            batch.set_channel(2)
+            self.assertEqual(self.sent, [])
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        self.assertEqual([decode(dg) for dg in self.sent],
+                         [(msgTypes.CONTROL_UPDATE_CHANNELS, [1, 2], [])])
+
+
+class RecordingListener(NetworkListener):
+    """A daemon's listener: its send hook just sends, without flushing."""
+
+    def __init__(self):
+        self.sent = []
+        NetworkListener.__init__(self, "127.0.0.1", 0, None)
+
+    def handle_send_connection_datagram(self, datagram):
+        self.sent.append(datagram)
+
+
+class RecordingConnector(NetworkConnector):
+    def __init__(self):
+        self.sent = []
+        NetworkConnector.__init__(self, None, "127.0.0.1", 0, 1)
+
+    def handle_send_connection_datagram(self, datagram):
+        self.sent.append(datagram)
+
+
+class TestSendOrder(unittest.TestCase):
+    def test_listener_registrations_go_out_before_datagrams(self):
+        async def run():
+            listener = RecordingListener()
+            listener.register_channel(1)
+            listener.register_channel(2)
+
+            datagram = NetworkDatagram()
+            datagram.add_header(1, 2, msgTypes.STATESERVER_OBJECT_UPDATE_FIELD)
+            listener.send_connection_datagram(datagram)
+            listener.unregister_channel(2)
+            await asyncio.sleep(0)
+            return listener.sent, datagram
+
+        sent, datagram = asyncio.run(run())
+        self.assertEqual(decode(sent[0]), (msgTypes.CONTROL_UPDATE_CHANNELS, [1, 2], []))
+        self.assertIs(sent[1], datagram)
+        self.assertEqual(decode(sent[2]), (msgTypes.CONTROL_REMOVE_CHANNEL, [], [2]))
+
+    def test_connector_registrations_go_out_before_ranges(self):
+        async def run():
+            connector = RecordingConnector()
+            connector.register_for_channel(5)
+            connector.register_for_range(100, 200)
+            await asyncio.sleep(0)
+            return connector.sent
+
+        sent = asyncio.run(run())
+        self.assertEqual(decode(sent[0]), (msgTypes.CONTROL_SET_CHANNEL, [5], []))
+        self.assertEqual(len(sent), 2)
+
+    def test_hook_stays_the_subclass_method(self):
+        listener = RecordingListener()
+        self.assertNotIn("handle_send_connection_datagram", vars(listener))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,227 @@
+"""
+Checks of TimingWheel against a fake event loop: timers landing exactly on
+level boundaries, cascading between levels and out of the overflow bucket,
+cancelling and rearming a timer after it cascaded, and a randomized run in
+which every timer must expire on its exact tick.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_timing_wheel.py
+"""
+
+import random
+import unittest
+from unittest import mock
+
+from core_components.timing_wheel import TimingWheel
+
+
+class FakeHandle:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """Just enough of an event loop for the wheel: time() and call_at()."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.handles = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = FakeHandle(when, callback)
+        self.handles.append(handle)
+        return handle
+
+    def runUntil(self, when):
+        while True:
+            due = [h for h in self.handles if not h.cancelled and h.when <= when]
+            if not due:
+                break
+
+            handle = min(due, key=lambda h: h.when)
+            self.handles.remove(handle)
+            self.now = max(self.now, handle.when)
+            handle.callback()
+
+        self.now = when
+
+
+class WheelTestCase(unittest.TestCase):
+    # 4 buckets per level and 3 levels: level 1 starts at 4 ticks, level 2
+    # at 16, and deadlines 64 ticks away or more go to the overflow bucket.
+    bits = 2
+    levels = 3
+
+    def setUp(self):
+        self.loop = FakeLoop()
+        patcher = mock.patch("asyncio.get_running_loop", return_value=self.loop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.expired = []  # (loop time, [owners]) per onExpire call
+        self.wheel = TimingWheel(self.onExpire, tick=1.0, bits=self.bits, levels=self.levels)
+
+    def onExpire(self, entries):
+        self.expired.append((self.loop.now, sorted(entry.owner for entry in entries)))
+
+    def expiryTicks(self):
+        return {owner: tick for tick, owners in self.expired for owner in owners}
+
+    def levelOf(self, entry):
+        if entry.bucket is self.wheel.overflow:
+            return len(self.wheel.levels)
+
+        for level, buckets in enumerate(self.wheel.levels):
+            if any(entry.bucket is bucket for bucket in buckets):
+                return level
+
+
+class TestTimingWheel(WheelTestCase):
+    def test_level_boundaries(self):
+        delays = (1, 3, 4, 5, 15, 16, 17, 63, 64, 65, 200)
+        for delay in delays:
+            self.wheel.schedule(delay, delay)
+
+        self.loop.runUntil(300)
+        self.assertEqual(self.expiryTicks(), {delay: delay for delay in delays})
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_level_boundaries_from_an_unaligned_tick(self):
+        self.wheel.schedule(100, "keepalive")
+        self.loop.runUntil(3)
+
+        delays = (1, 4, 13, 16, 61, 64)
+        for delay in delays:
+            self.wheel.schedule(delay, delay)
+
+        self.loop.runUntil(200)
+        expected = {delay: 3 + delay for delay in delays}
+        expected["keepalive"] = 100
+        self.assertEqual(self.expiryTicks(), expected)
+
+    def test_placement(self):
+        self.assertEqual(self.levelOf(self.wheel.schedule(3, "a")), 0)
+        self.assertEqual(self.levelOf(self.wheel.schedule(4, "b")), 1)
+        self.assertEqual(self.levelOf(self.wheel.schedule(16, "c")), 2)
+        self.assertEqual(self.levelOf(self.wheel.schedule(64, "d")), 3)
+
+    def test_cascade_moves_timers_down(self):
+        entry = self.wheel.schedule(20, "a")
+        self.assertEqual(self.levelOf(entry), 2)
+
+        # Tick 16 reaches its level 2 bucket, tick 20 its level 1 bucket
+        self.loop.runUntil(16)
+        self.assertEqual(self.levelOf(entry), 1)
+        self.loop.runUntil(19)
+        self.assertEqual(self.levelOf(entry), 1)
+        self.assertEqual(self.expired, [])
+        self.loop.runUntil(20)
+        self.assertEqual(self.expired, [(20, ["a"])])
+
+    def test_cancel_after_cascade(self):
+        entry = self.wheel.schedule(20, "a")
+        self.wheel.schedule(40, "b")
+        self.loop.runUntil(16)
+        self.assertEqual(self.levelOf(entry), 1)
+
+        self.wheel.cancel(entry)
+        self.assertFalse(entry.scheduled)
+        self.assertEqual(len(self.wheel), 1)
+        self.wheel.cancel(entry)
+        self.assertEqual(len(self.wheel), 1)
+
+        self.loop.runUntil(100)
+        self.assertEqual(self.expired, [(40, ["b"])])
+
+    def test_cancel_out_of_overflow(self):
+        entry = self.wheel.schedule(70, "a")
+        self.loop.runUntil(64)
+        self.assertEqual(self.levelOf(entry), 1)
+
+        self.wheel.cancel(entry)
+        self.loop.runUntil(200)
+        self.assertEqual(self.expired, [])
+        self.assertIsNone(self.wheel.handle)
+
+    def test_rearm_after_cascade(self):
+        entry = self.wheel.schedule(20, "a")
+        self.loop.runUntil(17)
+
+        self.wheel.rearm(entry, 30)
+        self.assertEqual(len(self.wheel), 1)
+        self.loop.runUntil(100)
+        self.assertEqual(self.expired, [(47, ["a"])])
+
+    def test_same_tick_expires_in_one_batch(self):
+        for owner in range(5):
+            self.wheel.schedule(0.5 + owner * 0.1, owner)
+
+        self.loop.runUntil(10)
+        self.assertEqual(self.expired, [(1, [0, 1, 2, 3, 4])])
+
+    def test_late_loop_catches_up(self):
+        self.wheel.schedule(2, "a")
+        self.wheel.schedule(9, "b")
+        self.loop.handles.clear()  # the loop misses every callback until tick 12
+        self.loop.now = 12
+        self.wheel.advance()
+
+        self.assertEqual(self.expired, [(12, ["a", "b"])])
+        self.assertEqual(self.wheel.now, 12)
+
+    def test_stops_when_empty_and_restarts(self):
+        self.wheel.schedule(2, "a")
+        self.loop.runUntil(50)
+        self.assertIsNone(self.wheel.handle)
+
+        self.wheel.schedule(5, "b")
+        self.loop.runUntil(100)
+        self.assertEqual(self.expired, [(2, ["a"]), (55, ["b"])])
+
+
+class TestTimingWheelRandom(WheelTestCase):
+    def test_random_against_deadlines(self):
+        rng = random.Random(7)
+        deadlines = {}  # owner -> tick it must expire on
+        entries = {}
+
+        def onExpire(expired):
+            for entry in expired:
+                self.assertEqual(deadlines.pop(entry.owner), self.wheel.now)
+
+        self.wheel.onExpire = onExpire
+
+        for _ in range(3000):
+            self.loop.runUntil(self.loop.now + rng.choice((0, 1, 3, 7, 20)))
+            for _ in range(rng.randrange(4)):
+                owner = rng.randrange(60)
+                entry = entries.get(owner)
+                if entry is not None and entry.scheduled and rng.random() < 0.3:
+                    self.wheel.cancel(entry)
+                    del deadlines[owner]
+                    continue
+
+                ticks = rng.choice((1, 2, 4, 15, 16, 17, 63, 64, 65, 150))
+                if entry is None:
+                    entries[owner] = self.wheel.schedule(ticks, owner)
+                else:
+                    self.wheel.rearm(entry, ticks)
+                deadlines[owner] = self.wheel.now + ticks
+
+            self.assertEqual(len(self.wheel), len(deadlines))
+
+        self.loop.runUntil(self.loop.now + 500)
+        self.assertEqual(deadlines, {})
+        self.assertEqual(len(self.wheel), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Checks of the per-session coalescing of field updates in AsyncCAClient: a
+newer update replacing a queued one in place, ordering against frames sent
+directly, the window restarting after a flush, and closed sessions.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_update_coalescing.py
+"""
+
+import asyncio
+import struct
+import unittest
+
+from core_components import msgTypes
+from core_components.client_agent import ClientAgent
+from core_components.datagram import Datagram
+from core_components.message_director import makeFrame
+from core_components.network_server_async import AsyncCAClient
+
+WINDOW = 0.02
+POSITION = 10  # a coalesced field
+CHAT = 11      # sent at once
+
+
+class FakeTransport:
+    def __init__(self):
+        self.data = bytearray()
+        self.writes = 0
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+        self.writes += 1
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 1)
+
+
+def update(doId, field, value, msgType=None):
+    dg = Datagram()
+    if msgType is not None:
+        dg.addUint16(msgType)
+    dg.addUint32(doId)
+    dg.addUint16(field)
+    dg.addUint32(value)
+    return dg
+
+
+def received(transport):
+    """Returns (msgType, doId, field, value) of every datagram written to transport."""
+    messages = []
+    data = bytes(transport.data)
+    offset = 0
+    while offset < len(data):
+        length, = struct.unpack_from("<H", data, offset)
+        messages.append(struct.unpack_from("<HIHI", data, offset + 2))
+        offset += 2 + length
+    return messages
+
+
+def location(parent, zone):
+    return (parent << 32) | zone
+
+
+class TestUpdateCoalescing(unittest.TestCase):
+    def setUpSession(self, channel=0):
+        session = AsyncCAClient(self.ca)
+        transport = FakeTransport()
+        session.connection_made(transport)
+        session.channel = channel
+        self.ca.interest.setZone(session, 1, 2000)
+        return session, transport
+
+    def start(self):
+        self.ca = ClientAgent(None, loginTimeout=0, anonymousTimeout=0, updateWindow=WINDOW,
+                              coalesceFields=frozenset((POSITION,)))
+
+    def broadcast(self, doId, field, value, sender=1):
+        self.ca.handle_object_update_field([location(1, 2000)], sender, update(doId, field, value))
+
+    def test_replaced_update_keeps_its_place(self):
+        async def run():
+            self.start()
+            session, transport = self.setUpSession()
+            self.broadcast(100, POSITION, 1)
+            self.broadcast(200, POSITION, 1)
+            self.broadcast(100, POSITION, 2)
+            await asyncio.sleep(0)
+            self.assertEqual(transport.data, b"", "updates must wait for the window")
+
+            await asyncio.sleep(WINDOW * 3)
+            return transport
+
+        transport = asyncio.run(run())
+        self.assertEqual(received(transport), [
+            (msgTypes.CLIENT_OBJECT_UPDATE_FIELD, 100, POSITION, 2),
+            (msgTypes.CLIENT_OBJECT_UPDATE_FIELD, 200, POSITION, 1),
+        ])
+        self.assertEqual(transport.writes, 1)
+        self.assertEqual(self.ca.coalescedUpdates, 1)
+
+    def test_direct_frame_goes_after_queued_updates(self):
+        async def run():
+            self.start()
+            session, transport = self.setUpSession()
+            self.broadcast(100, POSITION, 1)
+            session.sendFrame(makeFrame(update(300, CHAT, 9, msgTypes.CLIENT_OBJECT_UPDATE_FIELD)))
+            self.assertIsNone(session.pendingUpdates)
+            self.assertIsNone(session.updateHandle)
+            await asyncio.sleep(WINDOW * 3)
+            return transport
+
+        transport = asyncio.run(run())
+        self.assertEqual([message[1:] for message in received(transport)], [(100, POSITION, 1), (300, CHAT, 9)])
+
+    def test_new_window_after_a_flush(self):
+        async def run():
+            self.start()
+            session, transport = self.setUpSession()
+            self.broadcast(100, POSITION, 1)
+            await asyncio.sleep(WINDOW * 3)
+            self.assertEqual(len(received(transport)), 1)
+
+            self.broadcast(100, POSITION, 2)
+            self.assertIsNotNone(session.updateHandle)
+            self.broadcast(100, POSITION, 3)
+            await asyncio.sleep(WINDOW * 3)
+            return transport
+
+        transport = asyncio.run(run())
+        self.assertEqual([message[3] for message in received(transport)], [1, 3])
+        self.assertEqual(self.ca.coalescedUpdates, 1)
+
+    def test_closing_drops_pending_updates(self):
+        async def run():
+            self.start()
+            session, transport = self.setUpSession()
+            self.broadcast(100, POSITION, 1)
+            session.connection_lost(None)
+            self.assertIsNone(session.pendingUpdates)
+            self.assertIsNone(session.updateHandle)
+
+            frame = makeFrame(update(100, POSITION, 2, msgTypes.CLIENT_OBJECT_UPDATE_FIELD))
+            self.assertFalse(session.queueUpdate((100, POSITION), frame, WINDOW))
+            await asyncio.sleep(WINDOW * 3)
+            return transport
+
+        transport = asyncio.run(run())
+        self.assertEqual(transport.data, b"")
+
+    def test_sender_is_skipped_and_other_fields_go_at_once(self):
+        async def run():
+            self.start()
+            sender, senderTransport = self.setUpSession(channel=5)
+            other, otherTransport = self.setUpSession(channel=6)
+            self.broadcast(100, POSITION, 1, sender=5)
+            self.broadcast(100, CHAT, 2, sender=5)
+            self.assertIsNone(sender.pendingUpdates)
+
+            # The update sent at once takes the queued one along, in order
+            self.assertIsNone(other.pendingUpdates)
+            await asyncio.sleep(0)
+            return senderTransport, otherTransport
+
+        senderTransport, otherTransport = asyncio.run(run())
+        self.assertEqual(senderTransport.data, b"")
+        self.assertEqual([message[2:] for message in received(otherTransport)], [(POSITION, 1), (CHAT, 2)])
+
+    def test_no_window_sends_at_once(self):
+        async def run():
+            self.ca = ClientAgent(None, loginTimeout=0, anonymousTimeout=0,
+                                  coalesceFields=frozenset((POSITION,)))
+            session, transport = self.setUpSession()
+            self.broadcast(100, POSITION, 1)
+            self.broadcast(100, POSITION, 2)
+            self.assertIsNone(session.pendingUpdates)
+            await asyncio.sleep(0)
+            return transport
+
+        transport = asyncio.run(run())
+        self.assertEqual([message[3] for message in received(transport)], [1, 2])
+        self.assertEqual(self.ca.coalescedUpdates, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+"""
+Checks of ZoneInterestIndex: the (parent, zone) -> sessions index as
+sessions change zones and shards, location channel lookups, and a randomized
+comparison against what every session says it watches. With a
+VisibilityGraph: cached transition diffs, moves under a new parent and in
+and out of the graph, and the diffs the Client Agent hands to zonesChanged.
+
+Run from the repository root:
+    python -m pytest core_components/test_scripts/test_zone_interest.py
+"""
+
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from core_components.client_agent import ClientAgent
+from core_components.datagram import Datagram, DatagramIterator
+from core_components.zone_interest import (EMPTY, VisibilityGraph, ZoneInterestIndex,
+                                           loadVisibilityGraph, splitLocation)
+
+
+def location(parent, zone):
+    return (parent << 32) | zone
+
+
+class Session:
+    """The interest state AsyncCAClient keeps for the index."""
+
+    def __init__(self, name):
+        self.name = name
+        self.parent = 0
+        self.zone = 0
+        self.zones = EMPTY
+
+    def __repr__(self):
+        return self.name
+
+
+class InterestTestCase(unittest.TestCase):
+    def assertConsistent(self, index, sessions):
+        """Every (parent, zone) a session watches lists it, and nothing else does."""
+        expected = {}
+        for session in sessions:
+            for zone in session.zones:
+                expected.setdefault((session.parent, zone), set()).add(session)
+
+        self.assertEqual(index.watchers, expected)
+
+
+class TestZoneInterestIndex(InterestTestCase):
+    def setUp(self):
+        self.index = ZoneInterestIndex()
+        self.a = Session("a")
+        self.b = Session("b")
+
+    def test_split_location(self):
+        self.assertEqual(splitLocation(location(200000000, 2000)), (200000000, 2000))
+
+    def test_set_zone(self):
+        entered, left = self.index.setZone(self.a, 1, 2000, [2001, 2002])
+        self.assertEqual((entered, left), ({2000, 2001, 2002}, EMPTY))
+        self.assertEqual(self.a.zone, 2000)
+
+        entered, left = self.index.setZone(self.a, 1, 2001, [2000, 2003])
+        self.assertEqual((entered, left), ({2003}, {2002}))
+        self.assertEqual(self.index.watching(1, 2002), EMPTY)
+        self.assertEqual(self.index.watching(1, 2003), {self.a})
+        self.assertConsistent(self.index, [self.a])
+
+    def test_lookup(self):
+        self.index.setZone(self.a, 1, 2000, [2001])
+        self.index.setZone(self.b, 1, 2001)
+
+        self.assertEqual(self.index.lookup([location(1, 2000)]), {self.a})
+        self.assertEqual(self.index.lookup([location(1, 2001)]), {self.a, self.b})
+        self.assertEqual(self.index.lookup([location(1, 2000), location(1, 2001)]), {self.a, self.b})
+        self.assertEqual(self.index.lookup([location(2, 2000)]), EMPTY)
+
+    def test_lookup_of_several_channels_does_not_touch_the_index(self):
+        self.index.setZone(self.a, 1, 2000)
+        self.index.setZone(self.b, 1, 2001)
+
+        sessions = self.index.lookup([location(1, 2000), location(1, 2001)])
+        sessions.clear()
+        self.assertEqual(self.index.watching(1, 2000), {self.a})
+
+    def test_new_parent_leaves_every_old_zone(self):
+        self.index.setZone(self.a, 1, 2000, [2001])
+        entered, left = self.index.setInterest(self.a, 2, frozenset((2000,)))
+
+        self.assertEqual((entered, left), ({2000}, {2000, 2001}))
+        self.assertEqual(self.index.watching(1, 2000), EMPTY)
+        self.assertEqual(self.index.watching(2, 2000), {self.a})
+        self.assertConsistent(self.index, [self.a])
+
+    def test_remove_session(self):
+        self.index.setZone(self.a, 1, 2000, [2001])
+        self.index.setZone(self.b, 1, 2001)
+        self.index.removeSession(self.a)
+
+        self.assertEqual(self.a.zones, EMPTY)
+        self.assertEqual(self.index.watching(1, 2001), {self.b})
+        self.assertEqual(len(self.index), 1)
+
+        self.index.removeSession(self.b)
+        self.assertEqual(len(self.index), 0)
+
+    def test_random_against_sessions(self):
+        rng = random.Random(3)
+        sessions = [Session(f"s{i}") for i in range(20)]
+
+        for _ in range(3000):
+            session = rng.choice(sessions)
+            op = rng.randrange(6)
+            if op == 0:
+                self.index.setInterest(session, rng.randrange(1, 4), EMPTY)
+            elif op == 1:
+                self.index.removeSession(session)
+            else:
+                visible = rng.sample(range(2000, 2015), rng.randrange(4))
+                self.index.setZone(session, rng.choice((session.parent or 1, rng.randrange(1, 4))),
+                                   rng.randrange(2000, 2015), visible)
+
+        self.assertConsistent(self.index, sessions)
+
+
+class TestVisibilityGraph(InterestTestCase):
+    def setUp(self):
+        # 1 - 2 - 3 in a row, 4 sees only itself
+        self.graph = VisibilityGraph({1: [2], 2: [1, 3], 3: [2], 4: []})
+        self.index = ZoneInterestIndex(self.graph)
+        self.a = Session("a")
+
+    def test_visible_from(self):
+        self.assertEqual(self.graph.visibleFrom(2), {1, 2, 3})
+        self.assertEqual(self.graph.visibleFrom(4), {4})
+        self.assertIsNone(self.graph.visibleFrom(5))
+        self.assertIn(4, self.graph)
+        self.assertEqual(len(self.graph), 4)
+
+    def test_graph_zones_ignore_the_client(self):
+        self.index.setZone(self.a, 1, 2, [99])
+        self.assertIs(self.a.zones, self.graph.visibleFrom(2))
+
+    def test_transitions_are_cached(self):
+        self.index.setZone(self.a, 1, 1)
+        self.assertEqual(self.index.setZone(self.a, 1, 2), ({3}, EMPTY))
+        self.assertEqual(self.index.setZone(self.a, 1, 1), (EMPTY, {3}))
+        self.assertEqual(self.index.setZone(self.a, 1, 2), ({3}, EMPTY))
+
+        info = self.graph.cacheInfo()
+        self.assertEqual((info.hits, info.misses), (1, 2))
+        self.assertConsistent(self.index, [self.a])
+
+    def test_cache_is_bounded(self):
+        graph = VisibilityGraph({1: [], 2: [], 3: []}, cacheSize=2)
+        for old, new in ((1, 2), (2, 3), (3, 1)):
+            graph.transition(old, new)
+
+        self.assertEqual(graph.cacheInfo().currsize, 2)
+
+    def test_set_zone_between_graph_zones_under_a_new_parent(self):
+        self.index.setZone(self.a, 1, 1)
+        misses = self.graph.cacheInfo().misses
+
+        entered, left = self.index.setZone(self.a, 2, 2)
+
+        self.assertEqual((entered, left), ({1, 2, 3}, {1, 2}))
+        self.assertEqual(self.graph.cacheInfo().misses, misses, "a diff under another parent is not a transition")
+        self.assertEqual(self.index.watching(1, 1), EMPTY)
+        self.assertEqual(self.index.watching(2, 1), {self.a})
+        self.assertEqual((self.a.parent, self.a.zone), (2, 2))
+        self.assertConsistent(self.index, [self.a])
+
+    def test_in_and_out_of_the_graph(self):
+        self.index.setZone(self.a, 1, 2)
+        self.assertEqual(self.index.setZone(self.a, 1, 99, [3, 100]), ({99, 100}, {1, 2}))
+        self.assertEqual(self.index.setZone(self.a, 1, 3), ({2}, {99, 100}))
+        self.assertIs(self.a.zones, self.graph.visibleFrom(3))
+        self.assertConsistent(self.index, [self.a])
+
+    def test_set_zone_after_leaving_the_shard(self):
+        self.index.setZone(self.a, 1, 1)
+        self.index.setInterest(self.a, 1, EMPTY)  # CLIENT_SET_SHARD to the same shard
+
+        self.assertEqual(self.index.setZone(self.a, 1, 2), ({1, 2, 3}, EMPTY))
+        self.assertConsistent(self.index, [self.a])
+
+    def test_load(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump({"2100": [2101], "2101": [2100, 2102]}, f)
+        self.addCleanup(os.unlink, f.name)
+
+        graph = loadVisibilityGraph(f.name, cacheSize=16)
+        self.assertEqual(graph.visibleFrom(2101), {2100, 2101, 2102})
+        self.assertEqual(graph.cacheInfo().maxsize, 16)
+
+    def test_random_against_sessions(self):
+        rng = random.Random(5)
+        graph = VisibilityGraph({zone: rng.sample(range(10), 3) for zone in range(10)})
+        index = ZoneInterestIndex(graph)
+        sessions = [Session(f"s{i}") for i in range(20)]
+
+        for _ in range(3000):
+            session = rng.choice(sessions)
+            op = rng.randrange(8)
+            if op == 0:
+                index.setInterest(session, rng.randrange(1, 3), EMPTY)
+            elif op == 1:
+                index.removeSession(session)
+            else:
+                # Mostly graph zones, some the graph does not have
+                zone = rng.randrange(14)
+                parent = session.parent if rng.random() < 0.8 and session.parent else rng.randrange(1, 3)
+                index.setZone(session, parent, zone, rng.sample(range(10, 14), rng.randrange(3)))
+
+        self.assertConsistent(index, sessions)
+        self.assertGreater(graph.cacheInfo().hits, 0)
+
+
+class RecordingClientAgent(ClientAgent):
+    def __init__(self, visibility):
+        ClientAgent.__init__(self, None, loginTimeout=0, anonymousTimeout=0, visibility=visibility)
+        self.changes = []
+
+    def zonesChanged(self, session, oldParent, entered, left):
+        self.changes.append((oldParent, session.parent, entered, left))
+
+
+class ClientSession(Session):
+    def __init__(self, name):
+        Session.__init__(self, name)
+        self.address = name
+        self.sent = []
+
+    def sendDatagram(self, dg):
+        self.sent.append(dg)
+
+
+def clientMessage(*values):
+    dg = Datagram()
+    for value in values:
+        dg.addUint32(value)
+    return DatagramIterator(dg.getMessage())
+
+
+class TestZonesChanged(unittest.TestCase):
+    def setUp(self):
+        self.graph = VisibilityGraph({1: [2], 2: [1, 3], 3: [2]})
+        self.ca = RecordingClientAgent(self.graph)
+        self.session = ClientSession("a")
+
+    def test_set_zone_and_shard(self):
+        self.ca.handle_set_shard(self.session, clientMessage(7))
+        self.ca.handle_set_zone(self.session, clientMessage(1))
+        self.ca.handle_set_zone(self.session, clientMessage(2, 99))
+        self.ca.handle_set_shard(self.session, clientMessage(8))
+
+        self.assertEqual(self.ca.changes, [
+            (0, 7, EMPTY, EMPTY),
+            (7, 7, {1, 2}, EMPTY),
+            (7, 7, {3}, EMPTY),
+            (7, 8, EMPTY, {1, 2, 3}),
+        ])
+        self.assertEqual(len(self.session.sent), 2, "one CLIENT_DONE_SET_ZONE_RESP per CLIENT_SET_ZONE")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Hierarchical timing wheel for large numbers of timeouts.
+
+Heartbeat and login timeouts of tens of thousands of client sessions would
+be tens of thousands of asyncio timers, or a scan of every session each
+second. The wheel keeps them in buckets instead: level 0 has one bucket per
+tick, each level above one bucket per full turn of the level below. A timer
+is placed at the lowest level where its deadline shares every higher digit
+with the current tick, and moves down a level whenever the wheel reaches its
+bucket, so scheduling, rearming and cancelling are O(1). One loop callback
+per tick expires the level 0 bucket, and everything that expired is handed
+to onExpire as one list.
+"""
+
+import asyncio
+import math
+
+
+class TimerEntry:
+    """A scheduled timeout: owner and kind are whatever the scheduler passed."""
+
+    __slots__ = ("owner", "kind", "deadline", "bucket")
+
+    def __init__(self, owner, kind):
+        self.owner = owner
+        self.kind = kind
+        self.deadline = 0
+        self.bucket = None  # the set holding it while scheduled
+
+    @property
+    def scheduled(self):
+        return self.bucket is not None
+
+
+class TimingWheel:
+    def __init__(self, onExpire, tick=0.1, bits=6, levels=4):
+        """
+        :param onExpire: Called with the list of TimerEntry expired by one advance.
+        :param tick: Seconds per tick, the resolution of every timeout.
+        :param bits: log2 of the buckets per level.
+        :param levels: Number of levels; deadlines further away than
+            2 ** (bits * levels) ticks wait in an overflow bucket.
+        """
+        self.onExpire = onExpire
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = [[set() for _ in range(1 << bits)] for _ in range(levels)]
+        self.overflow = set()
+
+        self.now = 0        # current tick
+        self.origin = 0.0   # loop time of tick 0
+        self.count = 0      # scheduled timers
+        self.handle = None  # next advance
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, owner, kind=None):
+        """Returns a new TimerEntry expiring in delay seconds."""
+        entry = TimerEntry(owner, kind)
+        self.rearm(entry, delay)
+        return entry
+
+    def rearm(self, entry, delay):
+        """(Re)schedule entry to expire in delay seconds from now."""
+        if entry.bucket is not None:
+            entry.bucket.discard(entry)
+        else:
+            self.count += 1
+
+        self.start()
+        entry.deadline = self.now + max(1, math.ceil(delay / self.tick))
+        self.place(entry)
+
+    def cancel(self, entry):
+        if entry.bucket is None:
+            return
+
+        entry.bucket.discard(entry)
+        entry.bucket = None
+        self.count -= 1
+
+    def place(self, entry):
+        deadline = entry.deadline
+        if deadline <= self.now:
+            bucket = self.levels[0][self.now & self.mask]
+        else:
+            # Lowest level whose higher digits agree with the current tick
+            differing = deadline ^ self.now
+            level = 0
+            while differing >> (self.bits * (level + 1)):
+                level += 1
+
+            if level < len(self.levels):
+                bucket = self.levels[level][(deadline >> (self.bits * level)) & self.mask]
+            else:
+                bucket = self.overflow
+
+        bucket.add(entry)
+        entry.bucket = bucket
+
+    def start(self):
+        """Start ticking; the wheel stops by itself while it holds no timer."""
+        if self.handle is not None:
+            return
+
+        loop = asyncio.get_running_loop()
+        self.origin = loop.time() - self.now * self.tick
+        self.handle = loop.call_at(self.origin + (self.now + 1) * self.tick, self.advance)
+
+    def advance(self):
+        """Process every tick due by now and expire their timers in one batch."""
+        self.handle = None
+        loop = asyncio.get_running_loop()
+        target = int((loop.time() - self.origin) / self.tick)
+
+        expired = []
+        while self.now < target and self.count:
+            self.now += 1
+            self.cascade()
+
+            bucket = self.levels[0][self.now & self.mask]
+            if bucket:
+                self.levels[0][self.now & self.mask] = set()
+                for entry in bucket:
+                    entry.bucket = None
+                self.count -= len(bucket)
+                expired.extend(bucket)
+
+        if not self.count:
+            self.now = max(self.now, target)
+        else:
+            self.handle = loop.call_at(self.origin + (self.now + 1) * self.tick, self.advance)
+
+        if expired:
+            self.onExpire(expired)
+
+    def cascade(self):
+        """Move down the timers of every higher level bucket the wheel just reached."""
+        for level in range(1, len(self.levels)):
+            if self.now & ((1 << (self.bits * level)) - 1):
+                return
+
+            index = (self.now >> (self.bits * level)) & self.mask
+            bucket = self.levels[level][index]
+            if bucket:
+                self.levels[level][index] = set()
+                for entry in bucket:
+                    self.place(entry)
+
+        if not self.now & ((1 << (self.bits * len(self.levels))) - 1) and self.overflow:
+            bucket, self.overflow = self.overflow, set()
+            for entry in bucket:
+                self.place(entry)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
@@ -0,0 +1,166 @@
+"""
+Which Client Agent sessions see which (parent, zone).
+
+A client watches a set of zones under one parent (its shard): the zone it
+is in plus the ones visible from it. The index keeps (parent, zone) ->
+sessions up to date as sessions change zones, so delivering an update for an
+object in a zone is one dict lookup instead of a scan of every session.
+
+With a VisibilityGraph loaded, what a zone sees comes from the graph
+instead of the client, and a session moving between two zones of the graph
+costs one cached diff lookup.
+
+MD location channels are (parent << 32) | zone.
+"""
+
+import functools
+import json
+
+EMPTY = frozenset()
+
+
+def splitLocation(channel):
+    """Returns the (parent, zone) of a location channel."""
+    return channel >> 32, channel & 0xFFFFFFFF
+
+
+class VisibilityGraph:
+    """
+    The zones visible from every zone, loaded once: each zone maps to an
+    immutable frozenset of itself and its neighbours, and the (entered,
+    left) diff of moving from one zone to another is kept in an LRU.
+    """
+
+    def __init__(self, neighbours, cacheSize=4096):
+        """
+        :param neighbours: {zone: iterable of the zones visible from it}.
+        :param cacheSize: Number of (old zone, new zone) diffs kept.
+        """
+        self.visible = {zone: frozenset((zone, *zones)) for zone, zones in neighbours.items()}
+        self.transition = functools.lru_cache(maxsize=cacheSize)(self.diff)
+
+    def __contains__(self, zone):
+        return zone in self.visible
+
+    def __len__(self):
+        return len(self.visible)
+
+    def visibleFrom(self, zone):
+        """The frozenset of zones visible from zone, None if the graph does not have it."""
+        return self.visible.get(zone)
+
+    def diff(self, oldZone, newZone):
+        """Returns the (entered, left) zones of moving from oldZone to newZone, uncached."""
+        old = self.visible[oldZone]
+        new = self.visible[newZone]
+        return new - old, old - new
+
+    def cacheInfo(self):
+        return self.transition.cache_info()
+
+
+def loadVisibilityGraph(path, cacheSize=4096):
+    """
+    Load a VisibilityGraph from a JSON file mapping every zone to the list
+    of zones visible from it: {"2100": [2101, 2102], ...}
+    """
+    with open(path) as f:
+        neighbours = json.load(f)
+
+    return VisibilityGraph({int(zone): [int(other) for other in zones]
+                            for zone, zones in neighbours.items()}, cacheSize)
+
+
+class ZoneInterestIndex:
+    def __init__(self, visibility=None):
+        """
+        :param visibility: VisibilityGraph deciding what sessions in its zones see.
+        """
+        self.watchers = {}  # (parent, zone) -> set of sessions
+        self.visibility = visibility
+
+    def __len__(self):
+        return len(self.watchers)
+
+    def setZone(self, session, parent, zone, visibleZones=()):
+        """
+        Move session to zone under parent. It watches the zones the
+        visibility graph has for zone, or else zone and visibleZones.
+        Returns the (entered, left) zones, as setInterest.
+        """
+        graph = self.visibility
+        zones = graph.visibleFrom(zone) if graph is not None else None
+        if zones is None:
+            session.zone = zone
+            return self.setInterest(session, parent, frozenset((zone, *visibleZones)))
+
+        if parent == session.parent and session.zones is graph.visibleFrom(session.zone):
+            # Both zones come from the graph: the diff is cached
+            entered, left = graph.transition(session.zone, zone)
+        elif parent == session.parent:
+            entered = zones - session.zones
+            left = session.zones - zones
+        else:
+            entered, left = zones, session.zones
+
+        session.zone = zone
+        self.applyInterest(session, parent, zones, entered, left)
+        return entered, left
+
+    def setInterest(self, session, parent, zones):
+        """
+        Make session watch zones (a frozenset) under parent, instead of what
+        it watched so far (session.parent / session.zones).
+        Returns the (entered, left) zones; when the parent changed every old
+        zone was left under the old parent.
+        """
+        if parent == session.parent:
+            entered = zones - session.zones
+            left = session.zones - zones
+        else:
+            entered = zones
+            left = session.zones
+
+        self.applyInterest(session, parent, zones, entered, left)
+        return entered, left
+
+    def applyInterest(self, session, parent, zones, entered, left):
+        oldParent = session.parent
+        for zone in left:
+            key = (oldParent, zone)
+            sessions = self.watchers[key]
+            sessions.discard(session)
+            if not sessions:
+                del self.watchers[key]
+
+        for zone in entered:
+            sessions = self.watchers.get((parent, zone))
+            if sessions is None:
+                sessions = self.watchers[(parent, zone)] = set()
+            sessions.add(session)
+
+        session.parent = parent
+        session.zones = zones
+
+    def removeSession(self, session):
+        self.setInterest(session, 0, EMPTY)
+
+    def watching(self, parent, zone):
+        """The sessions watching (parent, zone); do not modify it."""
+        return self.watchers.get((parent, zone), EMPTY)
+
+    def lookup(self, channels):
+        """
+        The sessions watching any of the location channels. With a single
+        channel this is the index's own set: do not modify it.
+        """
+        if len(channels) == 1:
+            return self.watchers.get(splitLocation(channels[0]), EMPTY)
+
+        sessions = set()
+        for channel in channels:
+            watchers = self.watchers.get(splitLocation(channel))
+            if watchers:
+                sessions |= watchers
+
+        return sessions